@@ -0,0 +1,61 @@
+import cchess
+from cchess import ChessBoard
+
+from XQMagicUI.LocalDB import AnalysisStore, getCanonicalKey
+
+#红方走了炮二平五后的局面，左右不对称
+FEN = 'rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C2C4/9/RNBAKABNR b - - 1 1'
+
+def make_info(depth, score = 20):
+    return {
+        'fen': FEN, 'iccs': 'h9g7', 'score': score, 'depth': depth,
+        'moves': ['h9g7', 'h0g2'],
+        'actions': {'h9g7': {'iccs': 'h9g7', 'score': score, 'diff': 0}},
+    }
+
+def test_canonical_key():
+    board = ChessBoard(FEN)
+    key, is_mirror = getCanonicalKey(board)
+    key_m, is_mirror_m = getCanonicalKey(board.mirror())
+    
+    assert key == key_m
+    assert is_mirror != is_mirror_m
+
+def test_analysis_store(tmp_path):
+    store = AnalysisStore()
+    store.open(tmp_path / 'analysis.db')
+    
+    assert store.getAnalysis(FEN, 'engine') is None
+    assert store.saveAnalysis(make_info(20), 'engine', 'Pikafish')
+
+    ret = store.getAnalysis(FEN, 'engine')
+    assert ret['iccs'] == 'h9g7'
+    assert ret['depth'] == 20
+    assert ret['score'] == 20
+    assert ret['engine'] == 'Pikafish'
+    assert ret['moves'] == ['h9g7', 'h0g2']
+    assert ret['actions']['h9g7']['new_key'] == ChessBoard(FEN).copy().move_iccs('h9g7').board_done.zhash()
+    
+    #深度不够不算命中
+    assert store.getAnalysis(FEN, 'engine', minDepth = 25) is None
+    assert store.getAnalysis(FEN, 'cloud') is None
+
+    #镜像局面共用一条记录，着法跟着镜像
+    ret = store.getAnalysis(cchess.fen_mirror(FEN), 'engine')
+    assert ret['iccs'] == cchess.iccs_mirror('h9g7')
+    assert ret['moves'] == cchess.iccs_list_mirror(['h9g7', 'h0g2'])
+    assert list(ret['actions']) == [cchess.iccs_mirror('h9g7')]
+    
+    #浅的结果不覆盖深的结果
+    assert not store.saveAnalysis(make_info(10, score = 99), 'engine', 'Pikafish')
+    assert store.getAnalysis(FEN, 'engine')['score'] == 20
+    assert store.saveAnalysis(make_info(30, score = 40), 'engine', 'Pikafish')
+    assert store.getAnalysis(FEN, 'engine', minDepth = 25)['score'] == 40
+
+    store.close()
+
+    #重新打开后数据还在
+    store = AnalysisStore()
+    store.open(tmp_path / 'analysis.db')
+    assert store.getAnalysis(FEN, 'engine')['depth'] == 30
+    store.close()
@@ -0,0 +1,72 @@
+import sys
+import json
+import copy
+from pathlib import Path
+
+import cv2 as cv
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'Tools'))
+
+from bench_online import run_bench, find_regressions, count_same_squares, main
+from test_board_vision import load_board_image, move_image_piece, BOARD_FEN
+
+CORPUS = 'Tests/online_corpus.json'
+ROI = [30, 600, 1020, 1200]
+
+def make_clip(file_name, images, repeat = 5):
+    #每个局面重复几帧：压缩后开头的几帧略有不同，要重复到画面稳定才会被识别
+    height, width = images[0].shape[:2]
+    writer = cv.VideoWriter(str(file_name), cv.VideoWriter_fourcc(*'MJPG'), 10, (width, height))
+    for img in images:
+        for i in range(repeat):
+            writer.write(img)
+    writer.release()
+
+def test_bench_image(qtbot):
+    result = run_bench(CORPUS)
+    assert result['accuracy'] == 1.0
+    assert result['items'][0]['fen'] == BOARD_FEN
+    #to_fen计时的是完整识别，不是上一帧的缓存
+    assert result['items'][0]['rescored'] == 90
+    for name in ['detect_board', 'match_board', 'to_fen']:
+        assert result['stages'][name]['count'] == 1
+
+    assert count_same_squares(BOARD_FEN, '9/9/9/9/9/9/9/9/9/9 w') == 90 - 28
+
+def test_bench_video(qtbot, tmp_path):
+    img = load_board_image()
+    img_1 = move_image_piece(img, (7, 3), (8, 3), (5, 3))
+    img_2 = move_image_piece(img_1, (2, 4), (2, 5), (1, 4))
+    make_clip(tmp_path / 'clip.avi', [img, img_1, img_2])
+
+    fens = [BOARD_FEN, '2r1kabr1/3na4/1c2b2c1/p7R/2p1N1p2/4C4/P1P3P1P/7C1/9/1RBAKAB2 b',
+            '2r1kabr1/3na4/1c2b2c1/p7R/4N1p2/2p1C4/P1P3P1P/7C1/9/1RBAKAB2 w']
+    corpus = {'items': [{'file': 'clip.avi', 'roi': ROI, 'fens': fens}]}
+    (tmp_path / 'corpus.json').write_text(json.dumps(corpus), encoding = 'utf-8')
+
+    result = run_bench(tmp_path)
+    it = result['items'][0]
+    assert it['moves'] == ['h6i6', 'c5c4']
+    assert it['correct'] == it['squares'] == 270
+    assert it['rescored'] >= 90 + 2 * 2
+    assert result['stages']['track_board']['count'] == it['frames'] - 1
+
+def test_find_regressions(qtbot, tmp_path):
+    result = run_bench(CORPUS)
+    assert find_regressions(result, result) == []
+
+    baseline = copy.deepcopy(result)
+    baseline['accuracy'] = 1.5
+    baseline['items'][0]['accuracy'] = 1.5
+    baseline['stages']['to_fen']['p95_ms'] = result['stages']['to_fen']['p95_ms'] / 2
+    flags = find_regressions(result, baseline)
+    assert len(flags) == 3
+    assert 'to_fen' in flags[2]
+
+    #有退步时返回1
+    save_file = tmp_path / 'result.json'
+    assert main([CORPUS, '--save', str(save_file)]) == 0
+    saved = json.loads(save_file.read_text(encoding = 'utf-8'))
+    saved['accuracy'] = 1.5
+    save_file.write_text(json.dumps(saved), encoding = 'utf-8')
+    assert main([CORPUS, '--baseline', str(save_file)]) == 1
@@ -0,0 +1,256 @@
+import cv2 as cv
+import numpy as np
+
+from XQMagicUI.BoardVision import FrameDiffer, LatencyStats, image_hash, hash_distance, \
+                    TemplateMatcher, BoardTracker, TRACKER_MAX_FAILS
+
+def load_board_image():
+    return cv.imdecode(np.fromfile('Tests/棋盘.jpg', dtype = np.uint8), cv.IMREAD_COLOR)
+
+def crop(img, pt, radius = 30):
+    x, y = pt
+    return img[y - radius:y + radius, x - radius:x + radius]
+
+#Tests/棋盘.jpg的棋盘位置：左上角格子中心和格子大小，棋子半径
+BOARD_LEFT, BOARD_TOP, BOARD_GRID, PIECE_RADIUS = 103, 678, 112.4, 40
+
+#取模板的格子(x向右, y向下)
+TEMPLATE_SQUARES = {(0, 0): 'r', (1, 1): 'n', (4, 0): 'k', (3, 0): 'a', (5, 0): 'b', (1, 2): 'c', (0, 3): 'p',
+                    (1, 9): 'R', (2, 9): 'B', (3, 9): 'A', (4, 9): 'K', (4, 5): 'N', (4, 4): 'C', (0, 6): 'P'}
+
+def square_img(img, x, y, radius = PIECE_RADIUS):
+    #与OnlineManager.get_piece_img相同的取法
+    v = int(radius / 1.5)
+    return crop(img, (int(BOARD_LEFT + BOARD_GRID * x), int(BOARD_TOP + BOARD_GRID * y)), v)
+
+def board_templates(img):
+    return {fench: square_img(img, x, y) for (x, y), fench in TEMPLATE_SQUARES.items()}
+
+def board_squares(img):
+    return [square_img(img, x, y, PIECE_RADIUS / 1.2) for y in range(10) for x in range(9)]
+
+def match_loop(crops, templates):
+    #原来OnlineManager.detect_piece的逐个模板匹配
+    ret = []
+    for img in crops:
+        best, best_score = None, 0.0
+        for key, tmpl in templates.items():
+            score = cv.minMaxLoc(cv.matchTemplate(img, tmpl, cv.TM_CCOEFF_NORMED))[1]
+            if score > best_score:
+                best, best_score = key, score
+        ret.append((best, best_score))
+    return ret
+
+def count_changed_loop(img_a, img_b, threshold):
+    #原来MovieSource.get_image_roi中逐个像素的计数
+    change = np.abs(img_a.astype(int) - img_b.astype(int))
+    count = 0
+    for y in range(change.shape[0]):
+        for x in range(change.shape[1]):
+            if change[y, x] > threshold:
+                count += 1
+    return count
+
+def make_frames(count, changing, size = (120, 160), seed = 1):
+    #前changing帧每帧都有一大块不同的图案，之后画面不变
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 255, size + (3, ), dtype = np.uint8)
+    frames = []
+    for i in range(count):
+        frame = base.copy()
+        if i < changing:
+            frame[20:100, 20:140] = rng.integers(0, 255, (80, 120, 3), dtype = np.uint8)
+        frames.append(frame)
+    return frames
+
+def frame_reader(frames):
+    it = iter(frames)
+    def read():
+        frame = next(it, None)
+        return (frame is not None, frame)
+    return read
+
+def test_changed_pixels():
+    rng = np.random.default_rng(2)
+    img_a = rng.integers(0, 255, (40, 50), dtype = np.uint8)
+    img_b = np.clip(img_a.astype(int) + rng.integers(-30, 30, (40, 50)), 0, 255).astype(np.uint8)
+
+    differ = FrameDiffer()
+    assert differ.changed_pixels(img_a, img_b) == count_changed_loop(img_a, img_b, 15)
+
+def test_wait_stable():
+    frames = make_frames(10, 4)
+    roi = ((0, 0), (160, 120))
+
+    differ = FrameDiffer()
+    frame = differ.wait_stable(frame_reader(frames), roi)
+    #第4帧(下标)与第5帧相同，返回第4帧
+    assert frame is frames[4]
+    assert differ.latency.get_stats()['count'] == 5
+
+    #没有感兴趣区域时读满帧数
+    frame = FrameDiffer().wait_stable(frame_reader(frames), None, max_frames = 6)
+    assert frame is frames[6]
+
+    #缩小比较和哈希比较的结果相同
+    for differ in [FrameDiffer(scale = 4), FrameDiffer(hash_distance = 2)]:
+        assert differ.wait_stable(frame_reader(frames), roi) is frames[4]
+
+    assert FrameDiffer().wait_stable(frame_reader([])) is None
+
+def test_image_hash():
+    rng = np.random.default_rng(3)
+    img = rng.integers(0, 255, (64, 64, 3), dtype = np.uint8)
+    noisy = np.clip(img.astype(int) + rng.integers(-3, 3, img.shape), 0, 255).astype(np.uint8)
+
+    assert hash_distance(image_hash(img), image_hash(img)) == 0
+    assert hash_distance(image_hash(img), image_hash(noisy)) <= 4
+    assert hash_distance(image_hash(img), image_hash(255 - img)) > 32
+
+def test_latency_stats():
+    stats = LatencyStats(window = 4)
+    assert stats.get_stats()['fps'] == 0.0
+    for ms in [1, 2, 3, 4, 100]:
+        stats.add(ms / 1000.0)
+    ret = stats.get_stats()
+    assert ret['count'] == 5
+    assert abs(ret['max_ms'] - 100) < 1e-6
+    assert abs(ret['mean_ms'] - 27.25) < 1e-6
+    assert abs(ret['fps'] - 1000 / 27.25) < 1e-6
+
+def test_template_matcher():
+    img = load_board_image()
+    templates = board_templates(img)
+    crops = board_squares(img)
+
+    matcher = TemplateMatcher(templates, crops[0].shape[:2])
+    results = matcher.match(crops)
+    expected = match_loop(crops, templates)
+    assert [x[0] for x in results] == [x[0] for x in expected]
+    assert max(abs(a[1] - b[1]) for a, b in zip(results, expected)) < 1e-3
+
+    #模板所在的格子一定识别成这个模板
+    for (x, y), fench in TEMPLATE_SQUARES.items():
+        assert results[y * 9 + x][0] == fench
+        assert results[y * 9 + x][1] > 0.9
+
+    #格子图像比模板大时在格子图像上滑动
+    small = {key: cv.resize(tmpl, (36, 36)) for key, tmpl in templates.items()}
+    results = TemplateMatcher(small, crops[0].shape[:2]).match(crops[:9])
+    expected = match_loop(crops[:9], small)
+    assert [x[0] for x in results] == [x[0] for x in expected]
+
+def test_template_matcher_changed_squares():
+    img = load_board_image()
+    matcher = TemplateMatcher(board_templates(img), board_squares(img)[0].shape[:2])
+
+    results = matcher.match_frame(board_squares(img))
+    assert matcher.rescored == 90
+
+    assert matcher.match_frame(board_squares(img)) == results
+    assert matcher.rescored == 0
+
+    #把红车(1, 9)涂成一块纯色，只重新识别这一格
+    img = img.copy()
+    x, y = int(BOARD_LEFT + BOARD_GRID), int(BOARD_TOP + BOARD_GRID * 9)
+    img[y - 30:y + 30, x - 30:x + 30] = img[y - 30:y + 30, x - 30 - 56:x + 30 - 56].mean(axis = (0, 1))
+    new_results = matcher.match_frame(board_squares(img))
+    assert matcher.rescored == 1
+    assert new_results[9 * 9 + 1][1] < 0.5
+    assert new_results[:81] == results[:81]
+
+#Tests/棋盘.jpg上实际的棋子(x向右, y向下)，每种棋子取一个
+BOARD_PIECES = {(2, 0): 'r', (4, 0): 'k', (5, 0): 'a', (6, 0): 'b', (3, 1): 'n', (1, 2): 'c', (0, 3): 'p',
+                (7, 3): 'R', (4, 4): 'N', (4, 5): 'C', (0, 6): 'P', (2, 9): 'B', (3, 9): 'A', (4, 9): 'K'}
+BOARD_FEN = '2r1kabr1/3na4/1c2b2c1/p6Rp/2p1N1p2/4C4/P1P3P1P/7C1/9/1RBAKAB2 w'
+
+def tracker_squares(img):
+    #与OnlineManager.match_squares的顺序相同，y = 0是最下面一行
+    return [square_img(img, x, 9 - y, PIECE_RADIUS / 1.2) for y in range(10) for x in range(9)]
+
+def move_image_piece(img, src, dst, empty, size = 50):
+    #把src格子的棋子贴到dst，src贴上空格子empty的图像
+    def rect(pt):
+        x, y = int(BOARD_LEFT + BOARD_GRID * pt[0]), int(BOARD_TOP + BOARD_GRID * pt[1])
+        return slice(y - size, y + size), slice(x - size, x + size)
+    img = img.copy()
+    piece, blank = img[rect(src)].copy(), img[rect(empty)].copy()
+    img[rect(dst)] = piece
+    img[rect(src)] = blank
+    return img
+
+def test_board_tracker():
+    img = load_board_image()
+    templates = {fench: square_img(img, x, y) for (x, y), fench in BOARD_PIECES.items()}
+    crops = tracker_squares(img)
+    tracker = BoardTracker(TemplateMatcher(templates, crops[0].shape[:2]))
+
+    assert tracker.reset(crops) == BOARD_FEN
+    assert not tracker.flip
+    assert tracker.rescored == 90
+
+    assert tracker.update(crops) == []
+    assert tracker.rescored == 0
+
+    #红车吃卒，只重新识别两个格子
+    img = move_image_piece(img, (7, 3), (8, 3), (5, 3))
+    assert tracker.update(tracker_squares(img)) == ['h6i6']
+    assert tracker.rescored == 2
+    assert tracker.board.get_fench((8, 6)) == 'R'
+    assert tracker.update(tracker_squares(img)) == []
+
+    #黑卒前进
+    img = move_image_piece(img, (2, 4), (2, 5), (1, 4))
+    assert tracker.update(tracker_squares(img)) == ['c5c4']
+    assert tracker.moves == ['h6i6', 'c5c4']
+    fen = tracker.board.to_fen()
+
+    #不合法的变化不改变棋盘，下一帧还会再识别
+    bad = move_image_piece(img, (4, 9), (4, 6), (5, 3))
+    assert tracker.update(tracker_squares(bad)) == []
+    assert tracker.board.to_fen() == fen
+    assert tracker.update(tracker_squares(bad)) == []
+    assert tracker.rescored == 2
+    assert tracker.update(tracker_squares(img)) == []
+
+    #没看到红方走子，黑方又走了一步，按另一方的着法找
+    img = move_image_piece(img, (1, 2), (1, 8), (5, 3))
+    assert tracker.update(tracker_squares(img)) == ['b7b1']
+    img = move_image_piece(img, (4, 5), (4, 6), (5, 3))
+    assert tracker.update(tracker_squares(img)) == ['e4e3']
+    assert tracker.latency.get_stats()['count'] > 0
+
+def test_board_tracker_resync():
+    img = load_board_image()
+    templates = {fench: square_img(img, x, y) for (x, y), fench in BOARD_PIECES.items()}
+    crops = tracker_squares(img)
+    tracker = BoardTracker(TemplateMatcher(templates, crops[0].shape[:2]))
+    assert tracker.reset(crops) == BOARD_FEN
+    start = img
+
+    #两帧之间双方各走了一步
+    img = move_image_piece(img, (7, 3), (8, 3), (5, 3))
+    img = move_image_piece(img, (2, 4), (2, 5), (1, 4))
+    assert tracker.update(tracker_squares(img)) == ['h6i6', 'c5c4']
+    assert tracker.fens[0] == BOARD_FEN
+    assert tracker.resets == 1
+
+    #一下走了三步推不出着法，连续失败几次后整个棋盘重新识别
+    img = move_image_piece(img, (1, 2), (1, 8), (5, 3))
+    img = move_image_piece(img, (4, 5), (4, 6), (5, 3))
+    img = move_image_piece(img, (0, 3), (0, 4), (5, 3))
+    crops = tracker_squares(img)
+    for i in range(TRACKER_MAX_FAILS - 1):
+        assert tracker.update(crops) == []
+    assert tracker.resets == 1
+    assert tracker.update(crops) == []
+    assert tracker.resets == 2
+    assert tracker.rescored == 90
+    fresh = BoardTracker(tracker.matcher)
+    assert tracker.board.to_fen() == fresh.reset(crops)
+    assert tracker.update(crops) == []
+
+    #变化的格子太多(比如开了新局)，马上重新识别
+    assert tracker.update(tracker_squares(start)) == []
+    assert tracker.resets == 3
+    assert tracker.board.to_fen().split()[0] == BOARD_FEN.split()[0]
@@ -0,0 +1,27 @@
+import pytest
+from peewee import OperationalError
+
+from XQMagicUI.LocalDB import openBookDatabase, BOOK_CACHE_MB, BOOK_MMAP_MB
+
+def test_writable_book_database(tmp_path):
+    db = openBookDatabase(tmp_path / '本地库.db')
+    db.connect()
+    assert db.pragma('journal_mode') == 'wal'
+    assert db.pragma('cache_size') == -1024 * BOOK_CACHE_MB
+    db.execute_sql('CREATE TABLE t (x INTEGER)')
+    db.execute_sql('INSERT INTO t VALUES (1)')
+    db.close()
+
+def test_read_only_book_database(tmp_path):
+    file_name = tmp_path / '开局库.db'
+    db = openBookDatabase(file_name)
+    db.execute_sql('CREATE TABLE t (x INTEGER)')
+    db.execute_sql('INSERT INTO t VALUES (1)')
+    db.close()
+    
+    db = openBookDatabase(file_name, readOnly = True)
+    assert db.execute_sql('SELECT x FROM t').fetchall() == [(1, )]
+    assert db.pragma('mmap_size') == 1024 * 1024 * BOOK_MMAP_MB
+    with pytest.raises(OperationalError):
+        db.execute_sql('INSERT INTO t VALUES (2)')
+    db.close()
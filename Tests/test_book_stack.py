@@ -0,0 +1,113 @@
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+
+import pytest
+
+from cchess import FULL_INIT_FEN
+
+from XQMagicUI.BookStack import BookStack, BOOK_SCORE_MAX, BOOK_STACK_THREADS
+from XQMagicUI.LocalDB import openBookDatabase
+
+class FakeBook():
+    def __init__(self, moves, delay = 0):
+        self.moves = moves
+        self.delay = delay
+        self.count = 0
+
+    def getMoves(self, fen):
+        self.count += 1
+        time.sleep(self.delay)
+        if not self.moves:
+            return None
+        actions = OrderedDict()
+        for iccs, score in self.moves:
+            actions[iccs] = {'iccs': iccs, 'score': score, 'text': iccs}
+        return {'fen': fen, 'actions': actions}
+
+def test_book_stack_merge():
+    stack = BookStack()
+    stack.setBook('local', FakeBook([('b2e2', 3), ('h0g2', 1)]), priority = 0, mark = '*')
+    stack.setBook('open', FakeBook([('h2e2', 20), ('b2e2', 10)]), priority = 10, useScore = False)
+
+    ret = stack.query(FULL_INIT_FEN)
+    actions = ret['actions']
+    assert list(actions) == ['h2e2', 'b2e2', 'h0g2']
+    assert 'score' not in actions['h2e2']
+    assert actions['b2e2'] == {'iccs': 'b2e2', 'text': 'b2e2', 'mark': '*', 'score': 3}
+
+    stack.setBook('open', FakeBook([('b2e2', 10)]), priority = 10)
+    assert stack.query(FULL_INIT_FEN)['actions']['b2e2']['score'] == 10
+    stack.scorePolicy = BOOK_SCORE_MAX
+    stack.clearCache()
+    stack.setBook('local', FakeBook([('b2e2', 30)]), mark = '*')
+    assert stack.query(FULL_INIT_FEN)['actions']['b2e2']['score'] == 30
+    stack.close()
+
+def test_book_stack_async_cache(qtbot):
+    books = [FakeBook([(f'{c}0{c}1', i)], delay = 0.2) for i, c in enumerate('abcd')]
+    stack = BookStack()
+    for i, book in enumerate(books):
+        stack.setBook(str(i), book, priority = i)
+    
+    #四个库同时查询，总时间与一个库差不多
+    start = time.perf_counter()
+    with qtbot.waitSignal(stack.resultSignal, timeout = 2000) as result:
+        stack.startQuery({'fen': FULL_INIT_FEN})
+        assert (time.perf_counter() - start) < 0.1
+    assert (time.perf_counter() - start) < 0.6
+    assert list(result.args[0]['actions']) == ['d0d1', 'c0c1', 'b0b1', 'a0a1']
+
+    #再次查询同一局面直接从缓存取出
+    with qtbot.waitSignal(stack.resultSignal, timeout = 100) as result:
+        stack.startQuery({'fen': FULL_INIT_FEN})
+    assert all(book.count == 1 for book in books)
+
+    #修改返回结果不影响缓存
+    result.args[0]['actions']['d0d1']['score'] = 100
+    assert stack.query(FULL_INIT_FEN)['actions']['d0d1']['score'] == 3
+    stack.close()
+
+class DBBook():
+    #查询时记下每个线程用的sqlite连接
+    def __init__(self, file_name):
+        self.db = openBookDatabase(file_name)
+        self.connections = {}
+
+    def getMoves(self, fen):
+        self.db.execute_sql('SELECT 1')
+        self.connections[threading.get_ident()] = self.db.connection()
+        time.sleep(0.05)
+        return None
+
+def test_book_stack_close_connections(qtbot, tmp_path):
+    book = DBBook(tmp_path / 'book.db')
+    stack = BookStack()
+    for i in range(BOOK_STACK_THREADS):
+        stack.setBook(str(i), book)
+
+    with qtbot.waitSignal(stack.resultSignal, timeout = 2000):
+        stack.startQuery({'fen': FULL_INIT_FEN})
+    assert len(book.connections) > 1
+
+    #换库时不等工作线程，各个线程下次查询前关掉自己的旧连接
+    old = dict(book.connections)
+    start_time = time.perf_counter()
+    stack.closeConnections()
+    assert (time.perf_counter() - start_time) < 0.05
+    book.connections.clear()
+    with qtbot.waitSignal(stack.resultSignal, timeout = 2000):
+        stack.startQuery({'fen': '9/9/9/9/9/9/9/9/9/4K4 w'})
+    reused = [x for x in book.connections if x in old]
+    assert reused
+    for ident in reused:
+        assert book.connections[ident] is not old[ident]
+        with pytest.raises(sqlite3.ProgrammingError):
+            old[ident].execute('SELECT 1')
+
+    #每个工作线程中的连接都关掉了
+    stack.close()
+    for conn in book.connections.values():
+        with pytest.raises(sqlite3.ProgrammingError):
+            conn.execute('SELECT 1')
@@ -0,0 +1,170 @@
+import time
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+from cchess import ChessBoard, FULL_INIT_FEN, pos2iccs
+
+from XQMagicUI import CloudDB as cloud_db
+from XQMagicUI.CloudDB import CloudDB, NetQuery, CLOUD_MAX_INFLIGHT, CLOUD_PREFETCH_INFLIGHT, CLOUD_MAX_RETRY
+from XQMagicUI.Cache import getFenKey
+
+def legal_moves(fen):
+    board = ChessBoard(fen)
+    moves = []
+    for move_from, move_to in board.create_moves():
+        iccs = pos2iccs(move_from, move_to)
+        if ChessBoard(fen).move_iccs(iccs):
+            moves.append(iccs)
+    return moves
+
+class CloudHandler(BaseHTTPRequestHandler):
+    #每个局面的前fail_count次请求返回500，之后返回着法
+    fails = {}
+    fail_count = 1
+    
+    def do_GET(self):
+        board = parse_qs(urlparse(self.path).query)['board'][0]
+        count = self.fails.get(board, 0)
+        self.fails[board] = count + 1
+        if count < self.fail_count:
+            #出错的响应也要有Content-Length，否则客户端可能在连接关闭后重发请求
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = ('|'.join(f'move:{iccs},score:{10 - i}' for i, iccs in enumerate(legal_moves(board)[:2]))).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    CloudHandler.fails = {}
+    CloudHandler.fail_count = 1
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), CloudHandler)
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/chessdb.php'
+    httpd.shutdown()
+
+def test_cloud_retry_does_not_block(qtbot, server):
+    cloud = CloudDB(None)
+    cloud.url = server
+    
+    start = time.perf_counter()
+    with qtbot.waitSignal(cloud.query_result_signal, timeout = 5000) as result:
+        cloud.startQuery({'fen': FULL_INIT_FEN})
+        #出错重试由定时器完成，startQuery立刻返回
+        assert (time.perf_counter() - start) < 0.2
+    
+    ret = result.args[0]
+    assert ret['fen'] == FULL_INIT_FEN
+    assert list(ret['actions']) == legal_moves(FULL_INIT_FEN)[:2]
+    assert not cloud.query_worker
+    assert CloudHandler.fails[FULL_INIT_FEN] == 2
+
+def test_cloud_retry_count(qtbot, server, monkeypatch):
+    monkeypatch.setattr(cloud_db, 'CLOUD_RETRY_DELAY', 10)
+    CloudHandler.fail_count = 100
+    cloud = CloudDB(None)
+    
+    query = NetQuery(cloud, FULL_INIT_FEN, server, [('board', FULL_INIT_FEN)])
+    with qtbot.waitSignal(query.query_err_signal, timeout = 5000):
+        query.startQuery()
+    
+    #第一次查询加上CLOUD_MAX_RETRY次重试
+    assert CloudHandler.fails[FULL_INIT_FEN] == CLOUD_MAX_RETRY + 1
+    assert query.tryCount == CLOUD_MAX_RETRY + 1
+
+def test_cloud_inflight_cap_and_cancel(qtbot, server):
+    cloud = CloudDB(None)
+    cloud.url = server
+    
+    board = ChessBoard(FULL_INIT_FEN)
+    fens = []
+    for move_from, move_to in list(board.create_moves())[:CLOUD_MAX_INFLIGHT + 2]:
+        move = board.copy().move(move_from, move_to)
+        fens.append(move.board_done.to_fen())
+
+    for fen in fens:
+        cloud.startQuery({'fen': fen})
+    
+    assert len(cloud.query_worker) == CLOUD_MAX_INFLIGHT
+    assert len(cloud.pending) == 2
+    
+    #走到新局面后，旧局面的查询全部取消
+    cloud.cancelQueries(keep = [fens[0]])
+    assert len(cloud.query_worker) == 1
+    assert not cloud.pending
+    
+    with qtbot.waitSignal(cloud.query_result_signal, timeout = 5000) as result:
+        pass
+    assert result.args[0]['fen'] == fens[0]
+
+def test_cloud_prefetch(qtbot, server):
+    cloud = CloudDB(None)
+    cloud.url = server
+    
+    board = ChessBoard(FULL_INIT_FEN)
+    fens = []
+    for move_from, move_to in list(board.create_moves())[:CLOUD_PREFETCH_INFLIGHT + 1]:
+        move = board.copy().move(move_from, move_to)
+        fens.append(move.board_done.to_fen())
+    
+    emitted = []
+    cloud.query_result_signal.connect(emitted.append)
+    
+    #预取只占用有限的在途查询，结果只放进缓存
+    cloud.prefetch(fens)
+    assert len(cloud.query_worker) == CLOUD_PREFETCH_INFLIGHT
+    assert len(cloud.prefetching) == 1
+    
+    qtbot.waitUntil(lambda: all(getFenKey(fen) in cloud.move_cache for fen in fens), timeout = 5000)
+    assert not emitted
+    
+    #走到预取过的局面，结果立刻从缓存中取出
+    cloud.startQuery({'fen': fens[0]})
+    assert emitted[-1]['fen'] == fens[0]
+    assert not cloud.query_worker
+
+def test_cloud_cancel_keeps_prefetch(qtbot, server):
+    cloud = CloudDB(None)
+    cloud.url = server
+    
+    board = ChessBoard(FULL_INIT_FEN)
+    fens = []
+    for move_from, move_to in list(board.create_moves())[:CLOUD_PREFETCH_INFLIGHT + 1]:
+        move = board.copy().move(move_from, move_to)
+        fens.append(move.board_done.to_fen())
+    
+    #走到下一步时，新局面还要预取的局面不取消，也不重新查询
+    cloud.prefetch(fens)
+    workers = dict(cloud.query_worker)
+    cloud.cancelQueries(keep = fens[1:])
+    assert getFenKey(fens[0]) not in cloud.query_worker
+    assert all(cloud.query_worker[key] is q for key, q in workers.items() if key != getFenKey(fens[0]))
+    #空出来的位置给排队的预取
+    assert getFenKey(fens[-1]) in cloud.query_worker
+    assert not cloud.prefetching
+    
+    cloud.prefetch(fens[1:])
+    qtbot.waitUntil(lambda: all(getFenKey(fen) in cloud.move_cache for fen in fens[1:]), timeout = 5000)
+    assert all(CloudHandler.fails[fen] == 2 for fen in fens[1:])
+
+def test_cloud_prefetch_upgrade(qtbot, server):
+    cloud = CloudDB(None)
+    cloud.url = server
+    
+    #已经在预取的局面又被正常查询，结果要发给界面
+    cloud.prefetch([FULL_INIT_FEN])
+    with qtbot.waitSignal(cloud.query_result_signal, timeout = 5000) as result:
+        cloud.startQuery({'fen': FULL_INIT_FEN})
+    assert result.args[0]['fen'] == FULL_INIT_FEN
+    assert CloudHandler.fails[FULL_INIT_FEN] == 2
@@ -0,0 +1,54 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'Tools'))
+
+from cloud_crawler import CloudFetcher, CloudCrawler, PosMove, Frontier, open_db, close_db, parse_moves
+from fake_cloud_server import start_server, CloudHandler
+
+@pytest.fixture
+def server():
+    httpd, url = start_server(max_moves = 2, fail_every = 3)
+    yield url
+    httpd.shutdown()
+
+def crawl(db_file, url, limit = 0):
+    open_db(str(db_file))
+    fetcher = CloudFetcher(url, concurrency = 4, retries = 5, retry_delay = 0.01)
+    crawler = CloudCrawler(fetcher, max_step = 4, batch_size = 4)
+    crawler.seed()
+    try:
+        stats = crawler.crawl(limit)
+        fens = [x.fen for x in PosMove.select()]
+        done = Frontier.select().where(Frontier.done == True).count()
+    finally:
+        fetcher.close()
+        close_db()
+    return stats, fens, done
+
+def test_parse_moves():
+    moves = parse_moves('move:h2e2,score:1,rank:2,note:! (10-00)|move:b2e2,score:-3\0')
+    assert [(x['move'], x['score']) for x in moves] == [('h2e2', 1), ('b2e2', -3)]
+    assert parse_moves('unknown\0') == []
+    assert parse_moves('invalid board') is None
+
+def test_crawl_resume(tmp_path, server):
+    db_file = tmp_path / 'openbook.db'
+
+    #第一次只查询一部分就停下，模拟中途退出
+    stats, fens, done = crawl(db_file, server, limit = 5)
+    assert stats['queried'] == 5
+    assert done == 5
+    assert stats['pending'] > 0
+
+    #再次运行从上次的位置继续，直到队列为空
+    stats, all_fens, done = crawl(db_file, server)
+    assert stats['pending'] == 0
+    assert set(fens) <= set(all_fens)
+    assert len(all_fens) == len(set(all_fens))
+    assert done == 5 + stats['queried']
+    assert stats['pos_per_sec'] > 0
+    #有查询出错后重试成功
+    assert CloudHandler.failures > 0
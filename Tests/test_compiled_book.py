@@ -0,0 +1,87 @@
+import os
+
+from cchess import ChessBoard, FULL_INIT_FEN, pos2iccs
+
+from XQMagicUI.LocalDB import OpenBookYfk, LocalBook
+from XQMagicUI.CompiledBook import CompiledBook, compileBook, getCompiledFile
+
+from test_open_book import make_yfk
+
+def book_records(depth = 3, width = 4):
+    records = []
+    fens = []
+    level = [FULL_INIT_FEN]
+    for i in range(depth):
+        next_level = []
+        for fen in level:
+            fens.append(fen)
+            count = 0
+            for move_from, move_to in ChessBoard(fen).create_moves():
+                iccs = pos2iccs(move_from, move_to)
+                board = ChessBoard(fen)
+                if board.move_iccs(iccs) is None:
+                    continue
+                board.next_turn()
+                records.append((fen, iccs, 20 - count * 3))
+                next_level.append(board.to_fen())
+                count += 1
+                if count >= width:
+                    break
+        level = next_level
+    return records, fens + level
+
+def test_compiled_book_same_as_yfk(tmp_path):
+    file_name = tmp_path / 'book.yfk'
+    records, fens = book_records()
+    make_yfk(file_name, records)
+    
+    compiled_file = getCompiledFile(file_name)
+    assert compileBook([file_name], compiled_file) == len(records)
+    
+    yfk = OpenBookYfk()
+    yfk.open(file_name)
+    book = CompiledBook()
+    assert book.open(compiled_file, [file_name])
+    
+    for fen in fens:
+        ret = yfk.getMoves(fen)
+        ret_c = book.getMoves(fen)
+        if ret is None:
+            assert ret_c is None
+            continue
+        assert ret_c['score'] == ret['score']
+        assert [(x['iccs'], x['score'], x['diff'], x['text']) for x in ret_c['actions'].values()] \
+                == [(x['iccs'], x['score'], x['diff'], x['text']) for x in ret['actions'].values()]
+    
+    book.close()
+    yfk.close()
+
+def test_compiled_book_stale(tmp_path):
+    file_name = tmp_path / 'book.yfk'
+    records, fens = book_records(depth = 1)
+    make_yfk(file_name, records)
+    compiled_file = getCompiledFile(file_name)
+    compileBook([file_name], compiled_file)
+    
+    #源库改动后编译库不再使用
+    st = file_name.stat()
+    os.utime(file_name, ns = (st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert not CompiledBook().open(compiled_file, [file_name])
+    assert CompiledBook().open(compiled_file)
+
+def test_compiled_local_book(tmp_path):
+    local = LocalBook()
+    local.open(tmp_path / 'localbook.db')
+    board = ChessBoard(FULL_INIT_FEN)
+    board.move_iccs('b2e2')
+    board.next_turn()
+    fen = board.to_fen()
+    local.saveRecord(fen, 'h9g7', None)
+    local.close()
+    
+    compiled_file = tmp_path / 'local.xqb'
+    compileBook([tmp_path / 'localbook.db'], compiled_file)
+    book = CompiledBook()
+    book.open(compiled_file)
+    assert list(book.getMoves(fen)['actions']) == ['h9g7']
+    book.close()
@@ -0,0 +1,29 @@
+import pytest
+
+def test_coalescer_keeps_latest_per_multipv(qtbot):
+    from XQMagicUI.Engine import EngineInfoCoalescer
+
+    c = EngineInfoCoalescer(None, fps = 1000)
+    c.timer.stop()
+    
+    fen = "rnbakabnr/9/1c5c1/p1p1p1p1p/9/9/P1P1P1P1P/1C5C1/9/RNBAKABNR w"
+    for depth in range(1, 11):
+        for pv in (1, 2):
+            c.push(1, {'fen': fen, 'multipv': pv, 'depth': depth})
+    
+    with qtbot.waitSignal(c.infoSignal, timeout=1000) as sig:
+        c.flush()
+    
+    engine_id, infos = sig.args
+    assert engine_id == 1
+    assert sorted(x['multipv'] for x in infos) == [1, 2]
+    assert all(x['depth'] == 10 for x in infos)
+
+    stats = c.getStats()
+    assert stats['received'] == 20
+    assert stats['merged'] == 18
+    assert stats['delivered'] == 2
+    
+    c.push(1, {'fen': fen, 'multipv': 1, 'depth': 11})
+    c.clear()
+    assert c.getStats()['dropped'] == 1
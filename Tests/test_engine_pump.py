@@ -0,0 +1,45 @@
+import time
+import threading
+from queue import Queue
+
+import pytest
+
+class QueueEngine():
+    #只模拟cchess.Engine的两个队列，engine_out_queque由"读线程"写入
+    def __init__(self):
+        self.ids = {'name': 'Fake'}
+        self.options = []
+        self.engine_out_queque = Queue()
+        self.move_queue = Queue()
+
+    def get_action(self):
+        if not self.engine_out_queque.empty():
+            line = self.engine_out_queque.get()
+            if line == 'uciok':
+                self.move_queue.put({'action': 'ready'})
+        if self.move_queue.empty():
+            return None
+        return self.move_queue.get()
+
+def test_engine_pump_wakes_on_output(qtbot):
+    from XQMagicUI.Engine import EngineManager
+
+    mgr = EngineManager(None, id=1)
+    mgr.engine = QueueEngine()
+
+    thread = threading.Thread(target=mgr.run, daemon=True)
+    thread.start()
+    time.sleep(0.1)
+
+    with qtbot.waitSignal(mgr.readySignal, timeout=1000) as ready:
+        start = time.perf_counter()
+        mgr.engine.engine_out_queque.put('uciok')
+    
+    assert ready.args[0] == 1
+    assert mgr.isReady
+    #不再有100ms的轮询延迟
+    assert (time.perf_counter() - start) < 0.09
+
+    mgr.stop()
+    thread.join(2)
+    assert not thread.is_alive()
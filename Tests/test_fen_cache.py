@@ -0,0 +1,78 @@
+from cchess import ChessBoard, FULL_INIT_FEN
+
+from XQMagicUI.Cache import FenCache, getFenKey, getMoveKey
+
+def test_fen_cache_lru():
+    cache = FenCache(maxEntries = 3)
+    for i in range(3):
+        cache[i] = {'score': i}
+    
+    #访问过的条目移到最后，最久没用的先淘汰
+    assert 0 in cache
+    cache[0]['diff'] = 1
+    cache[3] = {}
+    
+    assert len(cache) == 3
+    assert 1 not in cache
+    assert cache[0] == {'score': 0, 'diff': 1}
+    
+    stats = cache.getStats()
+    assert stats['evictions'] == 1
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+def test_fen_cache_pinned():
+    cache = FenCache(maxEntries = 2)
+    cache[1] = {}
+    cache[2] = {}
+    cache.pin([1, 2])
+    
+    #钉住的条目不会被淘汰，只能超出上限
+    cache[3] = {}
+    assert list(cache) == [1, 2, 3]
+    
+    cache.pin([1])
+    cache[4] = {}
+    assert list(cache) == [1, 4]
+
+def test_fen_cache_bytes():
+    cache = FenCache(maxBytes = 4096)
+    cache[1] = {}
+    cache[2] = {}
+    
+    #取出后直接修改的条目也会重新计算大小
+    cache[1]['moves'] = ['h2e2'] * 100
+    cache[2]
+    cache[3] = {}
+    
+    assert 1 not in cache
+    assert cache.getStats()['bytes'] <= 4096
+    
+    assert cache.get(2) == {}
+    assert cache.get(9, 1) == 1
+    assert cache.pop(2) == {}
+    assert cache.pop(2, None) is None
+
+def test_child_key():
+    board = ChessBoard(FULL_INIT_FEN)
+    key = getFenKey(FULL_INIT_FEN)
+    
+    #每一步的增量键值都和走后局面重新计算的zhash相同
+    for iccs in ['h2e2', 'h9g7', 'h0g2', 'i9h9', 'i0h0', 'b9c7', 'e2e6']:
+        for move_from, move_to in board.create_moves():
+            move = board.copy().move(move_from, move_to)
+            if move:
+                assert getMoveKey(move, key) == move.board_done.zhash()
+        move = board.move_iccs(iccs)
+        board.next_turn()
+        key = getMoveKey(move, key)
+        assert key == board.zhash()
+        assert key == getFenKey(board.to_fen())
+
+def test_fen_cache_fen_key():
+    cache = FenCache()
+    cache[FULL_INIT_FEN] = {'score': 1}
+    
+    #fen和键值指向同一个条目
+    assert getFenKey(FULL_INIT_FEN) in cache
+    assert cache[getFenKey(FULL_INIT_FEN)]['score'] == 1
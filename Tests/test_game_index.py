@@ -0,0 +1,96 @@
+import os
+import time
+import shutil
+from pathlib import Path
+
+from cchess import Game
+
+from XQMagicUI.GameIndex import GameIndex, findIndexFiles, getGameKeys, IndexFile
+from XQMagicUI.LocalDB import getCanonicalKey
+
+def copy_books(tmp_path, count):
+    folder = tmp_path / 'books'
+    folder.mkdir()
+    files = list(findIndexFiles(['Books/00《象棋布局全书》/06五九炮过河车']))[:count]
+    for i, it in enumerate(files):
+        shutil.copy(it, folder / f'{i:02d}.xqf')
+    return folder
+
+def position_of(file_name, ply):
+    game = Game.read_from(file_name)
+    board = game.init_board.copy()
+    for iccs in game.dump_iccs_moves()[0][:ply]:
+        board.move_iccs(iccs)
+        board.next_turn()
+    return board
+
+def test_game_index_search(tmp_path):
+    folder = copy_books(tmp_path, 6)
+
+    index = GameIndex()
+    index.open(tmp_path / 'gameindex.db')
+    stats = index.update([str(folder)])
+    assert stats['files'] == 6
+    assert stats['updated'] == 6
+    assert stats['positions'] > 0
+
+    #每局的开始局面都能找到
+    file_name = str(folder / '03.xqf')
+    game = Game.read_from(file_name)
+    board = position_of(file_name, 0)
+    results = index.search(board.to_fen())
+    assert len(results) == 6
+
+    #走到第12步的局面
+    board = position_of(file_name, 12)
+    keys = getGameKeys(game)
+    assert keys[12] == getCanonicalKey(board)[0]
+    results = index.search(board.to_fen())
+    it = [x for x in results if x['file'] == file_name][0]
+    assert it['index'] == 0
+    assert it['ply'] == keys.index(keys[12])
+
+    #镜像局面也能找到
+    mirror = index.search(board.mirror().to_fen())
+    assert mirror == results
+
+    start_time = time.perf_counter()
+    for i in range(100):
+        index.search(board.to_fen())
+    assert (time.perf_counter() - start_time) / 100 < 0.01
+
+    index.close()
+
+def test_game_index_update(tmp_path):
+    folder = copy_books(tmp_path, 4)
+
+    index = GameIndex()
+    index.open(tmp_path / 'gameindex.db')
+    index.update([str(folder)])
+
+    #没有改动的文件不重新读取
+    stats = index.update([str(folder)])
+    assert stats['updated'] == 0
+    assert stats['removed'] == 0
+
+    #改动过的文件重新索引，删除的文件从索引中去掉
+    changed = folder / '01.xqf'
+    st = changed.stat()
+    os.utime(changed, ns = (st.st_atime_ns, st.st_mtime_ns + 10**9))
+    os.remove(folder / '02.xqf')
+
+    stats = index.update([str(folder)])
+    assert stats['updated'] == 1
+    assert stats['removed'] == 1
+
+    paths = [it.path for it in IndexFile.select()]
+    assert sorted(Path(x).name for x in paths) == ['00.xqf', '01.xqf', '03.xqf']
+
+    board = position_of(folder / '00.xqf', 0)
+    assert len(index.search(board.to_fen())) == 3
+
+    #按棋谱删除局面用索引，不扫描整个表
+    plan = index.db.execute_sql('EXPLAIN QUERY PLAN DELETE FROM position WHERE game IN (1, 2)').fetchall()
+    assert 'position_game' in str(plan)
+
+    index.close()
@@ -0,0 +1,150 @@
+import struct
+
+from PyQt5.QtCore import Qt, QModelIndex
+
+from cchess import ChessBoard, Game, FULL_INIT_FEN
+
+from XQMagicUI.GameLib import readLibIndex, readLibGame, GameLibModel, GAME_LIB_PAGE_SIZE, \
+                    CBL_MAGIC, CBL_GAMES_START, CBL_BLOCK_SIZE, CBR_MAGIC, buildPositions, readGameFile, FileLoadWorker
+
+PIECE_CODES = {'R': 0x11, 'N': 0x12, 'B': 0x13, 'A': 0x14, 'K': 0x15, 'C': 0x16, 'P': 0x17,
+               'r': 0x21, 'n': 0x22, 'b': 0x23, 'a': 0x24, 'k': 0x25, 'c': 0x26, 'p': 0x27}
+
+MOVES = ['h2e2', 'h9g7', 'h0g2', 'i9h9', 'i0h0', 'b9c7']
+
+def encode_str(s, size):
+    return s.encode('utf-16-le').ljust(size, b'\x00')
+
+def encode_pos(iccs):
+    x, y = ord(iccs[0]) - ord('a'), int(iccs[1])
+    return (9 - y) * 9 + x
+
+def make_cbr(title, moves, blocks = 1):
+    board = ChessBoard(FULL_INIT_FEN)
+    squares = bytearray(90)
+    for x in range(9):
+        for y in range(10):
+            fench = board.get_fench((x, y))
+            if fench:
+                squares[(9 - y) * 9 + x] = PIECE_CODES[fench]
+
+    header = struct.pack("<16s164s128s384s64s320s64s160s64s712sB35sB3sH2s90si",
+                CBR_MAGIC, b'', encode_str(title, 128), b'', encode_str('测试赛', 64), b'',
+                encode_str('红方', 64), b'', encode_str('黑方', 64), b'', 1, b'', 1, b'', len(moves), b'', bytes(squares), 0)
+
+    steps = b''
+    for i, iccs in enumerate(moves):
+        mark = 0x01 if i == len(moves) - 1 else 0
+        steps += bytes([mark, 0, encode_pos(iccs[:2]), encode_pos(iccs[2:])])
+
+    #文件头后面是注释长度(0)
+    data = header + struct.pack('<i', 0) + steps
+    return data.ljust(CBL_BLOCK_SIZE * blocks, b'\x00')
+
+def make_cbl(file_name, games):
+    head = struct.pack("<16s44si512s", CBL_MAGIC, b'', len(games), encode_str('测试棋库', 512))
+    with open(file_name, 'wb') as f:
+        f.write(head.ljust(CBL_GAMES_START, b'\x00'))
+        for title, moves, blocks in games:
+            f.write(make_cbr(title, moves, blocks))
+
+def test_read_lib_index(tmp_path):
+    file_name = tmp_path / 'test.cbl'
+    #第二局占两个块
+    games = [(f'第{i}局', MOVES[:i + 1], 2 if i == 1 else 1) for i in range(5)]
+    make_cbl(file_name, games)
+
+    lib = readLibIndex(file_name)
+    assert lib['name'] == '测试棋库'
+    assert [x['title'] for x in lib['games']] == [x[0] for x in games]
+    assert lib['games'][1]['size'] == CBL_BLOCK_SIZE * 2
+    assert lib['games'][0]['red'] == '红方'
+    assert lib['games'][0]['result'] == '1-0'
+
+    #按需解析的结果与整个棋库一次解析的相同
+    full = Game.read_from_lib(file_name)
+    assert len(full['games']) == len(lib['games'])
+    for entry, game in zip(lib['games'], full['games']):
+        it = readLibGame(file_name, entry)
+        assert it.dump_iccs_moves() == game.dump_iccs_moves()
+        assert it.info['index'] == entry['index']
+
+    #对局库搜索结果中只有序号
+    it = readLibGame(file_name, {'index': 3})
+    assert it.dump_iccs_moves()[0] == MOVES[:4]
+
+    bad_file = tmp_path / 'bad.cbl'
+    bad_file.write_bytes(b'bad')
+    assert readLibIndex(bad_file) is None
+
+def test_game_lib_model(qtbot):
+    entries = [{'file': 'a.cbl', 'index': i, 'title': f'第{i}局'} for i in range(GAME_LIB_PAGE_SIZE * 2 + 10)]
+
+    model = GameLibModel()
+    model.setEntries(entries)
+    assert model.rowCount() == GAME_LIB_PAGE_SIZE
+    assert model.canFetchMore(QModelIndex())
+
+    model.fetchMore(QModelIndex())
+    model.fetchMore(QModelIndex())
+    assert model.rowCount() == len(entries)
+    assert not model.canFetchMore(QModelIndex())
+
+    index = model.index(5)
+    assert model.data(index) == '第5局'
+    assert model.data(index, Qt.UserRole) is entries[5]
+
+    model.setEntries([{'file': 'b.xqf', 'index': 0, 'title': 'b', 'ply': 7}])
+    assert model.rowCount() == 1
+    assert model.data(model.index(0)) == 'b (第7步)'
+
+def test_build_positions():
+    file_name = 'Tests/Books/征东.XQF'
+    result = readGameFile(file_name)
+    game = result['game']
+    moves = game.dump_iccs_moves()[0]
+    positions = result['positions']
+    assert len(positions) == len(moves)
+
+    #与逐步走子的结果相同
+    board = game.init_board.copy()
+    for index, (iccs, position) in enumerate(zip(moves, positions), 1):
+        fen_prev = board.to_fen()
+        move = board.move_iccs(iccs)
+        board.next_turn()
+        assert position['index'] == index
+        assert position['iccs'] == iccs
+        assert position['fen_prev'] == fen_prev
+        assert position['fen'] == board.to_fen()
+        assert position['move'].to_text() == move.to_text()
+
+    assert positions[-1]['fen_engine'] == positions[-1]['move'].to_engine_fen()
+
+    #非法着法之后的不再走
+    assert len(buildPositions(FULL_INIT_FEN, ['h2e2', 'h2e2', 'h9g7'])) == 1
+
+def test_file_load_worker(qtbot, tmp_path):
+    file_name = tmp_path / 'test.cbl'
+    make_cbl(file_name, [(f'第{i}局', MOVES, 1) for i in range(600)])
+
+    worker = FileLoadWorker(file_name)
+    progress = []
+    worker.progressSignal.connect(lambda count, total: progress.append((count, total)))
+    with qtbot.waitSignal(worker.doneSignal, timeout = 10000) as blocker:
+        worker.start()
+    worker.thread.wait()
+
+    result = blocker.args[0]
+    assert result['type'] == 'lib'
+    assert not result['canceled']
+    assert len(result['lib']['games']) == 600
+    assert progress and all(total == 600 for count, total in progress)
+
+    #取消后不返回结果
+    worker = FileLoadWorker(file_name)
+    worker.stop()
+    with qtbot.waitSignal(worker.doneSignal, timeout = 10000) as blocker:
+        worker.start()
+    worker.thread.wait()
+    assert blocker.args[0]['canceled']
+    assert blocker.args[0]['lib'] is None
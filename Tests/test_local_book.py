@@ -0,0 +1,109 @@
+import json
+import sqlite3
+from pathlib import Path
+
+from cchess import ChessBoard, Game, FULL_INIT_FEN, fen_mirror, iccs_mirror, pos2iccs
+
+from XQMagicUI.LocalDB import LocalBook, Book, LOCAL_BOOK_VERSION, LOCAL_BOOK_BATCH_SIZE, getCanonicalKey
+
+def side_fen():
+    #不对称的局面，镜像后的fen与原fen不同
+    board = ChessBoard(FULL_INIT_FEN)
+    board.move_iccs('h2e2')
+    board.next_turn()
+    return board.to_fen()
+
+def test_local_book_mirror(tmp_path):
+    fen = side_fen()
+    f_mirror = fen_mirror(fen)
+    
+    book = LocalBook()
+    book.open(tmp_path / 'localbook.db')
+    
+    book.saveRecord(fen, 'h9g7', None)
+    #镜像局面的同一着法只保存一条
+    book.saveRecord(f_mirror, iccs_mirror('h9g7'), None)
+    book.saveRecord(f_mirror, 'h7e7', 10)
+    assert Book.select().count() == 2
+    
+    key, _ = getCanonicalKey(ChessBoard(fen))
+    assert all(it.key == key for it in Book.select())
+
+    assert list(book.getMoves(fen)['actions']) == ['h9g7', iccs_mirror('h7e7')]
+    assert list(book.getMoves(f_mirror)['actions']) == [iccs_mirror('h9g7'), 'h7e7']
+    assert book.getRecord(f_mirror, 'h7e7')[0] == 1
+    assert book.getRecord(fen, 'h7e7')[0] == 0
+    
+    book.close()
+
+def test_local_book_upgrade(tmp_path):
+    fen = side_fen()
+    file_name = tmp_path / 'localbook.db'
+    
+    #旧版本的表结构，镜像局面各保存了一条
+    conn = sqlite3.connect(file_name)
+    conn.execute('CREATE TABLE book (id INTEGER PRIMARY KEY, fen VARCHAR(255) NOT NULL, iccs VARCHAR(255) NOT NULL, score INTEGER, memo JSON)')
+    conn.execute('CREATE TABLE Bookmark (id INTEGER PRIMARY KEY, name VARCHAR(255) NOT NULL, fen VARCHAR(255) NOT NULL, moves JSON)')
+    conn.execute('INSERT INTO book (fen, iccs) VALUES (?, ?)', (fen, 'h9g7'))
+    conn.execute('INSERT INTO book (fen, iccs, score, memo) VALUES (?, ?, ?, ?)', (fen_mirror(fen), iccs_mirror('h9g7'), 5, json.dumps({'note': '好棋'})))
+    #第一步之后的其他局面，记录数超过一批
+    for move_from, move_to in list(ChessBoard(FULL_INIT_FEN).create_moves()):
+        if pos2iccs(move_from, move_to) in ['h2e2', 'b2e2']:
+            continue
+        board = ChessBoard(FULL_INIT_FEN)
+        board.move(move_from, move_to)
+        board.next_turn()
+        for p_from, p_to in list(board.create_moves()):
+            conn.execute('INSERT INTO book (fen, iccs) VALUES (?, ?)', (board.to_fen(), pos2iccs(p_from, p_to)))
+    conn.execute('INSERT INTO Bookmark (name, fen) VALUES (?, ?)', ('mark', fen))
+    conn.commit()
+    conn.close()
+    
+    book = LocalBook()
+    book.open(file_name)
+    assert book.db_local.pragma('user_version') == LOCAL_BOOK_VERSION
+    assert Book.select().count() > LOCAL_BOOK_BATCH_SIZE
+    
+    #memo原样保留为dict，不会被编码两次
+    key, _ = getCanonicalKey(ChessBoard(fen))
+    assert Book.get(Book.key == key).memo == {'note': '好棋'}
+    
+    actions = book.getMoves(fen)['actions']
+    assert list(actions) == ['h9g7']
+    assert actions['h9g7']['score'] == 5
+    assert book.isNameInBookmark('mark')
+    book.close()
+
+def test_local_book_bulk_import(tmp_path):
+    board = ChessBoard(FULL_INIT_FEN)
+    positionList = [{'fen': board.to_fen()}]
+    for iccs in ['h2e2', 'h9g7', 'h0g2', 'i9h9']:
+        fen_prev = board.to_fen()
+        board.move_iccs(iccs)
+        board.next_turn()
+        positionList.append({'fen': board.to_fen(), 'fen_prev': fen_prev, 'iccs': iccs})
+    
+    book = LocalBook()
+    book.open(tmp_path / 'localbook.db')
+    
+    stats = book.savePositionLists([positionList, positionList])
+    assert stats['plies'] == 8
+    assert stats['inserted'] == 4
+    assert stats['plies_per_sec'] > 0
+    
+    #再次导入不会重复
+    assert book.savePositionList(positionList)['inserted'] == 0
+    assert Book.select().count() == 4
+    assert list(book.getMoves(positionList[2]['fen_prev'])['actions']) == ['h9g7']
+    book.close()
+
+def test_local_book_import_games(tmp_path):
+    games = [Game.read_from(x) for x in sorted(Path('Tests/Books').glob('*.XQF'))[:3]]
+    plies = sum(len(game.dump_iccs_moves()[0]) for game in games if game.dump_iccs_moves())
+    
+    book = LocalBook()
+    book.open(tmp_path / 'localbook.db')
+    stats = book.importGames(games)
+    assert stats['plies'] == plies
+    assert Book.select().count() == stats['inserted']
+    book.close()
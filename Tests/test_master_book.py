@@ -0,0 +1,82 @@
+import sys
+import json
+import sqlite3
+from pathlib import Path
+
+from cchess import FULL_INIT_FEN, ChessBoard, Game
+
+sys.path.insert(0, str(Path(__file__).parent.parent / 'Tools'))
+
+from make_master_book import BookBuilder, add_game, find_files, parse_file
+from XQMagicUI.LocalDB import MasterBook
+
+def test_build_master_book(tmp_path):
+    files = list(find_files(['Books/00《象棋布局全书》/06五九炮过河车']))[:12]
+    out_file = tmp_path / 'master.db'
+    
+    #内存上限设得很小，中途要多次写入临时表
+    builder = BookBuilder(out_file, max_ply = 8, min_count = 1, max_entries = 5)
+    count = builder.build(files, jobs = 2)
+    assert builder.files == len(files)
+    assert builder.flushes > 1
+    assert count > 0
+    
+    conn = sqlite3.connect(out_file)
+    rows = conn.execute('SELECT memo FROM evbook').fetchall()
+    assert not conn.execute("SELECT name FROM sqlite_master WHERE name = 'stats'").fetchall()
+    conn.close()
+    
+    #合并后的出现次数与逐个文件统计的总数相同
+    plies = sum(parse_file(x, 8)[1] for x in files)
+    assert sum(json.loads(memo)['count'] for memo, in rows) == plies
+    
+    book = MasterBook()
+    assert book.open(out_file)
+    ret = book.getMoves(FULL_INIT_FEN)
+    assert ret['actions']
+    book.close()
+
+def make_game(moves, result):
+    board = ChessBoard(FULL_INIT_FEN)
+    game = Game(board)
+    game.info['result'] = result
+    board = board.copy()
+    last = game
+    for i, iccs in enumerate(moves):
+        move = board.move_iccs(iccs)
+        last = game.append_first_move(move) if i == 0 else last.append_next_move(move)
+        board.next_turn()
+    return game
+
+def test_master_book_black_score(tmp_path):
+    stats = {}
+    games = [
+        make_game(['h2e2', 'h9g7'], '1-0'),
+        make_game(['h2e2', 'b9c7'], '0-1'),
+        make_game(['h2e2', 'b9c7'], '0-1'),
+    ]
+    plies = sum(add_game(stats, game, 8) for game in games)
+    
+    out_file = tmp_path / 'master.db'
+    builder = BookBuilder(out_file, max_ply = 8, min_count = 1)
+    builder.add((len(games), plies, list(stats.items())))
+    assert builder.finish() > 0
+    
+    book = MasterBook()
+    assert book.open(out_file)
+    
+    #红方走棋，分数是红方视角的
+    ret = book.getMoves(FULL_INIT_FEN)
+    assert list(ret['actions'].values())[0]['score'] == -33
+    
+    #黑方走棋，库里存的是黑方视角的分数，好的着法排在前面
+    board = ChessBoard(FULL_INIT_FEN)
+    board.move_iccs('h2e2')
+    board.next_turn()
+    ret = book.getMoves(board.to_fen())
+    assert list(ret['actions']) == ['b9c7', 'h9g7']
+    assert ret['score'] == 100
+    assert ret['actions']['b9c7']['score'] == -100
+    assert ret['actions']['h9g7']['score'] == 100
+    assert ret['actions']['h9g7']['diff'] == -200
+    book.close()
@@ -0,0 +1,49 @@
+import sqlite3
+
+from cchess import ChessBoard, FULL_INIT_FEN, fen_mirror, iccs_mirror
+
+from XQMagicUI.LocalDB import OpenBookDB, OpenBookYfk, MoveRecord
+from XQMagicUI.Cache import getFenKey
+
+ByCoord = {v: k for k, v in OpenBookDB.CoordMap.items()}
+
+def yfk_vmove(iccs):
+    return ByCoord[iccs[:2]] | (ByCoord[iccs[2:]] << 8)
+
+def make_yfk(file_name, records):
+    conn = sqlite3.connect(file_name)
+    conn.execute('CREATE TABLE bhobk (id INTEGER PRIMARY KEY, vindex INTEGER, vkey INTEGER, vdraw INTEGER, vlost INTEGER, vmove INTEGER, vscore INTEGER, vvalid INTEGER, vwin INTEGER)')
+    for fen, iccs, score in records:
+        conn.execute('INSERT INTO bhobk (vkey, vmove, vscore, vvalid) VALUES (?, ?, ?, 1)', (ChessBoard(fen).zhash(), yfk_vmove(iccs), score))
+    conn.commit()
+    conn.close()
+
+def test_yfk_lazy_moves(tmp_path):
+    file_name = tmp_path / 'book.yfk'
+    board = ChessBoard(FULL_INIT_FEN)
+    board.move_iccs('b2e2')
+    board.next_turn()
+    fen = board.to_fen()
+    make_yfk(file_name, [(FULL_INIT_FEN, 'h2e2', 10), (FULL_INIT_FEN, 'b0c2', 5), (fen, 'h9g7', 3)])
+
+    book = OpenBookYfk()
+    book.open(file_name)
+    
+    ret = book.getMoves(FULL_INIT_FEN)
+    assert list(ret['actions']) == ['h2e2', 'b0c2']
+    act = ret['actions']['b0c2']
+    assert isinstance(act, MoveRecord)
+    assert act['diff'] == -5
+    assert not act.isResolved
+    
+    #用到着法文字时才走棋
+    assert act['text'] == ChessBoard(FULL_INIT_FEN).move_iccs('b0c2').to_text()
+    assert act.isResolved
+    assert act['new_key'] == getFenKey(ChessBoard(FULL_INIT_FEN).move_iccs('b0c2').board_done.to_fen())
+    assert dict(ret['actions']['h2e2'])['text']
+    
+    #镜像局面查到的着法也要镜像
+    ret = book.getMoves(fen_mirror(fen))
+    assert list(ret['actions']) == [iccs_mirror('h9g7')]
+    
+    book.close()
@@ -0,0 +1,127 @@
+import os
+import time
+import threading
+from queue import Queue
+from pathlib import Path
+
+from cchess import Game, ChessBoard, FULL_INIT_FEN, pos2iccs
+
+from XQMagicUI.Review import positionsFromGame, EngineReviewer, EnginePool, getPoolThreads
+
+def test_positions_from_game():
+    game = Game.read_from(str(Path(__file__).parent / 'Books' / '郝继超先手弃双车胜赵玮.XQF'))
+    moves = game.dump_iccs_moves()[0]
+
+    positions = positionsFromGame(game)
+    
+    assert len(positions) == len(moves) + 1
+    assert positions[0]['fen'] == game.init_board.to_fen()
+    for index, pos in enumerate(positions):
+        assert pos['index'] == index
+    for pos, iccs in zip(positions[1:], moves):
+        assert pos['iccs'] == iccs
+    #每一步的前一局面就是上一个position
+    for prev, pos in zip(positions, positions[1:]):
+        assert pos['fen_prev'] == prev['fen']
+
+class SilentEngine():
+    #收到go和stop都不回应
+    def __init__(self):
+        self.engine_out_queque = Queue()
+        self.move_queue = Queue()
+        self.cmds = []
+
+    def _send_cmd(self, cmd):
+        self.cmds.append(cmd)
+
+    def go_from(self, fen, params = {}):
+        self.cmds.append('go')
+
+    def get_action(self):
+        return None
+
+def test_reviewer_gives_up():
+    position = {'fen': FULL_INIT_FEN, 'index': 0}
+
+    #超时后发送stop，再等stop_timeout后放弃
+    engine = SilentEngine()
+    reviewer = EngineReviewer(engine, {}, timeout = 0.1, stop_timeout = 0.2)
+    start_time = time.time()
+    assert reviewer.analyse(position) is None
+    assert time.time() - start_time < 2
+    assert engine.cmds == ['go', 'stop']
+
+    #取消复盘时不等超时
+    engine = SilentEngine()
+    reviewer = EngineReviewer(engine, {}, timeout = 60, stop_timeout = 0.2)
+    stopEvent = threading.Event()
+    stopEvent.set()
+    start_time = time.time()
+    assert reviewer.review([position], stopEvent = stopEvent) == []
+    assert reviewer.analyse(position, stopEvent) is None
+    assert time.time() - start_time < 2
+    assert engine.cmds == ['go', 'stop']
+
+class FakeEngine():
+    #收到go后立即给出第一个合法着法，isready立即回应readyok
+    def __init__(self):
+        self.engine_out_queque = Queue()
+        self.move_queue = Queue()
+        self.score_dict = {}
+        self.fens = []
+
+    def _send_cmd(self, cmd):
+        if cmd == 'isready':
+            self.move_queue.put({'action': 'info', 'raw_msg': 'readyok'})
+
+    def go_from(self, fen, params = {}):
+        self.fens.append(fen)
+        #fen_engine的格式是"起始fen moves 着法..."
+        fen, _, moves = fen.partition(' moves ')
+        board = ChessBoard(fen)
+        for iccs in moves.split():
+            board.move_iccs(iccs)
+            board.next_turn()
+        fen = board.to_fen()
+        for move_from, move_to in board.create_moves():
+            iccs = pos2iccs(move_from, move_to)
+            if ChessBoard(fen).move_iccs(iccs):
+                self.move_queue.put({'action': 'bestmove', 'move': iccs, 'score': 10})
+                return
+        self.move_queue.put({'action': 'dead'})
+
+    def get_action(self):
+        if self.move_queue.empty():
+            return None
+        return self.move_queue.get()
+
+def test_engine_pool_review():
+    game = Game.read_from(str(Path(__file__).parent / 'Books' / '郝继超先手弃双车胜赵玮.XQF'))
+    positions = positionsFromGame(game)
+    
+    engines = [FakeEngine() for i in range(3)]
+    pool = EnginePool({'depth': 10}, engines = engines)
+    
+    seen = []
+    results = pool.review(positions, seen.append)
+    
+    #所有局面都分析了一次，结果按步数排序
+    assert [x['index'] for x in results] == [x['index'] for x in positions]
+    assert len(seen) == len(positions)
+    assert sum(len(x.fens) for x in engines) == len(positions)
+    for ret, pos in zip(results, positions):
+        assert ret['fen'] == pos['fen']
+        assert ret['iccs'] in ret['actions']
+
+def test_engine_pool_stop():
+    game = Game.read_from(str(Path(__file__).parent / 'Books' / '郝继超先手弃双车胜赵玮.XQF'))
+    positions = positionsFromGame(game)
+    
+    stopEvent = threading.Event()
+    stopEvent.set()
+    pool = EnginePool({}, engines = [FakeEngine(), FakeEngine()])
+    assert pool.review(positions, stopEvent = stopEvent) == []
+
+def test_pool_threads():
+    assert getPoolThreads(1) == max(1, os.cpu_count())
+    assert getPoolThreads(os.cpu_count() * 2) == 1
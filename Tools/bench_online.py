@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import argparse
+from pathlib import Path
+from collections import defaultdict
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cv2 as cv
+import numpy as np
+
+from PyQt5.QtWidgets import QApplication
+
+from cchess import ChessBoard
+
+from XQMagicUI.BoardVision import LatencyStats
+from XQMagicUI.Online import OnlineManager, MovieSource, Point, Size
+
+#---------------------------------------------------------
+#屏幕棋盘识别的离线测试：不截屏，直接识别标注过的图片和视频，统计各步骤耗时和识别正确率
+#语料是一个json文件，文件路径相对于json文件所在目录：
+#{"items": [
+#    {"file": "棋盘.jpg", "roi": [left, top, width, height], "fen": "..."},
+#    {"file": "clip.avi", "roi": [left, top, width, height], "fens": ["开始局面", "第一步之后", ...]}
+#]}
+#图片：用fen中的棋子取模板(match_board)，再整个棋盘识别(to_fen)，按格子比较
+#视频：用第一个稳定帧和fens[0]取模板，之后每个稳定帧用BoardTracker跟踪，走出的局面依次与fens按格子比较
+#棋盘黑方在下面时加 "flip": true
+
+VIDEO_TYPES = ['.avi', '.mp4', '.mkv', '.mov']
+
+#p95耗时比上次增加超过这个比例算变慢
+LATENCY_TOLERANCE = 0.2
+
+#---------------------------------------------------------
+class StageTimer():
+    def __init__(self):
+        self.stages = defaultdict(LatencyStats)
+
+    def run(self, name, func, *args):
+        start_time = time.perf_counter()
+        ret = func(*args)
+        self.stages[name].add(time.perf_counter() - start_time)
+        return ret
+
+    def get_stats(self):
+        return {name: stats.get_stats() for name, stats in self.stages.items()}
+
+def read_image(file_name):
+    #cv.imread不支持中文路径
+    return cv.imdecode(np.fromfile(str(file_name), dtype = np.uint8), cv.IMREAD_COLOR)
+
+def load_corpus(file_name):
+    file_name = Path(file_name)
+    if file_name.is_dir():
+        file_name = file_name / 'corpus.json'
+    with open(file_name, 'r', encoding = 'utf-8') as f:
+        items = json.load(f)['items']
+    for it in items:
+        it['path'] = str(file_name.parent / it['file'])
+    return items
+
+def count_same_squares(fen, expect_fen):
+    board, expect = ChessBoard(fen), ChessBoard(expect_fen)
+    return sum(1 for x in range(9) for y in range(10) if board.get_fench((x, y)) == expect.get_fench((x, y)))
+
+#---------------------------------------------------------
+def prepare_board(manager, timer, img, item, fen):
+    #找棋盘并用标注的局面取模板，与在线识别界面中的操作相同
+    manager.img_cv = img
+    left, top, width, height = item['roi']
+    manager.set_roi(Point(left, top), Size(width, height))
+    if not timer.run('detect_board', manager.detect_board):
+        return False
+    timer.run('match_board', manager.match_board, ChessBoard(fen), item.get('flip', False))
+    return True
+
+def bench_image(manager, timer, item):
+    result = {'file': item['file'], 'detected': False, 'correct': 0, 'squares': 90, 'frames': 1}
+    img = read_image(item['path'])
+    if (img is None) or not prepare_board(manager, timer, img, item, item['fen']):
+        return result
+
+    #match_board已经识别过这张图，清掉上一帧的结果，计时的是90个格子的完整识别
+    manager.get_matcher().last_crops = None
+    fen = timer.run('to_fen', manager.to_fen)
+    #实际识别的格子数，只用了缓存时是0
+    rescored = manager.matcher.rescored
+    result.update({'detected': True, 'correct': count_same_squares(fen, item['fen']), 'fen': fen, 'rescored': rescored})
+    return result
+
+def bench_video(manager, timer, item):
+    fens = item['fens']
+    result = {'file': item['file'], 'detected': False, 'correct': 0, 'squares': 90 * len(fens), 'frames': 0}
+
+    source = MovieSource()
+    if not source.open(item['path']):
+        return result
+
+    left, top, width, height = item['roi']
+    roi_rect = ((left, top), (left + width, top + height))
+    img = source.get_image_roi(roi_rect)
+    if (img is None) or not prepare_board(manager, timer, img, item, fens[0]):
+        return result
+
+    manager.tracker = None
+    timer.run('track_reset', manager.track_board)
+    rescored = manager.tracker.rescored
+    frames = 1
+    while True:
+        img = timer.run('wait_stable', source.get_image_roi, roi_rect)
+        if img is None:
+            break
+        frames += 1
+        manager.img_cv = img
+        timer.run('track_board', manager.track_board)
+        rescored += manager.tracker.rescored
+
+    #开始的局面和走过的每个局面
+    positions = manager.tracker.fens + [manager.tracker.board.to_fen()]
+    correct = sum(count_same_squares(fen, expect) for fen, expect in zip(positions, fens))
+    result.update({'detected': True, 'correct': correct, 'frames': frames, 'moves': manager.tracker.moves, 'rescored': rescored})
+    return result
+
+def run_bench(corpus):
+    timer = StageTimer()
+    manager = OnlineManager(None)
+    items = []
+
+    start_time = time.perf_counter()
+    for item in load_corpus(corpus):
+        if Path(item['path']).suffix.lower() in VIDEO_TYPES:
+            items.append(bench_video(manager, timer, item))
+        else:
+            items.append(bench_image(manager, timer, item))
+    used = time.perf_counter() - start_time
+
+    for it in items:
+        it['accuracy'] = it['correct'] / it['squares'] if it['squares'] else 0.0
+
+    correct = sum(x['correct'] for x in items)
+    squares = sum(x['squares'] for x in items)
+    frames = sum(x['frames'] for x in items)
+    return {
+        'items': items,
+        'stages': timer.get_stats(),
+        'accuracy': correct / squares if squares else 0.0,
+        'frames': frames,
+        'fps': frames / used if used > 0 else 0.0,
+        }
+
+#---------------------------------------------------------
+def find_regressions(result, baseline, tolerance = LATENCY_TOLERANCE):
+    #与上次的结果比较：正确率下降、p95耗时增加超过tolerance的都列出来
+    flags = []
+    if result['accuracy'] < baseline['accuracy']:
+        flags.append(f"总正确率 {baseline['accuracy']:.2%} -> {result['accuracy']:.2%}")
+
+    old_items = {x['file']: x for x in baseline.get('items', [])}
+    for it in result['items']:
+        old = old_items.get(it['file'])
+        if old and (it['accuracy'] < old['accuracy']):
+            flags.append(f"{it['file']} 正确率 {old['accuracy']:.2%} -> {it['accuracy']:.2%}")
+
+    for name, stats in result['stages'].items():
+        old = baseline.get('stages', {}).get(name)
+        if old and (old['p95_ms'] > 0) and (stats['p95_ms'] > old['p95_ms'] * (1 + tolerance)):
+            flags.append(f"{name} p95 {old['p95_ms']:.2f}ms -> {stats['p95_ms']:.2f}ms")
+
+    return flags
+
+def print_result(result):
+    print(f"{'步骤':12s} {'次数':>6s} {'平均ms':>8s} {'p50ms':>8s} {'p95ms':>8s} {'最大ms':>8s} {'每秒':>8s}")
+    for name, it in result['stages'].items():
+        print(f"{name:12s} {it['count']:6d} {it['mean_ms']:8.2f} {it['p50_ms']:8.2f} {it['p95_ms']:8.2f} {it['max_ms']:8.2f} {it['fps']:8.1f}")
+    print()
+    for it in result['items']:
+        state = '' if it['detected'] else ' 没有找到棋盘'
+        print(f"{it['file']}: {it['correct']}/{it['squares']} 格 {it['accuracy']:.2%}, {it['frames']} 帧, 识别 {it.get('rescored', 0)} 格{state}")
+    print(f"总计: 正确率 {result['accuracy']:.2%}, {result['frames']} 帧, {result['fps']:.1f} 帧/秒")
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '屏幕棋盘识别离线测试')
+    parser.add_argument('corpus', help = '语料json文件，或者包含corpus.json的目录')
+    parser.add_argument('--save', help = '把结果保存到json文件')
+    parser.add_argument('--baseline', help = '与以前保存的结果比较')
+    parser.add_argument('--tolerance', type = float, default = LATENCY_TOLERANCE, help = '耗时增加超过这个比例算变慢')
+    args = parser.parse_args(argv)
+
+    #不需要显示，但识别中用到了QPixmap
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    app = QApplication.instance() or QApplication(sys.argv[:1])
+
+    result = run_bench(args.corpus)
+    print_result(result)
+
+    if args.save:
+        with open(args.save, 'w', encoding = 'utf-8') as f:
+            json.dump(result, f, ensure_ascii = False, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding = 'utf-8') as f:
+            flags = find_regressions(result, json.load(f), args.tolerance)
+        for it in flags:
+            print(f'退步: {it}')
+        if flags:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import sys
+import time
+import argparse
+from pathlib import Path
+from collections import deque
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from cchess import ChessBoard, FULL_INIT_FEN
+
+from XQMagicUI.LocalDB import OpenBookYfk, OpenBookPF
+from XQMagicUI.CompiledBook import CompiledBook
+
+#---------------------------------------------------------
+#开局库查询速度测试
+#从初始局面开始按库中的着法遍历全部(或前limit个)局面，分别测试：
+#  lazy: 只取着法和分数(复盘、预取、多库合并只用到这些)
+#  full: 每个着法都取着法文字和走后局面键值(与界面显示相同)
+
+def open_book(file_name):
+    ext = Path(file_name).suffix.lower()
+    if ext == '.xqb':
+        book = CompiledBook()
+    elif ext == '.yfk':
+        book = OpenBookYfk()
+    else:
+        book = OpenBookPF()
+    book.open(file_name)
+    if not book.isBookOpened:
+        return None
+    return book
+
+def collect_positions(book, limit):
+    fens = []
+    seen = set()
+    queue = deque([FULL_INIT_FEN])
+    while queue and (len(fens) < limit):
+        fen = queue.popleft()
+        board = ChessBoard(fen)
+        key = min(board.zhash(), board.mirror().zhash())
+        if key in seen:
+            continue
+        seen.add(key)
+        ret = book.getMoves(fen)
+        if not ret:
+            continue
+        fens.append(fen)
+        for iccs in ret['actions']:
+            b = board.copy()
+            if b.move_iccs(iccs) is None:
+                continue
+            b.next_turn()
+            queue.append(b.to_fen())
+    return fens
+
+def bench(book, fens, full):
+    moves = 0
+    start_time = time.perf_counter()
+    for fen in fens:
+        ret = book.getMoves(fen)
+        for act in ret['actions'].values():
+            moves += 1
+            if full:
+                act['text']
+                act['new_key']
+            else:
+                act['score']
+    return moves, time.perf_counter() - start_time
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '开局库查询速度测试')
+    parser.add_argument('file', help = '开局库文件(.yfk, .pfbook, 编译后的.xqb)')
+    parser.add_argument('--limit', type = int, default = 100000, help = '最多测试多少个局面')
+    args = parser.parse_args(argv)
+
+    book = open_book(args.file)
+    if book is None:
+        print(f'打开开局库失败：{args.file}')
+        return -1
+
+    fens = collect_positions(book, args.limit)
+    print(f'{args.file}: {len(fens)} 个局面')
+
+    results = {}
+    for name, full in [('lazy', False), ('full', True)]:
+        moves, used = bench(book, fens, full)
+        results[name] = used
+        print(f'{name:5s}: {used:.2f} 秒, {len(fens) / used:.0f} 局面/秒, {moves / used:.0f} 着法/秒')
+
+    print(f"lazy/full 加速 {results['full'] / results['lazy']:.2f} 倍")
+    book.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
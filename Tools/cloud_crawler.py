@@ -0,0 +1,313 @@
+import sys
+import time
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from cchess import ChessBoard, FULL_INIT_FEN
+
+from peewee import *
+from playhouse.sqlite_ext import *
+
+#---------------------------------------------------------
+#云库开局库爬虫，取代make_db_from_cloud_db.py
+#1. 多个请求同时在途(有上限)，出错按指数退避重试
+#2. 待查询队列(frontier)和已见局面都保存在数据库中，每批结果在一个事务里写入，
+#   中途退出后再运行就从上次的位置继续，不会丢失已完成的查询
+#3. 局面按镜像归一后的键值去重，子局面一条insert语句批量加入队列
+
+CLOUD_URL = 'http://www.chessdb.cn/chessdb.php'
+
+CRAWL_CONCURRENCY = 8
+CRAWL_TIMEOUT = 10
+CRAWL_RETRIES = 3
+CRAWL_RETRY_DELAY = 1.0
+
+#一个局面累计失败这么多次就不再查询
+CRAWL_MAX_TRIES = 3
+
+#---------------------------------------------------------
+book_db = SqliteExtDatabase(None)
+
+class PosMove(Model):
+    fen = CharField(unique=True, index=True)
+    vkey = BigIntegerField(unique=True)
+    step  = IntegerField()
+    score = IntegerField()
+    mark  = CharField(null=True)
+    vmoves = JSONField()
+
+    class Meta:
+        database = book_db
+
+class Frontier(Model):
+    #加入过队列的局面都在这里，ckey是镜像归一后的键值，同时作为已见局面集合
+    ckey = BigIntegerField(unique=True)
+    fen = CharField()
+    step = IntegerField(index=True)
+    tries = IntegerField(default=0)
+    done = BooleanField(default=False, index=True)
+
+    class Meta:
+        database = book_db
+
+def open_db(file_name):
+    book_db.init(file_name, pragmas=(
+        ('cache_size', -1024 * 64),
+        ('journal_mode', 'wal'),
+        ('synchronous', 'normal')))
+    book_db.connect(reuse_if_open=True)
+    book_db.create_tables([PosMove, Frontier])
+    return book_db
+
+def close_db():
+    if not book_db.is_closed():
+        book_db.close()
+
+#---------------------------------------------------------
+def get_canonical_key(board):
+    return min(board.zhash(), board.mirror().zhash())
+
+def parse_moves(text):
+    #云库返回 move:h2e2,score:1,rank:2,note:..|move:...，没有记录的局面返回unknown
+    text = text.rstrip('\0').strip()
+    if text.lower() in ['', 'unknown', 'nobestmove']:
+        return []
+    if text.startswith('invalid'):
+        return None
+
+    moves = []
+    for it in text.split('|'):
+        it_dict = {}
+        for seg in it.strip().split(','):
+            if ':' in seg:
+                key, value = seg.split(':', 1)
+                it_dict[key] = value
+        if 'move' not in it_dict or 'score' not in it_dict:
+            continue
+        try:
+            it_dict['score'] = int(it_dict['score'])
+        except ValueError:
+            continue
+        moves.append(it_dict)
+
+    return moves
+
+def clean_moves(fen, step, moves):
+    #与make_db_from_cloud_db.py中的筛选规则相同
+    ret = []
+    save_moves = {}
+    score_best = moves[0]['score']
+    for i, m in enumerate(moves):
+        diff =  abs( m['score'] - score_best)
+
+        if step == 1 and m['score'] < 0:
+            continue
+        else:
+            if step >= 2 and (m['score'] < -65):
+                continue
+
+            elif i > 3 and score_best < 0:
+                continue
+            elif i > 3 and diff > 50:
+                continue
+            elif i >= 7 and diff > 30:
+                continue
+            elif step > 6 and diff > 50:
+                continue
+
+            elif score_best < 0 and diff > 30:
+                continue
+
+            elif score_best > 10 and m['score'] < -score_best:
+                continue
+
+            elif diff > 60:
+                continue
+
+        save_moves[m['move']] = m['score']
+        ret.append({'fen': fen, 'iccs': m['move'], 'score': m['score']})
+
+    return (score_best, ret, save_moves)
+
+#---------------------------------------------------------
+class CloudFetcher():
+    #requests是阻塞的，放在线程池中执行，asyncio只负责调度和限制同时在途的请求数
+    def __init__(self, url = CLOUD_URL, concurrency = CRAWL_CONCURRENCY, timeout = CRAWL_TIMEOUT,
+            retries = CRAWL_RETRIES, retry_delay = CRAWL_RETRY_DELAY):
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.local = threading.local()
+        self.semaphore = None
+
+        self.requests = 0
+        self.errors = 0
+
+    def get_session(self):
+        #每个线程一个Session，复用连接
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def get(self, fen):
+        resp = self.get_session().get(self.url, params = {'action': 'queryall', 'board': fen}, timeout = self.timeout)
+        resp.raise_for_status()
+        return resp.text
+
+    async def fetch(self, fen):
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+
+        loop = asyncio.get_running_loop()
+        for i in range(self.retries):
+            async with self.semaphore:
+                self.requests += 1
+                try:
+                    text = await loop.run_in_executor(self.executor, self.get, fen)
+                    moves = parse_moves(text)
+                    if moves is not None:
+                        return moves
+                except Exception as e:
+                    print(f'查询出错：{fen} {e}')
+                self.errors += 1
+            await asyncio.sleep(self.retry_delay * (2 ** i))
+
+        return None
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+
+#---------------------------------------------------------
+class CloudCrawler():
+    def __init__(self, fetcher, max_step = 20, batch_size = None, max_tries = CRAWL_MAX_TRIES):
+        self.fetcher = fetcher
+        self.max_step = max_step
+        self.batch_size = batch_size if batch_size else fetcher.concurrency * 8
+        self.max_tries = max_tries
+
+        self.saved = 0
+        self.queried = 0
+
+    def seed(self, fen = FULL_INIT_FEN):
+        #队列为空时(第一次运行)放入起始局面
+        if Frontier.select().count() == 0:
+            Frontier.create(ckey = get_canonical_key(ChessBoard(fen)), fen = fen, step = 1)
+
+    def next_batch(self):
+        return list(Frontier.select().where((Frontier.done == False) & (Frontier.tries < self.max_tries)
+                    & (Frontier.step <= self.max_step)).order_by(Frontier.step, Frontier.id).limit(self.batch_size))
+
+    def save_batch(self, batch, results):
+        #一批结果在一个事务里写入，中途退出时这一批整体重做
+        with book_db.atomic():
+            for item, moves in zip(batch, results):
+                if moves is None:
+                    Frontier.update(tries = Frontier.tries + 1).where(Frontier.id == item.id).execute()
+                    continue
+
+                self.queried += 1
+                Frontier.update(done = True).where(Frontier.id == item.id).execute()
+                if not moves:
+                    continue
+
+                score, records, save_moves = clean_moves(item.fen, item.step, moves)
+                if not save_moves:
+                    continue
+
+                board = ChessBoard(item.fen)
+                if PosMove.insert(fen = item.fen, vkey = board.zhash(), score = score, step = item.step,
+                        vmoves = save_moves).on_conflict_ignore().as_rowcount().execute():
+                    self.saved += 1
+
+                children = []
+                for it in records:
+                    b = board.copy()
+                    if b.move_iccs(it['iccs']) is None:
+                        continue
+                    b.next_turn()
+                    children.append({'ckey': get_canonical_key(b), 'fen': b.to_fen(), 'step': item.step + 1})
+                if children:
+                    Frontier.insert_many(children).on_conflict_ignore().execute()
+
+    def pending_count(self):
+        return Frontier.select().where((Frontier.done == False) & (Frontier.tries < self.max_tries)
+                    & (Frontier.step <= self.max_step)).count()
+
+    async def crawl_async(self, max_positions = 0, report = None):
+        start_time = time.time()
+        while True:
+            batch = self.next_batch()
+            if not batch:
+                break
+            if max_positions > 0:
+                left = max_positions - self.queried
+                if left <= 0:
+                    break
+                batch = batch[:left]
+
+            results = await asyncio.gather(*[self.fetcher.fetch(item.fen) for item in batch])
+            self.save_batch(batch, results)
+
+            if report:
+                report(self.get_stats(time.time() - start_time))
+
+        return self.get_stats(time.time() - start_time)
+
+    def crawl(self, max_positions = 0, report = None):
+        return asyncio.run(self.crawl_async(max_positions, report))
+
+    def get_stats(self, used):
+        used = max(used, 1e-6)
+        return {
+            'queried': self.queried,
+            'saved': self.saved,
+            'requests': self.fetcher.requests,
+            'errors': self.fetcher.errors,
+            'pending': self.pending_count(),
+            'seconds': used,
+            'pos_per_sec': self.queried / used,
+        }
+
+def print_stats(stats):
+    print(f"已查询 {stats['queried']} 局面, 保存 {stats['saved']}, 请求 {stats['requests']}(出错 {stats['errors']}), "
+          f"待查询 {stats['pending']}, {stats['pos_per_sec']:.1f} 局面/秒")
+
+#---------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '从云库抓取开局库，可以中断后继续')
+    parser.add_argument('--db', default = 'openbook.db', help = '输出数据库，同时保存抓取进度')
+    parser.add_argument('--url', default = CLOUD_URL, help = '云库地址')
+    parser.add_argument('--jobs', type = int, default = CRAWL_CONCURRENCY, help = '同时在途的请求数')
+    parser.add_argument('--max-step', type = int, default = 20, help = '最多抓取到第几步')
+    parser.add_argument('--limit', type = int, default = 0, help = '本次最多查询多少个局面')
+    parser.add_argument('--fen', default = FULL_INIT_FEN, help = '起始局面')
+    args = parser.parse_args(argv)
+
+    open_db(args.db)
+    fetcher = CloudFetcher(args.url, concurrency = max(1, args.jobs))
+    crawler = CloudCrawler(fetcher, max_step = args.max_step)
+    crawler.seed(args.fen)
+
+    try:
+        stats = crawler.crawl(args.limit, print_stats)
+    except KeyboardInterrupt:
+        print('中断，下次运行从这里继续')
+        return -1
+    finally:
+        fetcher.close()
+        close_db()
+
+    print_stats(stats)
+    print(f"用时 {stats['seconds']:.1f} 秒")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
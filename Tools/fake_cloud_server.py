@@ -0,0 +1,115 @@
+import sys
+import zlib
+import time
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from cchess import ChessBoard, pos2iccs
+
+#---------------------------------------------------------
+#本地模拟的云库(chessdb.cn)，只支持 action=queryall，用于离线测试云库爬虫
+#每个局面返回前几个合法着法，分数由局面和着法决定，多次查询结果相同
+#fail_every > 0 时，局面的crc32能被fail_every整除的，第一次查询返回500，重试时正常返回，
+#哪些查询出错只由局面决定，与请求的先后顺序无关
+
+def legal_moves(fen):
+    board = ChessBoard(fen)
+    moves = []
+    for move_from, move_to in board.create_moves():
+        iccs = pos2iccs(move_from, move_to)
+        if ChessBoard(fen).move_iccs(iccs):
+            moves.append(iccs)
+    return moves
+
+def query_all(fen, max_moves):
+    moves = legal_moves(fen)[:max_moves]
+    if not moves:
+        return 'unknown'
+    scores = sorted([(zlib.crc32(f'{fen} {iccs}'.encode()) % 40 - 10) for iccs in moves], reverse = True)
+    return '|'.join(f'move:{iccs},score:{score},rank:2,note:! (00-00),winrate:50.00' for iccs, score in zip(moves, scores))
+
+class CloudHandler(BaseHTTPRequestHandler):
+    max_moves = 3
+    fail_every = 0
+    delay = 0.0
+
+    lock = threading.Lock()
+    requests = 0
+    failures = 0
+    board_requests = {}
+
+    def should_fail(self, board):
+        if (self.fail_every <= 0) or (zlib.crc32(board.encode()) % self.fail_every) != 0:
+            return False
+        with self.lock:
+            count = self.board_requests.get(board, 0)
+            self.board_requests[board] = count + 1
+            if count == 0:
+                CloudHandler.failures += 1
+        return count == 0
+
+    def do_GET(self):
+        with self.lock:
+            CloudHandler.requests += 1
+
+        if self.delay > 0:
+            time.sleep(self.delay)
+
+        params = parse_qs(urlparse(self.path).query)
+        if self.should_fail(params.get('board', [''])[0]):
+            #出错的响应也要有Content-Length，否则客户端可能在连接关闭后重发请求
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if params.get('action', [''])[0] != 'queryall' or 'board' not in params:
+            body = b'invalid board'
+        else:
+            body = (query_all(params['board'][0], self.max_moves) + '\0').encode()
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server(port = 0, max_moves = 3, fail_every = 0, delay = 0.0):
+    #在后台线程中启动，返回(httpd, url)，用完调用httpd.shutdown()
+    CloudHandler.max_moves = max_moves
+    CloudHandler.fail_every = fail_every
+    CloudHandler.delay = delay
+    CloudHandler.requests = 0
+    CloudHandler.failures = 0
+    CloudHandler.board_requests = {}
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), CloudHandler)
+    thread = threading.Thread(target = httpd.serve_forever, daemon = True)
+    thread.start()
+
+    return (httpd, f'http://127.0.0.1:{httpd.server_address[1]}/chessdb.php')
+
+#---------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '本地模拟云库服务')
+    parser.add_argument('--port', type = int, default = 8099)
+    parser.add_argument('--moves', type = int, default = 3, help = '每个局面返回的着法个数')
+    parser.add_argument('--fail-every', type = int, default = 0, help = '大约每多少个局面有一个第一次查询返回错误')
+    parser.add_argument('--delay', type = float, default = 0.0, help = '每个请求的延迟(秒)')
+    args = parser.parse_args(argv)
+
+    httpd, url = start_server(args.port, args.moves, args.fail_every, args.delay)
+    print(f'模拟云库：{url}')
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        httpd.shutdown()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import sys
+import time
+import argparse
+from pathlib import Path
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import cchess
+from cchess import Game
+
+from playhouse.sqlite_ext import SqliteExtDatabase
+
+from XQMagicUI.LocalDB import MasterEvBook, master_book_db
+
+#---------------------------------------------------------
+#从棋谱集合生成大师库(与MasterBook读取的evbook表格式相同)
+#1. 棋谱文件分给多个进程解析，每个进程先在本地按(局面, 着法)汇总，只把汇总结果传回主进程
+#2. 主进程内存中的汇总表超过上限就合并到数据库的临时表中，内存占用有上限
+#3. 最后用一条SQL从临时表生成evbook表
+
+GAME_EXTS = ['.xqf', '.pgn', '.cbf', '.cbr']
+LIB_EXTS = ['.cbl']
+
+BOOK_MAX_PLY = 30
+BOOK_MIN_COUNT = 2
+#主进程内存中最多汇总这么多条(局面, 着法)，超过就写入临时表
+BOOK_MAX_ENTRIES = 500000
+
+#统计值的位置：出现次数, 红胜, 和, 红负, 最早出现的步数(按红先计数，奇数步为红方走棋)
+COUNT, WIN, DRAW, LOSS, STEP = range(5)
+
+MIRROR_FILES = str.maketrans('abcdefghi', 'ihgfedcba')
+
+#---------------------------------------------------------
+def get_result(game):
+    #红方视角的结果，不明的返回None
+    result = game.info.get('result', '')
+    if result == '1-0':
+        return WIN
+    if result == '0-1':
+        return LOSS
+    if result in ['1/2-1/2', '½-½']:
+        return DRAW
+    return None
+
+def add_game(stats, game, max_ply):
+    moves = game.dump_iccs_moves()
+    if not moves:
+        return 0
+
+    result = get_result(game)
+    board = game.init_board.copy()
+    count = 0
+    #黑先的棋局步数从2开始，保证步数的奇偶与走棋方一致
+    first_step = 2 if board.get_move_color() == cchess.BLACK else 1
+    for step, iccs in enumerate(moves[0][:max_ply], first_step):
+        #左右镜像的局面合并统计，着法也随之镜像
+        zhash = board.zhash()
+        zhash_mirror = board.mirror().zhash()
+        if zhash_mirror < zhash:
+            key, move = zhash_mirror, iccs[0].translate(MIRROR_FILES) + iccs[1] + iccs[2].translate(MIRROR_FILES) + iccs[3]
+        else:
+            key, move = zhash, iccs
+
+        if board.move_iccs(iccs) is None:
+            break
+        board.next_turn()
+
+        it = stats.get((key, move))
+        if it is None:
+            it = stats[(key, move)] = [0, 0, 0, 0, step]
+        it[COUNT] += 1
+        if result is not None:
+            it[result] += 1
+        it[STEP] = min(it[STEP], step)
+        count += 1
+
+    return count
+
+def read_games(file_name):
+    ext = Path(file_name).suffix.lower()
+    if ext in LIB_EXTS:
+        lib = Game.read_from_lib(file_name)
+        return lib['games'] if lib else []
+    game = Game.read_from(file_name)
+    return [game] if game else []
+
+def parse_file(file_name, max_ply):
+    #在子进程中执行，返回这个文件的汇总结果
+    stats = {}
+    games = 0
+    plies = 0
+    try:
+        for game in read_games(file_name):
+            plies += add_game(stats, game, max_ply)
+            games += 1
+    except Exception as e:
+        print(f'读取棋谱出错：{file_name} {e}')
+
+    return (games, plies, list(stats.items()))
+
+def find_files(paths):
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            for it in sorted(path.rglob('*')):
+                if it.suffix.lower() in GAME_EXTS + LIB_EXTS:
+                    yield str(it)
+        elif path.suffix.lower() in GAME_EXTS + LIB_EXTS:
+            yield str(path)
+
+#---------------------------------------------------------
+class BookBuilder():
+    def __init__(self, out_file, max_ply = BOOK_MAX_PLY, min_count = BOOK_MIN_COUNT, max_entries = BOOK_MAX_ENTRIES):
+        self.out_file = Path(out_file)
+        self.max_ply = max_ply
+        self.min_count = min_count
+        self.max_entries = max_entries
+
+        self.stats = defaultdict(lambda: [0, 0, 0, 0, max_ply + 1])
+        self.files = 0
+        self.games = 0
+        self.plies = 0
+        self.flushes = 0
+
+        if self.out_file.is_file():
+            self.out_file.unlink()
+        self.db = SqliteExtDatabase(str(self.out_file), pragmas = (
+            ('cache_size', -1024 * 64),
+            ('journal_mode', 'off'),
+            ('synchronous', 'off')))
+        self.db.execute_sql('CREATE TABLE stats (key INTEGER, iccs TEXT, count INTEGER, win INTEGER, draw INTEGER, '
+                            'loss INTEGER, step INTEGER, PRIMARY KEY (key, iccs)) WITHOUT ROWID')
+
+    def add(self, result):
+        games, plies, stats = result
+        self.files += 1
+        self.games += games
+        self.plies += plies
+        for key, it in stats:
+            old = self.stats[key]
+            for i in [COUNT, WIN, DRAW, LOSS]:
+                old[i] += it[i]
+            old[STEP] = min(old[STEP], it[STEP])
+
+        if len(self.stats) >= self.max_entries:
+            self.flush()
+
+    def on_file_done(self, result, report, start_time):
+        self.add(result)
+        if report and (self.files % 1000 == 0):
+            report(self, time.time() - start_time)
+
+    def flush(self):
+        #内存中的汇总合并到临时表
+        if not self.stats:
+            return
+        rows = [(key, iccs) + tuple(it) for (key, iccs), it in self.stats.items()]
+        with self.db.atomic():
+            self.db.cursor().executemany(
+                'INSERT INTO stats VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT(key, iccs) DO UPDATE SET '
+                'count = count + excluded.count, win = win + excluded.win, draw = draw + excluded.draw, '
+                'loss = loss + excluded.loss, step = min(step, excluded.step)', rows)
+        self.stats.clear()
+        self.flushes += 1
+
+    def finish(self):
+        self.flush()
+
+        #分数为走棋方视角的胜负差(百分比)，黑方走棋的局面取反，memo中保存红方视角的原始统计
+        master_book_db.initialize(self.db)
+        with self.db.atomic():
+            self.db.create_tables([MasterEvBook])
+            self.db.execute_sql(
+                'INSERT INTO evbook (key, step, score, iccs, mark, memo) '
+                "SELECT key, step, (CASE WHEN step % 2 = 0 THEN loss - win ELSE win - loss END) * 100 / count, iccs, NULL, "
+                "json_object('count', count, 'win', win, 'draw', draw, 'loss', loss) "
+                'FROM stats WHERE count >= ? ORDER BY key, count DESC', (self.min_count, ))
+            self.db.execute_sql('CREATE INDEX evbook_key ON evbook (key)')
+            self.db.execute_sql('DROP TABLE stats')
+        self.db.execute_sql('VACUUM')
+
+        count = self.db.execute_sql('SELECT count(*) FROM evbook').fetchone()[0]
+        self.db.close()
+        return count
+
+    def build(self, files, jobs = 1, report = None):
+        start_time = time.time()
+
+        #同时在途的文件数有上限，已经解析完的结果不会在主进程中堆积
+        window = max(1, jobs) * 4
+        pending = deque()
+        with ProcessPoolExecutor(max(1, jobs)) as executor:
+            for file_name in files:
+                pending.append(executor.submit(parse_file, file_name, self.max_ply))
+                if len(pending) >= window:
+                    self.on_file_done(pending.popleft().result(), report, start_time)
+            while pending:
+                self.on_file_done(pending.popleft().result(), report, start_time)
+
+        count = self.finish()
+        if report:
+            report(self, time.time() - start_time)
+        return count
+
+def print_progress(builder, used):
+    used = max(used, 1e-6)
+    print(f'{builder.files} 个文件, {builder.games} 局, {builder.plies} 步, {builder.games / used:.0f} 局/秒')
+
+#---------------------------------------------------------
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '从棋谱文件(xqf, pgn, cbf, cbr, cbl)生成大师库')
+    parser.add_argument('paths', nargs = '+', help = '棋谱文件或目录')
+    parser.add_argument('-o', '--output', default = 'masterbook.db', help = '输出文件')
+    parser.add_argument('--jobs', type = int, default = 4, help = '解析棋谱的进程数')
+    parser.add_argument('--max-ply', type = int, default = BOOK_MAX_PLY, help = '每局最多统计前多少步')
+    parser.add_argument('--min-count', type = int, default = BOOK_MIN_COUNT, help = '出现次数少于这个值的着法不保存')
+    parser.add_argument('--max-entries', type = int, default = BOOK_MAX_ENTRIES, help = '内存中最多汇总多少条')
+    args = parser.parse_args(argv)
+
+    builder = BookBuilder(args.output, args.max_ply, args.min_count, args.max_entries)
+    start_time = time.time()
+    count = builder.build(find_files(args.paths), args.jobs, print_progress)
+    print(f'{args.output}: {count} 条记录, 用时 {time.time() - start_time:.1f} 秒')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import deque
+
+import cv2 as cv
+import numpy as np
+
+import cchess
+
+#-----------------------------------------------------------------------------------------#
+#棋盘图像识别中与界面无关的部分，全部使用numpy/opencv的整块数组运算，不逐个像素循环
+
+#像素差大于这个值算作变化
+FRAME_DIFF_THRESHOLD = 15
+#变化的像素少于这个数认为画面已经稳定(按原始分辨率计)
+FRAME_CHANGE_PIXELS = 500
+#等待画面稳定时最多读取的帧数
+FRAME_MAX_WAIT = 25
+
+#耗时统计保留最近多少次
+LATENCY_WINDOW = 1000
+
+#-----------------------------------------------------------------------------------------#
+class LatencyStats():
+    def __init__(self, window = LATENCY_WINDOW):
+        self.samples = deque(maxlen = window)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def clear(self):
+        self.samples.clear()
+        self.count = 0
+
+    def get_stats(self):
+        if not self.samples:
+            return {'count': self.count, 'mean_ms': 0.0, 'p50_ms': 0.0, 'p95_ms': 0.0, 'max_ms': 0.0, 'fps': 0.0}
+
+        ms = np.array(self.samples) * 1000.0
+        mean = float(ms.mean())
+        return {
+            'count': self.count,
+            'mean_ms': mean,
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p95_ms': float(np.percentile(ms, 95)),
+            'max_ms': float(ms.max()),
+            'fps': 1000.0 / mean if mean > 0 else 0.0,
+            }
+
+#-----------------------------------------------------------------------------------------#
+def image_hash(img, size = 8):
+    #差值感知哈希(dHash)：缩小到(size+1)*size的灰度图，比较相邻像素的明暗，得到size*size位的整数
+    if img.ndim == 3:
+        img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+    small = cv.resize(img, (size + 1, size), interpolation = cv.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+def hash_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count('1')
+
+#-----------------------------------------------------------------------------------------#
+#一个格子的图像与上一帧的平均像素差超过这个值就重新识别
+SQUARE_CHANGE_THRESHOLD = 8.0
+
+def normalize_windows(windows):
+    #windows: (..., h, w, c)，每个窗口各通道减去均值后归一化，点积就是TM_CCOEFF_NORMED的相关系数
+    windows = windows.astype(np.float32)
+    windows -= windows.mean(axis = (-3, -2), keepdims = True)
+    shape = windows.shape
+    flat = windows.reshape(shape[:-3] + (-1, ))
+    norm = np.linalg.norm(flat, axis = -1, keepdims = True)
+    return flat / np.maximum(norm, 1e-6)
+
+def as_color(img):
+    return cv.cvtColor(img, cv.COLOR_GRAY2BGR) if img.ndim == 2 else img
+
+class TemplateMatcher():
+    #把全部棋子模板叠成一个数组，所有格子的图像和所有模板一次矩阵乘法算出相关系数，
+    #结果与逐个cv.matchTemplate(TM_CCOEFF_NORMED) + cv.minMaxLoc取最大值相同
+    #小图在大图中滑动的各个位置也展开成窗口一起计算
+    def __init__(self, templates, crop_size):
+        #templates: {fench: img}，crop_size: 格子图像的(高, 宽)
+        self.keys = list(templates.keys())
+        self.crop_size = tuple(crop_size)
+
+        imgs = [as_color(x) for x in templates.values()]
+        height, width = imgs[0].shape[:2]
+        imgs = [x if x.shape[:2] == (height, width) else cv.resize(x, (width, height)) for x in imgs]
+        self.templ_size = (height, width)
+
+        crop_h, crop_w = self.crop_size
+        #格子图像比模板小时在模板上取窗口，否则在格子图像上取窗口
+        self.slide_templ = (crop_h <= height) and (crop_w <= width)
+        stack = np.stack(imgs)
+        if self.slide_templ:
+            windows = np.lib.stride_tricks.sliding_window_view(stack, (crop_h, crop_w), axis = (1, 2))
+            #(K, sy, sx, c, h, w) -> (K, S, h, w, c)
+            windows = np.moveaxis(windows, 3, -1).reshape(len(imgs), -1, crop_h, crop_w, stack.shape[-1])
+            self.templ_vectors = normalize_windows(windows)
+        else:
+            self.templ_vectors = normalize_windows(stack)
+
+        self.last_crops = None
+        self.last_results = None
+        self.rescored = 0
+
+    def prepare(self, crops):
+        #大小不对的(图像边缘被截掉的)格子图像缩放到统一大小，空图像用0填充
+        crop_h, crop_w = self.crop_size
+        ret = np.zeros((len(crops), crop_h, crop_w, 3), dtype = np.uint8)
+        for i, img in enumerate(crops):
+            if img is None or img.size == 0:
+                continue
+            img = as_color(img)
+            if img.shape[:2] != self.crop_size:
+                img = cv.resize(img, (crop_w, crop_h))
+            ret[i] = img
+        return ret
+
+    def scores(self, crops):
+        #返回(N, K)的相关系数，N是格子数，K是模板数
+        stack = self.prepare(crops)
+        if len(stack) == 0:
+            return np.zeros((0, len(self.keys)), dtype = np.float32)
+
+        if self.slide_templ:
+            vectors = normalize_windows(stack)
+            K, S, D = self.templ_vectors.shape
+            scores = vectors @ self.templ_vectors.reshape(K * S, D).T
+            return scores.reshape(len(stack), K, S).max(axis = 2)
+
+        height, width = self.templ_size
+        windows = np.lib.stride_tricks.sliding_window_view(stack, (height, width), axis = (1, 2))
+        windows = np.moveaxis(windows, 3, -1).reshape(len(stack), -1, height, width, stack.shape[-1])
+        vectors = normalize_windows(windows)
+        return (vectors @ self.templ_vectors.T).max(axis = 1)
+
+    def match(self, crops):
+        #每个格子最相似的模板和相关系数
+        scores = self.scores(crops)
+        best = scores.argmax(axis = 1) if len(scores) else []
+        return [(self.keys[k], float(scores[i, k])) for i, k in enumerate(best)]
+
+    def match_frame(self, crops, threshold = SQUARE_CHANGE_THRESHOLD):
+        #与上一帧相比没有变化的格子直接用上次的结果，只识别变化了的格子
+        stack = self.prepare(crops)
+        if (self.last_crops is None) or (len(stack) != len(self.last_crops)):
+            changed = np.arange(len(stack))
+            results = [None] * len(stack)
+        else:
+            diff = np.abs(stack.astype(np.int16) - self.last_crops.astype(np.int16)).mean(axis = (1, 2, 3))
+            changed = np.flatnonzero(diff > threshold)
+            results = list(self.last_results)
+
+        if len(changed):
+            for i, it in zip(changed, self.match([stack[i] for i in changed])):
+                results[i] = it
+
+        self.rescored = len(changed)
+        self.last_crops = stack
+        self.last_results = results
+        return results
+
+#-----------------------------------------------------------------------------------------#
+class FrameDiffer():
+    #判断连续两帧(的感兴趣区域)是否基本相同
+    #scale > 1 时先缩小再比较，变化像素数按面积折算回原始分辨率
+    #hash_distance >= 0 时只比较感知哈希，哈希距离不超过这个值就算相同
+    def __init__(self, threshold = FRAME_DIFF_THRESHOLD, max_changed = FRAME_CHANGE_PIXELS, scale = 1, hash_distance = -1):
+        self.threshold = threshold
+        self.max_changed = max_changed
+        self.scale = max(1, int(scale))
+        self.hash_distance = hash_distance
+        self.latency = LatencyStats()
+
+    def prepare(self, frame, roi_rect = None):
+        #只用第一个(蓝色)通道，与原来的cv.split(...)[0]相同
+        if roi_rect is not None:
+            (left, top), (right, bottom) = roi_rect
+            frame = frame[top:bottom, left:right]
+        img = frame[:, :, 0] if frame.ndim == 3 else frame
+        if self.scale > 1:
+            height, width = img.shape[:2]
+            img = cv.resize(img, (max(1, width // self.scale), max(1, height // self.scale)), interpolation = cv.INTER_AREA)
+        if self.hash_distance >= 0:
+            return image_hash(img)
+        return np.ascontiguousarray(img)
+
+    def changed_pixels(self, img_a, img_b):
+        change = cv.absdiff(img_a, img_b)
+        _, mask = cv.threshold(change, self.threshold, 255, cv.THRESH_BINARY)
+        return cv.countNonZero(mask) * self.scale * self.scale
+
+    def is_same(self, img_a, img_b):
+        start_time = time.perf_counter()
+        if self.hash_distance >= 0:
+            same = hash_distance(img_a, img_b) <= self.hash_distance
+        else:
+            same = self.changed_pixels(img_a, img_b) < self.max_changed
+        self.latency.add(time.perf_counter() - start_time)
+        return same
+
+    def wait_stable(self, read_frame, roi_rect = None, max_frames = FRAME_MAX_WAIT):
+        #read_frame()返回(ok, frame)，与cv.VideoCapture.read相同
+        #一直读到感兴趣区域与上一帧基本相同(或者读满max_frames帧)，返回最后一帧
+        ok, frame = read_frame()
+        if not ok:
+            return None
+
+        img_roi = self.prepare(frame, roi_rect) if roi_rect is not None else None
+        for i in range(max_frames):
+            ok, new_frame = read_frame()
+            if not ok:
+                break
+
+            if roi_rect is not None:
+                img_new_roi = self.prepare(new_frame, roi_rect)
+                if self.is_same(img_roi, img_new_roi):
+                    break
+                img_roi = img_new_roi
+            frame = new_frame
+
+        return frame
+
+#-----------------------------------------------------------------------------------------#
+#格子特征图的大小
+SQUARE_SIGNATURE_SIZE = 8
+#相关系数低于这个值认为格子上没有棋子，与OnlineManager.to_fen相同
+PIECE_MIN_SCORE = 0.7
+#两步棋加上走子标记最多改变这么多格子，更多的变化(比如开了新局)直接整个重新识别
+TRACKER_MAX_CHANGED = 8
+#连续这么多次推不出着法，认为跟踪的棋盘已经和画面对不上，整个重新识别
+TRACKER_MAX_FAILS = 5
+
+class BoardTracker():
+    #跟踪屏幕上的棋盘：每个格子保存一个缩小的灰度特征图，只重新识别特征变化了的格子，
+    #再从变化的几个格子推出着法(一步或者两步)，用走子规则检查后才更新棋盘，推不出来时整个棋盘重新识别
+    #格子下标是y * 9 + x，y = 0是图像最下面一行，与OnlineManager.match_squares相同
+    def __init__(self, matcher, min_score = PIECE_MIN_SCORE, threshold = SQUARE_CHANGE_THRESHOLD):
+        self.matcher = matcher
+        self.min_score = min_score
+        self.threshold = threshold
+
+        self.board = None
+        self.flip = False
+        self.signatures = None
+        #reset之后走的着法，以及每步走子前的局面
+        self.moves = []
+        self.fens = []
+        #连续推不出着法的次数，整个棋盘识别的次数
+        self.fails = 0
+        self.resets = 0
+        #上一次识别的格子数
+        self.rescored = 0
+        self.latency = LatencyStats()
+
+    def signature(self, crops):
+        size = SQUARE_SIGNATURE_SIZE
+        ret = np.zeros((len(crops), size, size), dtype = np.float32)
+        for i, img in enumerate(crops):
+            if img is None or img.size == 0:
+                continue
+            if img.ndim == 3:
+                img = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+            ret[i] = cv.resize(img, (size, size), interpolation = cv.INTER_AREA)
+        return ret
+
+    def to_board_pos(self, index):
+        x, y = index % 9, index // 9
+        return (8 - x, 9 - y) if self.flip else (x, y)
+
+    def recognize(self, crops, indexes):
+        #返回{格子下标: fench}，没有棋子的是None
+        results = self.matcher.match([crops[i] for i in indexes])
+        self.rescored = len(results)
+        return {i: (fench if score >= self.min_score else None) for i, (fench, score) in zip(indexes, results)}
+
+    def reset(self, crops, move_color = cchess.RED):
+        #整个棋盘重新识别，返回fen
+        start_time = time.perf_counter()
+        pieces = self.recognize(crops, range(len(crops)))
+
+        #根据将帅的位置检测棋盘翻转
+        self.flip = any((fench == 'k') and (i // 9 < 5) for i, fench in pieces.items())
+
+        self.board = cchess.ChessBoard()
+        for i, fench in pieces.items():
+            if fench:
+                self.board.put_fench(fench, self.to_board_pos(i))
+        self.board.set_move_color(move_color)
+
+        self.signatures = self.signature(crops)
+        self.moves = []
+        self.fens = []
+        self.fails = 0
+        self.resets += 1
+        self.latency.add(time.perf_counter() - start_time)
+        return self.board.to_fen()
+
+    def resync(self, crops):
+        #画面和跟踪的棋盘对不上了，整个重新识别，新开局是红方先走，否则还按原来的走棋方
+        move_color = self.board.get_move_color()
+        fen = self.reset(crops, move_color)
+        if fen.split()[0] == cchess.FULL_INIT_FEN.split()[0]:
+            self.board.set_move_color(cchess.RED)
+        return []
+
+    def update(self, crops):
+        #返回新走的着法(iccs)列表，没有变化或者还不能确定时返回空列表
+        start_time = time.perf_counter()
+        try:
+            return self.update_board(crops)
+        finally:
+            self.latency.add(time.perf_counter() - start_time)
+
+    def update_board(self, crops):
+        signatures = self.signature(crops)
+        diff = np.abs(signatures - self.signatures).mean(axis = (1, 2))
+        changed = np.flatnonzero(diff > self.threshold)
+        self.rescored = 0
+        if len(changed) == 0:
+            return []
+        if len(changed) > TRACKER_MAX_CHANGED:
+            return self.resync(crops)
+
+        pieces = self.recognize(crops, changed)
+        positions = {self.to_board_pos(i): fench for i, fench in pieces.items()}
+
+        #棋子没变(比如只是走子标记移动了)，记下新的特征
+        if all(self.board.get_fench(pos) == fench for pos, fench in positions.items()):
+            self.signatures[changed] = signatures[changed]
+            self.fails = 0
+            return []
+
+        found = self.infer_move(positions)
+        found = [found] if found else self.infer_two_moves(positions)
+        if found is None:
+            #走子动画还没结束或者识别有误，特征不更新，下一帧再试，一直推不出来就整个重新识别
+            self.fails += 1
+            if self.fails >= TRACKER_MAX_FAILS:
+                return self.resync(crops)
+            return []
+
+        moves = []
+        for color, pos_from, pos_to in found:
+            self.board.set_move_color(color)
+            self.fens.append(self.board.to_fen())
+            move = self.board.move(pos_from, pos_to)
+            self.board.next_turn()
+            moves.append(move.to_iccs())
+
+        self.signatures[changed] = signatures[changed]
+        self.fails = 0
+        self.moves.extend(moves)
+        return moves
+
+    def infer_move(self, positions):
+        #positions: {棋盘位置: 识别出的fench}，只包含变化了的格子
+        #先按轮到的一方找，再找另一方(没有看到对方走子时)，合法又与识别结果一致的着法只有一个才算找到
+        squares = list(positions.keys())
+        if not (2 <= len(squares) <= 4):
+            return None
+
+        move_color = self.board.get_move_color()
+        for color in [move_color, cchess.BLACK if move_color == cchess.RED else cchess.RED]:
+            board = self.board.copy()
+            board.set_move_color(color)
+            found = []
+            for pos_from in squares:
+                fench = board.get_fench(pos_from)
+                if (not fench) or (board.get_fench_color(pos_from) != color) or (positions[pos_from] is not None):
+                    continue
+                for pos_to in squares:
+                    if positions[pos_to] != fench or not board.is_valid_move(pos_from, pos_to):
+                        continue
+                    if board.is_checked_move(pos_from, pos_to):
+                        continue
+                    #其他变化的格子上的棋子应该没变
+                    others = [pos for pos in squares if pos not in (pos_from, pos_to)]
+                    if all(board.get_fench(pos) == positions[pos] for pos in others):
+                        found.append((color, pos_from, pos_to))
+            if len(found) == 1:
+                return found[0]
+        return None
+
+    def valid_moves(self, board, squares):
+        #从squares中的格子出发的合法着法
+        for pos_from in squares:
+            if (not board.get_fench(pos_from)) or (board.get_fench_color(pos_from) != board.get_move_color()):
+                continue
+            for _, pos_to in board.get_piece(pos_from).create_moves():
+                if board.is_valid_move(pos_from, pos_to) and not board.is_checked_move(pos_from, pos_to):
+                    yield (pos_from, pos_to)
+
+    def is_same_changes(self, changes, positions):
+        #changes: 走完后变了的格子上的棋子，要与识别结果一致，其他格子都没有变化
+        for pos, fench in changes.items():
+            if (fench != self.board.get_fench(pos)) and (pos not in positions):
+                return False
+        return all(changes.get(pos, self.board.get_fench(pos)) == fench for pos, fench in positions.items())
+
+    def infer_two_moves(self, positions):
+        #两帧之间双方各走了一步，同infer_move，找到的两步着法序列只有一个才算找到
+        #两步的起点都一定变了，第一步的终点没变只能是被对方同样的棋子吃回(兑子)
+        squares = list(positions.keys())
+        move_color = self.board.get_move_color()
+        for color in [move_color, cchess.BLACK if move_color == cchess.RED else cchess.RED]:
+            board = self.board.copy()
+            board.set_move_color(color)
+            found = []
+            for pos_from, pos_to in self.valid_moves(board, squares):
+                if (pos_to not in positions) and not board.get_fench(pos_to):
+                    continue
+                board_next = board.copy()
+                board_next.move(pos_from, pos_to)
+                board_next.next_turn()
+                for pos_from2, pos_to2 in self.valid_moves(board_next, squares):
+                    if (pos_to2 not in positions) and (pos_to2 != pos_to):
+                        continue
+                    changes = {pos_from: None, pos_to: board.get_fench(pos_from)}
+                    changes[pos_from2] = None
+                    changes[pos_to2] = board_next.get_fench(pos_from2)
+                    if self.is_same_changes(changes, positions):
+                        found.append([(color, pos_from, pos_to), (board_next.get_move_color(), pos_from2, pos_to2)])
+            if len(found) == 1:
+                return found[0]
+        return None
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from .Cache import getFenKey
+from .LocalDB import closeThreadConnections
+
+#-----------------------------------------------------#
+#同时查询的库的个数上限
+BOOK_STACK_THREADS = 4
+
+#关闭时在每个工作线程中执行任务，等其他线程的最长时间(秒)
+BOOK_STACK_SYNC_TIMEOUT = 5
+
+#按局面缓存合并后的查询结果
+BOOK_STACK_CACHE_SIZE = 4096
+
+#多个库都有分数时的取法
+BOOK_SCORE_FIRST = 'first'  #取优先级最高的库的分数
+BOOK_SCORE_MAX = 'max'      #取较大的分数
+
+#-----------------------------------------------------#
+class BookStack(QObject):
+    #把多个库(开局库、大师库、本地库、残局库等，只要有getMoves(fen)接口)合并成一个查询
+    #各个库在工作线程中同时查询，合并后的结果按局面缓存，再次走到同一局面时不用再查
+    resultSignal = pyqtSignal(dict)
+
+    def __init__(self, parent = None, scorePolicy = BOOK_SCORE_FIRST, cacheSize = BOOK_STACK_CACHE_SIZE):
+        super().__init__(parent)
+
+        self.scorePolicy = scorePolicy
+        self.cacheSize = cacheSize
+
+        self.books = []
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        #每次修改库或者清空缓存时加一，旧的查询结果不再放入缓存
+        self.version = 0
+        self.isClosed = False
+        #每次换库时加一，工作线程查询前发现变了就先关闭本线程中的旧连接
+        self.connVersion = 0
+        self.threadState = threading.local()
+
+        self.executor = ThreadPoolExecutor(BOOK_STACK_THREADS)
+
+    def setBook(self, name, book, priority = 0, mark = None, useScore = True):
+        #同名的库会被替换，priority大的库排在前面
+        with self.lock:
+            self.books = [x for x in self.books if x['name'] != name]
+            if book is not None:
+                self.books.append({'name': name, 'book': book, 'priority': priority, 'mark': mark, 'useScore': useScore})
+                self.books.sort(key = lambda x: -x['priority'])
+            self.clearCacheLocked()
+
+    def removeBook(self, name):
+        self.setBook(name, None)
+
+    def clearCache(self):
+        with self.lock:
+            self.clearCacheLocked()
+
+    def clearCacheLocked(self):
+        self.cache.clear()
+        self.version += 1
+
+    def runInThreads(self, func):
+        #在每个工作线程中各执行一次func：每个任务都要等所有任务开始执行后才继续，所以不会有两个任务在同一个线程中
+        barrier = threading.Barrier(BOOK_STACK_THREADS)
+
+        def work():
+            try:
+                barrier.wait(BOOK_STACK_SYNC_TIMEOUT)
+            except threading.BrokenBarrierError:
+                pass
+            func()
+
+        wait([self.executor.submit(work) for i in range(BOOK_STACK_THREADS)])
+
+    def closeConnections(self):
+        #各个工作线程查询时打开的数据库连接，不等工作线程，在各线程下次查询前关闭
+        with self.lock:
+            self.connVersion += 1
+
+    def closeStaleConnections(self):
+        if getattr(self.threadState, 'connVersion', 0) != self.connVersion:
+            closeThreadConnections()
+            self.threadState.connVersion = self.connVersion
+
+    def close(self):
+        #还没开始的查询直接返回，然后关闭工作线程中的连接
+        self.isClosed = True
+        self.runInThreads(closeThreadConnections)
+        self.executor.shutdown(wait = True, cancel_futures = True)
+
+    #-----------------------------------------------------#
+    def getCached(self, fen_key):
+        with self.lock:
+            if fen_key not in self.cache:
+                return None
+            self.cache.move_to_end(fen_key)
+            return self.copyResult(self.cache[fen_key])
+
+    def putCache(self, fen_key, ret, version):
+        with self.lock:
+            if version != self.version:
+                return
+            self.cache[fen_key] = ret
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last = False)
+
+    def copyResult(self, ret):
+        #调用者会修改着法(合并云库分数等)，每次给出一份副本
+        return {'fen': ret['fen'], 'actions': OrderedDict((iccs, dict(act)) for iccs, act in ret['actions'].items())}
+
+    #-----------------------------------------------------#
+    def query(self, fen):
+        #同步查询，在调用者线程中依次查询各个库
+        fen_key = getFenKey(fen)
+        ret = self.getCached(fen_key)
+        if ret is not None:
+            return ret
+
+        with self.lock:
+            books = list(self.books)
+            version = self.version
+
+        results = [self.queryBook(entry, fen) for entry in books]
+        ret = self.merge(fen, books, results)
+        self.putCache(fen_key, ret, version)
+        return self.copyResult(ret)
+
+    def startQuery(self, position):
+        #异步查询，结果通过resultSignal送出，缓存命中时立刻送出
+        fen = position['fen']
+        fen_key = getFenKey(fen)
+
+        ret = self.getCached(fen_key)
+        if ret is not None:
+            self.resultSignal.emit(ret)
+            return
+
+        with self.lock:
+            books = list(self.books)
+            version = self.version
+
+        if not books:
+            self.resultSignal.emit({'fen': fen, 'actions': OrderedDict()})
+            return
+
+        job = {'fen': fen, 'key': fen_key, 'books': books, 'version': version, 'results': [None] * len(books), 'left': len(books)}
+        for i, entry in enumerate(books):
+            future = self.executor.submit(self.queryBook, entry, fen)
+            future.add_done_callback(lambda f, i = i: self.onBookDone(job, i, f))
+
+    def onBookDone(self, job, index, future):
+        #在工作线程中调用，最后一个库查完时合并结果
+        if future.cancelled():
+            return
+
+        with self.lock:
+            job['results'][index] = future.result()
+            job['left'] -= 1
+            if job['left'] > 0:
+                return
+
+        ret = self.merge(job['fen'], job['books'], job['results'])
+        self.putCache(job['key'], ret, job['version'])
+        self.resultSignal.emit(self.copyResult(ret))
+
+    def queryBook(self, entry, fen):
+        if self.isClosed:
+            return None
+
+        self.closeStaleConnections()
+        try:
+            query = entry['book'].getMoves(fen)
+        except Exception as e:
+            logging.error(f"查询{entry['name']}出错：{e}")
+            return None
+
+        if not query:
+            return None
+
+        #在工作线程中就把着法文字等全部算出来
+        return [dict(act) for act in query['actions'].values()]
+
+    def merge(self, fen, books, results):
+        #优先级高的库的着法排在前面，同一着法的其他信息合并到一起
+        actions = OrderedDict()
+        for entry, acts in zip(books, results):
+            if not acts:
+                continue
+            for act in acts:
+                iccs = act['iccs']
+                if not entry['useScore']:
+                    act.pop('score', None)
+                    act.pop('diff', None)
+                if entry['mark']:
+                    act['mark'] = entry['mark']
+
+                if iccs not in actions:
+                    actions[iccs] = act
+                    continue
+
+                old_act = actions[iccs]
+                for key, value in act.items():
+                    if key == 'score':
+                        old_act['score'] = self.mergeScore(old_act.get('score'), value)
+                    elif key == 'mark':
+                        old_act['mark'] = value
+                    else:
+                        old_act.setdefault(key, value)
+
+        return {'fen': fen, 'actions': actions}
+
+    def mergeScore(self, old_score, new_score):
+        if old_score is None:
+            return new_score
+        if (new_score is None) or (self.scorePolicy == BOOK_SCORE_FIRST):
+            return old_score
+        return max(old_score, new_score)
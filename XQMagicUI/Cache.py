@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+
+import sys
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+
+from cchess import ChessBoard
+from cchess.zhash_data import z_c90, z_pieces, z_redKey, z_hashTable
+
+#-----------------------------------------------------#
+#缓存上限的默认值，可以在配置文件的[Cache]节中修改
+CACHE_MAX_ENTRIES = 200000
+CACHE_MAX_MB = 256
+
+#-----------------------------------------------------#
+#局面键值：与ChessBoard.zhash()相同的64位Zobrist值，缓存内部用它代替fen字符串
+@lru_cache(maxsize = 65536)
+def getFenKey(fen):
+    return ChessBoard(fen).zhash()
+
+def toSignedKey(key):
+    return (key & ((1 << 63) - 1)) - (key & (1 << 63))
+
+def getPieceKey(fench, pos):
+    x, y = pos
+    return z_hashTable[z_pieces[fench] * 256 + z_c90[x + (9 - y) * 9]]
+
+def getChildKey(board, key, move_from, move_to):
+    #按走子增量计算走后局面的键值，不用复制棋盘，也不用生成fen
+    #board是走子前的棋盘，key是它的键值
+    fench = board.get_fench(move_from)
+    captured = board.get_fench(move_to)
+    
+    key ^= getPieceKey(fench, move_from) ^ getPieceKey(fench, move_to) ^ z_redKey
+    if captured:
+        key ^= getPieceKey(captured, move_to)
+    
+    return toSignedKey(key)
+
+def getMoveKey(move, key = None):
+    #cchess的Move对象走后局面的键值
+    if key is None:
+        key = move.board.zhash()
+    return getChildKey(move.board, key, move.p_from, move.p_to)
+
+def getCacheKey(key):
+    return key if isinstance(key, int) else getFenKey(key)
+
+#-----------------------------------------------------#
+def sizeOfEntry(key, value):
+    #估算一条缓存占用的内存，只计算到第二层(fenInfo中的列表和字典)
+    size = sys.getsizeof(key) + sys.getsizeof(value)
+    if isinstance(value, dict):
+        for k, v in value.items():
+            size += sys.getsizeof(k) + sys.getsizeof(v)
+            if isinstance(v, (list, tuple, dict)):
+                for it in v:
+                    size += sys.getsizeof(it)
+    return size
+
+#-----------------------------------------------------#
+class FenCache():
+    #按最近使用淘汰的fen缓存，用法和dict相同
+    #可以用fen或者局面键值访问，内部只保存键值
+    #当前棋谱(positionList)上的局面被钉住，不会被淘汰
+    def __init__(self, maxEntries = CACHE_MAX_ENTRIES, maxBytes = CACHE_MAX_MB * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+
+        self.lock = threading.RLock()
+        self.data = OrderedDict()
+        self.sizes = {}
+        #取出后可能被调用者直接修改的条目，下次检查容量时重新估算大小
+        self.dirty = set()
+        self.pinned = set()
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def setLimits(self, maxEntries, maxBytes):
+        with self.lock:
+            self.maxEntries = maxEntries
+            self.maxBytes = maxBytes
+            self.evict()
+
+    def pin(self, keys):
+        with self.lock:
+            self.pinned = set(getCacheKey(x) for x in keys)
+
+    def __contains__(self, key):
+        key = getCacheKey(key)
+        with self.lock:
+            if key in self.data:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def __getitem__(self, key):
+        key = getCacheKey(key)
+        with self.lock:
+            value = self.data[key]
+            self.data.move_to_end(key)
+            self.dirty.add(key)
+            return value
+
+    def __setitem__(self, key, value):
+        key = getCacheKey(key)
+        with self.lock:
+            if key in self.data:
+                self.bytes -= self.sizes[key]
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.sizes[key] = sizeOfEntry(key, value)
+            self.bytes += self.sizes[key]
+            self.dirty.discard(key)
+            #刚放进去的条目调用者马上还要用，不能淘汰
+            self.evict(keep = key)
+
+    def __delitem__(self, key):
+        key = getCacheKey(key)
+        with self.lock:
+            del self.data[key]
+            self.bytes -= self.sizes.pop(key)
+            self.dirty.discard(key)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return iter(list(self.data.keys()))
+
+    def get(self, key, default = None):
+        with self.lock:
+            if key not in self:
+                return default
+            return self[key]
+
+    def pop(self, key, *default):
+        key = getCacheKey(key)
+        with self.lock:
+            if key not in self.data:
+                if default:
+                    return default[0]
+                raise KeyError(key)
+            value = self.data[key]
+            del self[key]
+            return value
+
+    def keys(self):
+        return list(self.data.keys())
+
+    def items(self):
+        return list(self.data.items())
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+            self.sizes.clear()
+            self.dirty.clear()
+            self.bytes = 0
+
+    def evict(self, keep = None):
+
+        self.remeasure()
+
+        #从最久没用过的开始淘汰，钉住的跳过
+        while (len(self.data) > self.maxEntries) or (self.bytes > self.maxBytes):
+            for key in self.data:
+                if (key not in self.pinned) and (key != keep):
+                    break
+            else:
+                #全部被钉住了，只能超出上限
+                return
+            del self[key]
+            self.evictions += 1
+
+    def remeasure(self):
+        for key in self.dirty:
+            if key not in self.data:
+                continue
+            size = sizeOfEntry(key, self.data[key])
+            self.bytes += size - self.sizes[key]
+            self.sizes[key] = size
+        self.dirty.clear()
+
+    def getStats(self):
+        with self.lock:
+            self.remeasure()
+            return {
+                'entries': len(self.data),
+                'bytes': self.bytes,
+                'pinned': len(self.pinned),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import json
-import time
 import logging
 import threading
 from pathlib import Path
@@ -9,10 +8,11 @@ from collections import OrderedDict
 import cchess
 from cchess import ChessBoard
 
-from PyQt5.QtCore import QObject, pyqtSignal, QUrl, QUrlQuery
-from PyQt5.QtNetwork import QNetworkRequest, QNetworkAccessManager
+from PyQt5.QtCore import QObject, pyqtSignal, QUrl, QUrlQuery, QTimer
+from PyQt5.QtNetwork import QNetworkRequest, QNetworkReply, QNetworkAccessManager
 
 from . import Globl
+from .Cache import getFenKey, getMoveKey
 
 #------------------------------------------------------------------------------
 def updateCache(qResult):
@@ -27,61 +27,100 @@ def updateCache(qResult):
         if act['diff'] == 0:
             best_moves.append(act['iccs'])
         m = {'score': act['score'], 'diff': act['diff']}
-        new_fen = act['new_fen']
-        if new_fen not in Globl.fenCache:
-            Globl.fenCache[new_fen] = m
+        new_key = act['new_key']
+        if new_key not in Globl.fenCache:
+            Globl.fenCache[new_key] = m
         else:
-            Globl.fenCache[new_fen].update(m)    
+            Globl.fenCache[new_key].update(m)    
     
     if len(best_moves) > 0: 
         Globl.fenCache[fen].update({ 'best_moves': best_moves })
         #print(Globl.fenCache[fen])        
         
 
+#------------------------------------------------------------------------------
+#单次查询的超时时间(毫秒)
+CLOUD_QUERY_TIMEOUT = 10000
+
+#出错后重试的等待时间(毫秒)，每重试一次加倍
+CLOUD_RETRY_DELAY = 500
+#出错后最多重试的次数，不算第一次查询
+CLOUD_MAX_RETRY = 2
+
+#同时在途的查询个数上限
+CLOUD_MAX_INFLIGHT = 4
+
+#预取占用的在途查询个数上限，至少给当前局面的查询留一个空位
+CLOUD_PREFETCH_INFLIGHT = 2
+
+#预取当前局面最好的几个着法，以及棋谱中后面几步的局面
+CLOUD_PREFETCH_CHILDREN = 3
+CLOUD_PREFETCH_PLIES = 4
+
 #------------------------------------------------------------------------------
 class NetQuery(QObject):
     query_ret_signal = pyqtSignal(str, str)
     query_err_signal = pyqtSignal(str)
     
-    def __init__(self, parent, fen, url):
+    def __init__(self, parent, fen, url, items, maxRetry = CLOUD_MAX_RETRY):
         super().__init__(parent)
         
         self.fen = fen
-        
-        self.url = url
         self.net_mgr = parent.net_mgr
-        self.req = None
+        self.maxRetry = maxRetry
 
         self.reply = None
         self.tryCount = 0
+        self.isCanceled = False
         
-    def startQuery(self):
-
-        url = QUrl(self.url)
+        url = QUrl(url)
         query = QUrlQuery()
-        query.addQueryItem('board', self.fen)
-        query.addQueryItem("action", 'queryall')
+        for name, value in items:
+            query.addQueryItem(name, value)
         url.setQuery(query)
         
+        #同一个QNetworkAccessManager的请求会复用已有的连接
         self.req = QNetworkRequest(url)
+        self.req.setRawHeader(b'Connection', b'keep-alive')
+        self.req.setTransferTimeout(CLOUD_QUERY_TIMEOUT)
+
+        #出错后用定时器等待重试，不阻塞界面线程
+        self.retryTimer = QTimer(self)
+        self.retryTimer.setSingleShot(True)
+        self.retryTimer.timeout.connect(self.startQuery)
+
+    def startQuery(self):
+        if self.isCanceled:
+            return
+        self.tryCount += 1
         self.reply = self.net_mgr.get(self.req)
         self.reply.finished.connect(self.onQueryFinished)
-        self.reply.errorOccurred.connect(self.onQueryError)
         
-    def onQueryFinished(self):
-        resp = self.reply.readAll().data().decode().rstrip('\0')
-        self.query_ret_signal.emit(self.fen, resp)
+    def abort(self):
+        self.isCanceled = True
+        self.retryTimer.stop()
+        if self.reply:
+            self.reply.abort()
 
-    def onQueryError(self, error):
+    def onQueryFinished(self):
+        reply = self.reply
         self.reply = None
+        if reply is None:
+            return
+        reply.deleteLater()
         
-        self.tryCount += 1
-        if self.tryCount < 3:
-            logging.warning(f'Query From CloudDB Error, retry { self.tryCount}')
-            time.sleep(2)
-            self.reply = self.net_mgr.get(self.req)
-            self.reply.finished.connect(self.onQueryFinished)
-            self.reply.errorOccurred.connect(self.onQueryError)
+        if self.isCanceled:
+            return
+
+        if reply.error() == QNetworkReply.NoError:
+            resp = reply.readAll().data().decode().rstrip('\0')
+            self.query_ret_signal.emit(self.fen, resp)
+            return
+
+        if self.tryCount <= self.maxRetry:
+            delay = CLOUD_RETRY_DELAY * (2 ** (self.tryCount - 1))
+            logging.warning(f'Query Error: {reply.errorString()}, retry {self.tryCount} after {delay}ms')
+            self.retryTimer.start(delay)
         else:
             self.query_err_signal.emit(self.fen)
     
@@ -93,37 +132,115 @@ class CloudDB(QObject):
         self.url = 'http://www.chessdb.cn/chessdb.php'
         
         self.move_cache = {}
+        
+        #query_worker是在途的查询，pending是等待空位的查询
         self.query_worker = {}
+        self.pending = OrderedDict()
+        self.maxInFlight = CLOUD_MAX_INFLIGHT
+        
+        #prefetching是等待空位的预取查询，prefetch_keys是在途查询中属于预取的部分
+        self.prefetching = OrderedDict()
+        self.prefetch_keys = set()
 
-        self.net_mgr = QNetworkAccessManager()
+        self.net_mgr = QNetworkAccessManager(self)
         
     def startQuery(self, position, score_limit = 100):
 
         fen = position['fen']
+        fen_key = getFenKey(fen)
         
         logging.info(f"Cloud Query: {fen}")
 
-        if fen in self.move_cache:
-            ret = self.move_cache[fen]
+        if fen_key in self.move_cache:
+            ret = self.move_cache[fen_key]
             self.query_result_signal.emit(ret)
             return 
 
+        #以前查询过的局面直接从分析库中取
+        if Globl.analysisStore:
+            ret = Globl.analysisStore.getAnalysis(fen, 'cloud')
+            if ret:
+                self.move_cache[fen_key] = ret
+                updateCache(ret)
+                self.query_result_signal.emit(ret)
+                return
+
+        #正在预取的局面转为正常查询，结果出来后发给界面
+        self.prefetch_keys.discard(fen_key)
+        if fen_key in self.prefetching:
+            self.pending[fen_key] = self.prefetching.pop(fen_key)
+            self.schedule()
+            return
+
         #还在工作尚未完成             
-        if fen in self.query_worker:
+        if (fen_key in self.query_worker) or (fen_key in self.pending):
             return
 
-        q = NetQuery(self, fen, self.url)
-        self.query_worker[fen] = q
+        self.pending[fen_key] = self.createQuery(fen)
+        self.schedule()
+
+    def prefetch(self, fens):
+        #低优先级查询，结果只放进缓存，不发给界面
+        for fen in fens:
+            fen_key = getFenKey(fen)
+            if (fen_key in self.move_cache) or (fen_key in self.query_worker) \
+                    or (fen_key in self.pending) or (fen_key in self.prefetching):
+                continue
+            if Globl.analysisStore and Globl.analysisStore.getAnalysis(fen, 'cloud'):
+                continue
+            self.prefetching[fen_key] = self.createQuery(fen)
+        self.schedule()
+
+    def createQuery(self, fen):
+        q = NetQuery(self, fen, self.url, [('board', fen), ('action', 'queryall')])
         q.query_ret_signal.connect(self.onQueryFinished)
         q.query_err_signal.connect(self.onQueryError) 
-        q.startQuery()
+        return q
+
+    def schedule(self):
+        while self.pending and (len(self.query_worker) < self.maxInFlight):
+            fen_key, q = self.pending.popitem(last = False)
+            self.query_worker[fen_key] = q
+            q.startQuery()
+        
+        while self.prefetching and (len(self.query_worker) < self.maxInFlight) \
+                and (len(self.prefetch_keys) < CLOUD_PREFETCH_INFLIGHT):
+            fen_key, q = self.prefetching.popitem(last = False)
+            self.query_worker[fen_key] = q
+            self.prefetch_keys.add(fen_key)
+            q.startQuery()
+
+    def cancelQueries(self, keep = ()):
+        #用户已经走到别的局面，还没有返回的查询(包括预取)除了keep中的局面都取消掉
+        keep_keys = set(getFenKey(x) for x in keep)
+        for workers in [self.pending, self.prefetching, self.query_worker]:
+            for fen_key in list(workers.keys()):
+                if fen_key in keep_keys:
+                    continue
+                q = workers.pop(fen_key)
+                q.abort()
+                q.deleteLater()
+                self.prefetch_keys.discard(fen_key)
+        self.schedule()
+
+    def finishQuery(self, fen_key):
+        q = self.query_worker.pop(fen_key, None)
+        if q:
+            q.deleteLater()
+        
+        isPrefetch = (fen_key in self.prefetch_keys)
+        self.prefetch_keys.discard(fen_key)
+        self.schedule()
+        
+        return isPrefetch
 
     def onQueryFinished(self, fen, resp):
         
         self.score_limit = 90
         ret = {}
         
-        self.query_worker.pop(fen)
+        fen_key = getFenKey(fen)
+        isPrefetch = self.finishQuery(fen_key)
 
         #resp: 若局面代码错误，返回 invalid board ，
         #若所查询的局面没有已知着法，返回 unknown ，若走棋方被将死或困毙，返回 checkmate / stalemate
@@ -140,9 +257,11 @@ class CloudDB(QObject):
             ret['mate'] = 0
             ret['actions'] = {}
         
-            self.move_cache[fen] = ret
+            self.move_cache[fen_key] = ret
+            self.saveAnalysis(ret)
             self.reply = None
-            self.query_result_signal.emit(ret)
+            if not isPrefetch:
+                self.query_result_signal.emit(ret)
             
             return
 
@@ -180,7 +299,7 @@ class CloudDB(QObject):
             act['diff'] =  act['score'] - score_best
             if move_color == cchess.BLACK:
                 act['score'] = -act['score']
-            act['new_fen'] = move_it.board_done.to_fen()
+            act['new_key'] = getMoveKey(move_it, fen_key)
 
             
         #moves = filter(lambda x : is_odd, moves)        
@@ -207,15 +326,25 @@ class CloudDB(QObject):
         ret['score'] = score_best
         ret['actions'] = moves_clean
             
-        self.move_cache[fen]  = ret
+        self.move_cache[fen_key]  = ret
         
         updateCache(ret)
+        self.saveAnalysis(ret)
 
         self.reply = None
-        self.query_result_signal.emit(ret)
+        if not isPrefetch:
+            self.query_result_signal.emit(ret)
         
     def onQueryError(self, fen):
-        self.query_worker.pop(fen)
+        self.finishQuery(getFenKey(fen))
+
+    def saveAnalysis(self, ret):
+        if not Globl.analysisStore:
+            return
+        try:
+            Globl.analysisStore.saveAnalysis(ret, 'cloud')
+        except Exception as e:
+            logging.error(f'保存云库分析结果错误：{e}')
 
 #------------------------------------------------------------------------------
 class MyScoreDB(QObject):
@@ -226,57 +355,54 @@ class MyScoreDB(QObject):
 
         self.url = 'http://212.64.28.112:8887/query'
         #self.url = 'http://127.0.0.1:8887/query'
-        self.net_mgr = QNetworkAccessManager()
+        self.net_mgr = QNetworkAccessManager(self)
         
-        self.reply = None
-        self.fen = None
-        self.board = ChessBoard()
-        self.tryCount = 0
+        self.query = None
+        self.index = 0
         self.score_limit = 0
         self.move_cache = {}
         
     def startQuery(self, position):
 
         fen = position['fen']
+        fen_key = getFenKey(fen)
         
         logging.info(f"Score Query: {fen}")
 
-        if fen in self.move_cache:
-            ret = self.move_cache[fen]
+        if fen_key in self.move_cache:
+            ret = self.move_cache[fen_key]
             self.query_result_signal.emit(ret)
             return 
-             
-        if (self.reply is not None) and (not self.reply.isFinished()):
-            self.reply.abort()
-        
-        self.index = position['index']
-        self.fen = fen
-        self.board.from_fen(fen)
-        
-        url = QUrl(self.url)
-        query = QUrlQuery()
-        query.addQueryItem('fen', fen)
-        #query.addQueryItem("action", 'queryall')
-        url.setQuery(query)
         
-        self.tryCount = 1
-        self.req = QNetworkRequest(url)
-        self.reply = self.net_mgr.get(self.req)
-        self.reply.finished.connect(self.onQueryFinished)
-        self.reply.errorOccurred.connect(self.onQueryError)
+        #同一时间只查询一个局面，上一个还没返回的直接取消
+        self.cancelQueries()
         
-    def onQueryFinished(self):
+        self.index = position['index']
+        self.query = NetQuery(self, fen, self.url, [('fen', fen)], maxRetry = 3)
+        self.query.query_ret_signal.connect(self.onQueryFinished)
+        self.query.query_err_signal.connect(self.onQueryError)
+        self.query.startQuery()
+        
+    def cancelQueries(self, keep = ()):
+        if self.query and (self.query.fen not in keep):
+            self.query.abort()
+            self.query.deleteLater()
+            self.query = None
+
+    def onQueryFinished(self, fen, resp):
         
-        if not self.reply:
-            return
+        if self.query:
+            self.query.deleteLater()
+        self.query = None
         
         ret = {}
 
-        resp = self.reply.readAll().data().decode()
         if len(resp) == 0:
             return
         
-        move_color = self.board.get_move_color()    
+        board = ChessBoard(fen)
+        fen_key = getFenKey(fen)
+        move_color = board.get_move_color()    
         moves = json.loads(resp)
         
         if not moves: 
@@ -285,14 +411,14 @@ class MyScoreDB(QObject):
         score_best = int(moves[0]['score'])
         for act in moves:
             act['iccs'] = act.pop('move')
-            move_it = self.board.copy().move_iccs(act['iccs'])
+            move_it = board.copy().move_iccs(act['iccs'])
             if move_it:
                 act['text'] = move_it.to_text()
             act['score'] = int(act['score']) 
             act['diff'] =  act['score'] - score_best
             if move_color == cchess.BLACK:
                 act['score'] = -act['score']
-            act['new_fen'] = move_it.board_done.to_fen()
+            act['new_key'] = getMoveKey(move_it, fen_key)
     
         #moves = filter(lambda x : is_odd, moves)        
 
@@ -314,24 +440,16 @@ class MyScoreDB(QObject):
             moves_clean[it['iccs']] = it
             
         ret['index'] = self.index
-        ret['fen'] = self.fen
+        ret['fen'] = fen
         ret['score'] = score_best
         ret['actions'] = moves_clean
         
-        self.reply = None
         self.query_result_signal.emit(ret)
         
         
-    def onQueryError(self, error):
-        self.reply = None
-        
-        self.tryCount += 1
-        if self.tryCount < 5:
-            logging.warning(f'Query from ScoreDB Error, retry { self.tryCount}')
-            time.sleep(2)
-            self.reply = self.net_mgr.get(self.req)
-            self.reply.finished.connect(self.onQueryFinished)
-            self.reply.errorOccurred.connect(self.onQueryError)
-        else:
-            self.query_result_signal.emit({})
+    def onQueryError(self, fen):
+        if self.query:
+            self.query.deleteLater()
+        self.query = None
+        self.query_result_signal.emit({})
         
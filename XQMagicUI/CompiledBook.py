@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import struct
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+
+import numpy as np
+
+from cchess import ChessBoard
+
+from .LocalDB import OpenBookDB, OpenBookYfk, OpenBookPF, MoveRecord, openBookDatabase
+
+#-----------------------------------------------------#
+#编译后的开局库：按(局面键值, 分数从高到低)排好序的定长记录数组，
+#用内存映射打开，查询只是两次二分查找，不经过sqlite
+#
+#文件格式：32字节文件头 + count条记录
+#文件头：magic, version, count, 源文件指纹(源文件改动后编译库失效)
+
+COMPILED_BOOK_SUFFIX = '.xqb'
+COMPILED_BOOK_MAGIC = b'XQBK'
+COMPILED_BOOK_VERSION = 1
+
+BOOK_HEADER = struct.Struct('<4sIQq8x')
+BOOK_RECORD = np.dtype([('key', '<i8'), ('move', '<u2'), ('score', '<i4')])
+
+#着法编码：起点格子序号 << 8 | 终点格子序号，格子序号是OpenBookDB.s90中的位置
+SQUARES = OpenBookDB.s90
+SQUARES_MIRROR = [SQUARES[(i // 9) * 9 + 8 - (i % 9)] for i in range(90)]
+
+#开局库vmove中的字节 -> 格子序号，255表示无效
+SQUARE_OF_BYTE = np.full(256, 255, dtype = np.uint8)
+SQUARE_OF_BYTE[OpenBookDB.c90] = np.arange(90, dtype = np.uint8)
+
+SQUARE_OF_COORD = {x: i for i, x in enumerate(SQUARES)}
+
+#-----------------------------------------------------#
+def getCompiledFile(fileName):
+    return Path(str(fileName) + COMPILED_BOOK_SUFFIX)
+
+def getSourceFingerprint(sources):
+    h = hashlib.blake2b(digest_size = 8)
+    for fileName in sources:
+        st = Path(fileName).stat()
+        h.update(f'{Path(fileName).name}|{st.st_size}|{st.st_mtime_ns}\n'.encode('utf-8'))
+    return int.from_bytes(h.digest(), 'little', signed = True)
+
+def readBookRecords(fileName):
+    #读出一个源库的全部记录，返回(keys, moves, scores)三个数组
+    ext = Path(fileName).suffix.lower()
+    db = openBookDatabase(fileName, readOnly = True)
+    try:
+        if ext == '.yfk':
+            rows = db.execute_sql('SELECT vkey, vmove, vscore FROM bhobk WHERE vvalid = 1').fetchall()
+            shift = OpenBookYfk.fromShift
+        elif ext in ['.pfbook', '.obk']:
+            rows = db.execute_sql('SELECT vkey, vmove, vscore FROM pfBook WHERE vvalid = 1').fetchall()
+            shift = OpenBookPF.fromShift
+        else:
+            #本地库，键值和着法都已经做过镜像归一
+            rows = db.execute_sql('SELECT key, iccs, score FROM book').fetchall()
+            rows = [(key, SQUARE_OF_COORD[iccs[:2]] << 8 | SQUARE_OF_COORD[iccs[2:]], score or 0) for key, iccs, score in rows]
+            shift = None
+    finally:
+        db.close()
+
+    if not rows:
+        return (np.zeros(0, np.int64), np.zeros(0, np.uint16), np.zeros(0, np.int32))
+
+    data = np.array(rows, dtype = np.int64)
+    keys, vmoves, scores = data[:, 0], data[:, 1], data[:, 2]
+
+    if shift is None:
+        return (keys, vmoves.astype(np.uint16), scores.astype(np.int32))
+
+    move_from = SQUARE_OF_BYTE[(vmoves >> shift) & 0xff]
+    move_to = SQUARE_OF_BYTE[(vmoves >> (8 - shift)) & 0xff]
+    valid = (move_from != 255) & (move_to != 255)
+    moves = (move_from.astype(np.uint16) << 8) | move_to
+
+    return (keys[valid], moves[valid], scores[valid].astype(np.int32))
+
+def compileBook(sources, outFile):
+    start_time = time.time()
+
+    parts = [readBookRecords(x) for x in sources]
+    records = np.zeros(sum(len(x[0]) for x in parts), dtype = BOOK_RECORD)
+    records['key'] = np.concatenate([x[0] for x in parts])
+    records['move'] = np.concatenate([x[1] for x in parts])
+    records['score'] = np.concatenate([x[2] for x in parts])
+
+    #多个源库中相同局面的相同着法只保留分数最高的一条
+    order = np.lexsort((-records['score'], records['move'], records['key']))
+    records = records[order]
+    if len(records) > 0:
+        first = np.ones(len(records), dtype = bool)
+        first[1:] = (records['key'][1:] != records['key'][:-1]) | (records['move'][1:] != records['move'][:-1])
+        records = records[first]
+
+    #同一局面内按分数从高到低排列
+    records = records[np.lexsort((-records['score'], records['key']))]
+
+    header = BOOK_HEADER.pack(COMPILED_BOOK_MAGIC, COMPILED_BOOK_VERSION, len(records), getSourceFingerprint(sources))
+    tmp_file = Path(str(outFile) + '.tmp')
+    with open(tmp_file, 'wb') as f:
+        f.write(header)
+        f.write(records.tobytes())
+    os.replace(tmp_file, outFile)
+
+    logging.info(f'编译开局库 {outFile}：{len(records)} 条记录，用时 {time.time() - start_time:.1f} 秒')
+    return len(records)
+
+#-----------------------------------------------------#
+class CompiledBook():
+    #接口与OpenBookYfk/OpenBookPF相同
+    def __init__(self):
+        self.isBookOpened = False
+        self.name = ''
+        self.records = None
+        self.keys = None
+
+    def open(self, fileName, sources = None):
+        #给出sources时，源库改动过就不打开
+        if not Path(fileName).is_file():
+            return False
+
+        with open(fileName, 'rb') as f:
+            header = f.read(BOOK_HEADER.size)
+        if len(header) < BOOK_HEADER.size:
+            return False
+
+        magic, version, count, fingerprint = BOOK_HEADER.unpack(header)
+        if (magic != COMPILED_BOOK_MAGIC) or (version != COMPILED_BOOK_VERSION):
+            return False
+
+        if sources:
+            try:
+                if fingerprint != getSourceFingerprint(sources):
+                    return False
+            except OSError:
+                return False
+
+        if count > 0:
+            self.records = np.memmap(fileName, dtype = BOOK_RECORD, mode = 'r', offset = BOOK_HEADER.size, shape = (count, ))
+        else:
+            self.records = np.zeros(0, dtype = BOOK_RECORD)
+        self.keys = self.records['key']
+
+        self.isBookOpened = True
+        return True
+
+    def close(self):
+        self.records = None
+        self.keys = None
+        self.isBookOpened = False
+
+    def lookup(self, key):
+        lo = np.searchsorted(self.keys, key, 'left')
+        hi = np.searchsorted(self.keys, key, 'right')
+        return self.records[lo:hi]
+
+    def getMoves(self, fen):
+
+        if not self.isBookOpened:
+            return None
+
+        board = ChessBoard(fen)
+        zhash = board.zhash()
+        zhash_mirror = board.mirror().zhash()
+
+        rows = [(int(score), move, False) for move, score in self.lookup(zhash)[['move', 'score']].tolist()]
+        if zhash_mirror != zhash:
+            rows.extend((int(score), move, True) for move, score in self.lookup(zhash_mirror)[['move', 'score']].tolist())
+
+        if not rows:
+            return None
+
+        rows.sort(key = lambda x: -x[0])
+
+        actions = OrderedDict()
+        score_best = rows[0][0]
+        for score, move, isMirror in rows:
+            squares = SQUARES_MIRROR if isMirror else SQUARES
+            iccs = squares[move >> 8] + squares[move & 0xff]
+            if iccs in actions:
+                continue
+            actions[iccs] = MoveRecord(board, zhash, iccs, score = score, diff = score - score_best)
+
+        ret = {}
+        ret['fen'] = fen
+        ret['score'] = score_best
+        ret['actions'] = actions
+
+        return ret
+
+#-----------------------------------------------------#
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '把开局库(.yfk, .pfBook)和本地库编译成内存映射的查询文件')
+    parser.add_argument('sources', nargs = '+', help = '源库文件')
+    parser.add_argument('-o', '--output', help = f'输出文件，默认为第一个源库加{COMPILED_BOOK_SUFFIX}后缀')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO)
+
+    out_file = Path(args.output) if args.output else getCompiledFile(args.sources[0])
+    count = compileBook(args.sources, out_file)
+    print(f'{out_file}: {count} 条记录')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,15 +2,76 @@
 
 import time
 import logging
+import threading
+from contextlib import contextmanager
 
-#import threading
-
-from PyQt5.QtCore import pyqtSignal, QObject
+from PyQt5.QtCore import pyqtSignal, QObject, QTimer
 
 import cchess
 from cchess import ChessBoard, UcciEngine, UciEngine
 
 from .Utils import ThreadRunner
+from .Cache import getFenKey, getMoveKey
+
+#等待引擎输出的最长时间(秒)，超时只是为了能及时响应stop()
+WAIT_OUTPUT_TIMEOUT = 0.5
+
+#引擎分析信息刷新到界面的频率(次/秒)
+ENGINE_INFO_FPS = 15
+
+#-----------------------------------------------------#
+def parseBestMove(action, fen, engine = None):
+    
+    board = ChessBoard(fen)
+    move_color = board.get_move_color()
+
+    ret = {}
+    ret.update(action)
+    ret['fen'] = fen
+    iccs = ret['iccs'] = ret.pop('move')
+    m = board.move_iccs(iccs) 
+    
+    #引擎有时会输出以前的局面的着法，这里预先验证一下能不能走，不能走的着法都忽略掉
+    if m is None:
+        return None
+
+    #bestmove行里没有搜索深度，从该着法最后一条info中取
+    if engine and ('depth' not in ret):
+        info = engine.score_dict.get(iccs, {})
+        if 'depth' in info:
+            ret['depth'] = info['depth']
+
+    #分数换算到红方得分
+    if move_color == cchess.BLACK:
+        for key in ['score', 'mate'] :
+            if key in ret:
+                ret[key] = - ret[key]
+            
+    #再处理出现mate时，score没分的情况
+    if 'mate' in ret:
+        mate_flag = 1 if ret['mate'] > 0 else -1
+        ret['score'] = 29999 * mate_flag
+    
+    iccs_dict = {'iccs': iccs, 'diff': 0, 'new_key': getMoveKey(m, getFenKey(fen))}
+    for key in ['score', 'mate']:
+        if key in ret:
+          iccs_dict[key] = ret[key]    
+    
+    ret['actions'] = {iccs: iccs_dict}
+    
+    return ret
+
+def waitEngineOutput(engine, timeout):
+    #引擎的读线程每读到一行就会put到engine_out_queque并notify not_empty,
+    #这里只等待通知而不取出数据，数据仍由engine.get_action()按原有流程解析。
+    #空闲时阻塞在条件变量上，不占用CPU
+    out_queue = engine.engine_out_queque
+    with out_queue.not_empty:
+        if (out_queue._qsize() == 0) and (engine.move_queue.qsize() == 0):
+            out_queue.not_empty.wait(timeout)
+
+def hasEngineOutput(engine):
+    return (engine.engine_out_queque.qsize() > 0) or (engine.move_queue.qsize() > 0)
 
 #-----------------------------------------------------#
 class EngineManager(QObject):
@@ -34,6 +95,10 @@ class EngineManager(QObject):
         
         self.isRunning = False
         self.isReady = False
+        
+        self.isBorrowed = False
+        self.engineLock = threading.Lock()
+        self.resumeEvent = threading.Event()
                         
     def loadEngine(self, engine_path, engine_type):
         if engine_type == 'uci':
@@ -117,13 +182,32 @@ class EngineManager(QObject):
     def run(self):
         self.isRunning = True
         while self.isRunning:
+            #引擎被复盘等批量任务借用时，这里不读取引擎输出
+            if self.isBorrowed:
+                self.resumeEvent.wait(WAIT_OUTPUT_TIMEOUT)
+                continue
             try:
-                self._runOnce()
+                waitEngineOutput(self.engine, WAIT_OUTPUT_TIMEOUT)
+                #有输出就一次处理完，每行输出到达后立刻发出信号
+                with self.engineLock:
+                    while self.isRunning and (not self.isBorrowed) and hasEngineOutput(self.engine):
+                        self._runOnce()
             except Exception as e:
                 logging.error(str(e))
-            time.sleep(0.1)
         #self.engine.stop_thinking()
 
+    @contextmanager
+    def borrowEngine(self):
+        #暂停输出泵，把引擎交给调用者独占使用(在调用者线程中同步读写)
+        self.resumeEvent.clear()
+        self.isBorrowed = True
+        with self.engineLock:
+            try:
+                yield self.engine
+            finally:
+                self.isBorrowed = False
+                self.resumeEvent.set()
+
     def _runOnce(self):
 
         action = self.engine.get_action()
@@ -144,34 +228,10 @@ class EngineManager(QObject):
             move_color = board.get_move_color()
             
         if act_id == 'bestmove':
-            ret = {}
-            ret.update(action)
-            iccs = ret['iccs'] = ret.pop('move')
-            m = board.copy().move_iccs(iccs) 
-            
-            #引擎有时会输出以前的局面的着法，这里预先验证一下能不能走，不能走的着法都忽略掉
-            if m is None:
+            ret = parseBestMove(action, self.fen, self.engine)
+            #引擎有时会输出以前的局面的着法，不能走的着法都忽略掉
+            if ret is None:
                 return
-
-            #分数换算到红方得分
-            if move_color == cchess.BLACK:
-                for key in ['score', 'mate'] :
-                    if key in ret:
-                        ret[key] = - ret[key]
-                    
-            #再处理出现mate时，score没分的情况
-            if 'mate' in ret:
-                mate_flag = 1 if ret['mate'] > 0 else -1
-                ret['score'] = 29999 * mate_flag
-            
-            
-            new_fen = m.board_done.to_fen()
-            iccs_dict = {'iccs': iccs, 'diff': 0, 'new_fen': new_fen}
-            for key in ['score', 'mate']:
-                if key in ret:
-                  iccs_dict[key] = ret[key]    
-            
-            ret['actions'] = {iccs: iccs_dict}
             self.moveBestSignal.emit(self.id, ret)
 
         elif act_id == 'info_move':
@@ -189,3 +249,68 @@ class EngineManager(QObject):
         
 
 #-----------------------------------------------------#
+class EngineInfoCoalescer(QObject):
+    #多分支(MultiPV)深度搜索时引擎每秒会输出大量info，逐条刷新界面会卡住GUI。
+    #这里每个(fen, multipv)只保留最新的一条，由界面线程的定时器按固定频率成批送出。
+    infoSignal = pyqtSignal(int, list)
+
+    def __init__(self, parent, fps = ENGINE_INFO_FPS):
+        super().__init__(parent)
+
+        self.lock = threading.Lock()
+        self.pending = {}
+        
+        self.received = 0
+        self.delivered = 0
+        self.merged = 0
+        self.dropped = 0
+        self.flushes = 0
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(max(1, 1000 // fps))
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    #push 可以在引擎线程中直接调用(Qt.DirectConnection)
+    def push(self, engine_id, fenInfo):
+        key = (engine_id, fenInfo.get('fen'), fenInfo.get('multipv', 1))
+        with self.lock:
+            self.received += 1
+            if key in self.pending:
+                self.merged += 1
+            self.pending[key] = fenInfo
+
+    def clear(self):
+        with self.lock:
+            self.dropped += len(self.pending)
+            self.pending = {}
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending = self.pending
+            self.pending = {}
+        
+        infos = {}
+        for (engine_id, _fen, _pv), fenInfo in pending.items():
+            infos.setdefault(engine_id, []).append(fenInfo)
+        
+        self.flushes += 1
+        for engine_id, fenInfos in infos.items():
+            self.delivered += len(fenInfos)
+            self.infoSignal.emit(engine_id, fenInfos)
+
+    def getStats(self):
+        with self.lock:
+            pending = len(self.pending)
+        return {
+            'received': self.received,
+            'delivered': self.delivered,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'pending': pending,
+            'flushes': self.flushes,
+        }
+
+#-----------------------------------------------------#
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+from pathlib import Path
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+from cchess import ChessBoard, Game
+
+from peewee import Proxy, Model, CharField, IntegerField, BigIntegerField, CompositeKey, chunked
+
+from .LocalDB import openBookDatabase, getCanonicalKey
+from .Utils import ThreadRunner
+
+#-----------------------------------------------------#
+#对局库局面索引：扫描一次目录树，记录每个局面(镜像归一后的键值)出现在哪些棋谱的第几步，
+#以后按文件的修改时间和大小增量更新。查询"哪些棋谱走到过这个局面"只是一次索引范围扫描
+
+INDEX_GAME_TYPES = ['.xqf', '.pgn', '.cbr', '.cbf']
+INDEX_LIB_TYPES = ['.cbl']
+
+#搜索结果总数上限
+INDEX_MAX_RESULTS = 1000
+
+#这么多个文件提交一次事务
+INDEX_COMMIT_FILES = 50
+
+game_index_db = Proxy()
+
+class IndexModel(Model):
+    class Meta:
+        database = game_index_db
+
+class IndexFile(IndexModel):
+    path  = CharField(unique = True)
+    mtime = BigIntegerField()
+    size  = BigIntegerField()
+
+    class Meta:
+        table_name = 'file'
+
+class IndexGame(IndexModel):
+    file  = IntegerField(index = True)
+    seq   = IntegerField()   #棋库中的第几局，单个棋谱文件为0
+    title = CharField(null = True)
+
+    class Meta:
+        table_name = 'game'
+
+class IndexPosition(IndexModel):
+    key  = BigIntegerField()
+    game = IntegerField()
+    ply  = IntegerField()
+
+    class Meta:
+        table_name = 'position'
+        primary_key = CompositeKey('key', 'game', 'ply')
+        without_rowid = True
+        #文件改动或删除时按棋谱删除局面，不加索引要扫描整个表
+        indexes = ((('game', ), False), )
+
+#-----------------------------------------------------#
+def readIndexGames(fileName):
+    ext = Path(fileName).suffix.lower()
+    if ext in INDEX_LIB_TYPES:
+        lib = Game.read_from_lib(fileName)
+        return lib['games'] if lib else []
+    game = Game.read_from(fileName)
+    return [game] if game else []
+
+def getGameKeys(game):
+    #主线上每一步的局面键值，第0步是开始局面
+    board = game.init_board.copy()
+    keys = [getCanonicalKey(board)[0]]
+    moves = game.dump_iccs_moves()
+    if not moves:
+        return keys
+    for iccs in moves[0]:
+        if board.move_iccs(iccs) is None:
+            break
+        board.next_turn()
+        keys.append(getCanonicalKey(board)[0])
+    return keys
+
+def findIndexFiles(folders):
+    for folder in folders:
+        for root, dirs, files in os.walk(folder):
+            dirs.sort()
+            for name in sorted(files):
+                if Path(name).suffix.lower() in INDEX_GAME_TYPES + INDEX_LIB_TYPES:
+                    yield str(Path(root, name))
+
+#-----------------------------------------------------#
+class GameIndex():
+    def __init__(self):
+        self.db = None
+
+    def open(self, fileName):
+        self.db = openBookDatabase(fileName)
+        game_index_db.initialize(self.db)
+        game_index_db.create_tables([IndexFile, IndexGame, IndexPosition], safe = True)
+        return True
+
+    def close(self):
+        if self.db:
+            self.db.close()
+        self.db = None
+
+    def removeFile(self, file_id):
+        games = IndexGame.select(IndexGame.id).where(IndexGame.file == file_id)
+        IndexPosition.delete().where(IndexPosition.game.in_(games)).execute()
+        IndexGame.delete().where(IndexGame.file == file_id).execute()
+        IndexFile.delete().where(IndexFile.id == file_id).execute()
+
+    def addFile(self, fileName, st):
+        file_id = IndexFile.insert(path = fileName, mtime = st.st_mtime_ns, size = st.st_size).execute()
+        positions = 0
+        try:
+            games = readIndexGames(fileName)
+        except Exception as e:
+            #读不了的文件也记下来，没改动就不再重复读
+            logging.warning(f'索引棋谱出错：{fileName} {e}')
+            return 0
+
+        for index, game in enumerate(games):
+            title = game.info.get('title') or Path(fileName).stem
+            game_id = IndexGame.insert(file = file_id, seq = index, title = title).execute()
+            #同一局中重复出现的局面只记第一次
+            rows = {}
+            for ply, key in enumerate(getGameKeys(game)):
+                rows.setdefault(key, ply)
+            for batch in chunked([{'key': key, 'game': game_id, 'ply': ply} for key, ply in rows.items()], 300):
+                IndexPosition.insert_many(batch).execute()
+            positions += len(rows)
+
+        return positions
+
+    def update(self, folders, progress = None, stopEvent = None):
+        #增量更新：新增和改动过的文件重新索引，已删除的文件从索引中去掉
+        start_time = time.time()
+
+        known = {it.path: it for it in IndexFile.select()}
+        files = list(findIndexFiles(folders))
+        seen = set(files)
+
+        stats = {'files': len(files), 'updated': 0, 'removed': 0, 'positions': 0}
+
+        folder_paths = [str(Path(x)) for x in folders]
+        with self.db.atomic():
+            for path, it in known.items():
+                #只清理本次扫描的目录下已经不存在的文件
+                if (path not in seen) and any(path.startswith(x + os.sep) for x in folder_paths):
+                    self.removeFile(it.id)
+                    stats['removed'] += 1
+
+        todo = []
+        for path in files:
+            st = os.stat(path)
+            it = known.get(path)
+            if it and (it.mtime == st.st_mtime_ns) and (it.size == st.st_size):
+                continue
+            todo.append((path, st, it))
+
+        for batch in chunked(todo, INDEX_COMMIT_FILES):
+            if stopEvent and stopEvent.is_set():
+                break
+            with self.db.atomic():
+                for path, st, it in batch:
+                    if it:
+                        self.removeFile(it.id)
+                    stats['positions'] += self.addFile(path, st)
+                    stats['updated'] += 1
+            if progress:
+                progress(stats['updated'], len(todo))
+
+        stats['seconds'] = time.time() - start_time
+        logging.info(f"对局库索引：{stats['files']} 个文件，更新 {stats['updated']}，删除 {stats['removed']}，"
+                     f"新增局面 {stats['positions']}，用时 {stats['seconds']:.1f} 秒")
+        return stats
+
+    def search(self, fen, limit = INDEX_MAX_RESULTS):
+        key, _ = getCanonicalKey(ChessBoard(fen))
+        query = (IndexPosition
+                 .select(IndexFile.path, IndexGame.seq, IndexGame.title, IndexPosition.ply)
+                 .join(IndexGame, on = (IndexPosition.game == IndexGame.id))
+                 .join(IndexFile, on = (IndexGame.file == IndexFile.id))
+                 .where(IndexPosition.key == key)
+                 .order_by(IndexFile.path, IndexGame.seq)
+                 .limit(limit)
+                 .tuples())
+        return [{'file': path, 'index': index, 'title': title, 'ply': ply} for path, index, title, ply in query]
+
+#-----------------------------------------------------#
+class GameIndexWorker(QObject):
+    #在后台线程中先增量更新索引，再搜索局面
+    progressSignal = pyqtSignal(int, int)
+    doneSignal = pyqtSignal(str, list)
+
+    def __init__(self, gameIndex, folders, fen):
+        super().__init__()
+        self.gameIndex = gameIndex
+        self.folders = folders
+        self.fen = fen
+        self.stopEvent = threading.Event()
+
+    def start(self):
+        self.thread = ThreadRunner(self)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self):
+        results = []
+        try:
+            self.gameIndex.update(self.folders, self.progressSignal.emit, self.stopEvent)
+            results = self.gameIndex.search(self.fen)
+        except Exception as e:
+            logging.error(f'搜索对局库错误：{e}')
+        self.doneSignal.emit(self.fen, results)
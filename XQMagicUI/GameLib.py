@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+import mmap
+import struct
+import logging
+import threading
+from pathlib import Path
+
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QAbstractListModel, QModelIndex
+
+from cchess import ChessBoard, Game
+from cchess.read_cbr import read_from_cbr_buffer, cut_bytes_to_str, result_dict
+
+from .Utils import ThreadRunner, loadEglib, loadCsvlib
+
+#-----------------------------------------------------#
+#棋库(.cbl)的快速索引：只读每局棋谱的标题等信息和在文件中的位置，
+#双击某一局时才解析这一局的着法
+
+CBL_MAGIC = b'CCBridgeLibrary\x00'
+CBL_GAMES_START = 101952
+CBL_BLOCK_SIZE = 4096
+
+CBR_MAGIC = b'CCBridge Record\x00'
+#与cchess.read_cbr中的文件头格式相同，只取前面的信息部分
+CBR_HEADER = struct.Struct("<16s164s128s384s64s320s64s160s64s712sB")
+
+#列表每次添加这么多行，滚动到底部时再添加
+GAME_LIB_PAGE_SIZE = 200
+
+#读取时每处理这么多局(步)报告一次进度
+LOAD_PROGRESS_STEP = 256
+
+GAME_LIB_TYPES = ['.cbl']
+END_BOOK_TYPES = ['.eglib', '.csv']
+
+#-----------------------------------------------------#
+def readLibIndex(fileName, progress = None, stopEvent = None):
+    with open(fileName, 'rb') as f:
+        head = f.read(576)
+        if len(head) < 576:
+            return None
+        magic, _i1, book_count, lib_name = struct.unpack("<16s44si512s", head)
+        if magic != CBL_MAGIC:
+            return None
+
+        lib = {'name': cut_bytes_to_str(lib_name), 'file': str(fileName), 'games': []}
+
+        f.seek(0, 2)
+        if f.tell() <= CBL_GAMES_START:
+            return lib
+
+        with mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ) as mm:
+            start = mm.find(CBR_MAGIC[:-1], CBL_GAMES_START)
+            if start < 0:
+                return lib
+
+            size = len(mm)
+            if ((size - start) % CBL_BLOCK_SIZE) != 0:
+                raise Exception(f'文件格式错误：缓冲区不是{CBL_BLOCK_SIZE}的整数倍：{size}, {start}')
+
+            #每局棋谱占一个或多个块，以CBR_MAGIC开头的块是一局棋谱的开始
+            offsets = [x for x in range(start, size, CBL_BLOCK_SIZE) if mm[x:x + len(CBR_MAGIC)] == CBR_MAGIC]
+            for index, offset in enumerate(offsets):
+                if (index % LOAD_PROGRESS_STEP) == 0:
+                    if stopEvent and stopEvent.is_set():
+                        return None
+                    if progress:
+                        progress(index, len(offsets))
+                end = offsets[index + 1] if index + 1 < len(offsets) else size
+                info = CBR_HEADER.unpack(mm[offset:offset + CBR_HEADER.size])
+                lib['games'].append({
+                    'file': str(fileName),
+                    'lib': lib['name'],
+                    'index': index,
+                    'offset': offset,
+                    'size': end - offset,
+                    'title': cut_bytes_to_str(info[2]) or f'第{index + 1}局',
+                    'event': cut_bytes_to_str(info[4]),
+                    'red': cut_bytes_to_str(info[6]),
+                    'black': cut_bytes_to_str(info[8]),
+                    'result': result_dict.get(info[10], '*'),
+                    })
+
+    return lib
+
+def readLibGame(fileName, entry):
+    #entry是readLibIndex中的一项，或者只有'index'的对局库搜索结果
+    if Path(fileName).suffix.lower() not in GAME_LIB_TYPES:
+        return Game.read_from(fileName)
+
+    if 'offset' not in entry:
+        lib = readLibIndex(fileName)
+        if not lib or (entry['index'] >= len(lib['games'])):
+            return None
+        entry = lib['games'][entry['index']]
+
+    with open(fileName, 'rb') as f:
+        f.seek(entry['offset'])
+        contents = f.read(entry['size'])
+
+    game = read_from_cbr_buffer(contents)
+    if game is not None:
+        game.info['index'] = entry['index']
+    return game
+
+def buildPositions(fen, moves, progress = None, stopEvent = None):
+    #从fen开始走完moves，生成与MainWindow.onMoveGo相同的局面列表(不含开始局面)，
+    #不涉及界面，可以在工作线程中执行
+    board = ChessBoard(fen)
+    positions = []
+    history = []
+    for index, iccs in enumerate(moves, 1):
+        if (index % LOAD_PROGRESS_STEP) == 0:
+            if stopEvent and stopEvent.is_set():
+                return None
+            if progress:
+                progress(index, len(moves))
+
+        if not board.is_valid_iccs_move(iccs):
+            break
+        move = board.move_iccs(iccs)
+        if move is None:
+            break
+        board.next_turn()
+        move.prepare_for_engine(board.move_player, history)
+        history.append(move)
+
+        positions.append({
+            'fen': board.to_fen(),
+            'fen_engine': move.to_engine_fen(),
+            'fen_prev': move.board.to_fen(),
+            'iccs': iccs,
+            'move': move,
+            'index': index,
+            'move_color': move.board.move_player.color
+        })
+
+    return positions
+
+def readGameFile(fileName, progress = None, stopEvent = None):
+    #按文件类型读取：棋库只读索引，棋谱文件同时生成局面列表，杀局谱读出全部局面
+    ext = Path(fileName).suffix.lower()
+    if ext in GAME_LIB_TYPES:
+        return {'type': 'lib', 'lib': readLibIndex(fileName, progress, stopEvent)}
+
+    if ext in END_BOOK_TYPES:
+        games = loadEglib(fileName) if ext == '.eglib' else loadCsvlib(fileName)
+        return {'type': 'endbook', 'games': list(games)}
+
+    game = Game.read_from(fileName)
+    if not game:
+        return {'type': 'game', 'game': None, 'positions': None}
+    moves = game.dump_iccs_moves()
+    positions = buildPositions(game.init_board.to_fen(), moves[0] if moves else [], progress, stopEvent)
+    return {'type': 'game', 'game': game, 'positions': positions}
+
+#-----------------------------------------------------#
+class FileLoadWorker(QObject):
+    #在后台线程中读取文件，结果通过doneSignal送回界面线程
+    progressSignal = pyqtSignal(int, int)
+    doneSignal = pyqtSignal(dict)
+
+    def __init__(self, fileName):
+        super().__init__()
+        self.fileName = fileName
+        self.stopEvent = threading.Event()
+
+    def start(self):
+        self.thread = ThreadRunner(self)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self):
+        result = {'file': str(self.fileName), 'type': None, 'error': ''}
+        try:
+            result.update(readGameFile(self.fileName, self.progressSignal.emit, self.stopEvent))
+        except Exception as e:
+            logging.error(f'读取文件【{self.fileName}】错误：{e}')
+            result['error'] = str(e)
+        result['canceled'] = self.stopEvent.is_set()
+        self.doneSignal.emit(result)
+
+#-----------------------------------------------------#
+class GameLibModel(QAbstractListModel):
+    #列表中每一行是一个dict：棋库索引项或者对局库搜索结果，行数多时分页添加
+    def __init__(self, parent = None):
+        super().__init__(parent)
+        self.entries = []
+        self.loaded = 0
+
+    def setEntries(self, entries):
+        self.beginResetModel()
+        self.entries = entries
+        self.loaded = min(len(entries), GAME_LIB_PAGE_SIZE)
+        self.endResetModel()
+
+    def entry(self, index):
+        if not index.isValid() or (index.row() >= self.loaded):
+            return None
+        return self.entries[index.row()]
+
+    def rowCount(self, parent = QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.loaded
+
+    def canFetchMore(self, parent):
+        return (not parent.isValid()) and (self.loaded < len(self.entries))
+
+    def fetchMore(self, parent):
+        count = min(len(self.entries) - self.loaded, GAME_LIB_PAGE_SIZE)
+        if count <= 0:
+            return
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded + count - 1)
+        self.loaded += count
+        self.endInsertRows()
+
+    def data(self, index, role = Qt.DisplayRole):
+        it = self.entry(index)
+        if it is None:
+            return None
+
+        if role == Qt.DisplayRole:
+            if 'ply' in it:
+                return f"{it['title']} (第{it['ply']}步)"
+            return it['title']
+        elif role == Qt.ToolTipRole:
+            if it.get('red') or it.get('black'):
+                return f"{it.get('red') or ''} vs {it.get('black') or ''} {it.get('result', '')}"
+            return it['file']
+        elif role == Qt.UserRole:
+            return it
+
+        return None
@@ -1,2 +1,7 @@
+from .Cache import FenCache
 
-fenCache = {}
+fenCache = FenCache()
+
+analysisStore = None
+
+gameIndex = None
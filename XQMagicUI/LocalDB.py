@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import time
+import json
 import logging
+import weakref
 import threading
 from pathlib import Path
 from collections import OrderedDict
@@ -9,11 +11,12 @@ from collections import OrderedDict
 import cchess
 from cchess import ChessBoard
 
-from peewee import Proxy, Model, CharField, IntegerField, BigIntegerField, TextField, BlobField
+from peewee import Proxy, Model, chunked, CharField, IntegerField, BigIntegerField, TextField, BlobField
 from playhouse.sqlite_ext import SqliteExtDatabase, JSONField
 from playhouse.shortcuts import model_to_dict, dict_to_model
 
 from . import Globl
+from .Cache import getFenKey, getMoveKey
         
 #----------------------------------------------------------------
 #python -m pwiz -e sqlite path/to/sqlite_database.db > 要生成的python文件名称.py
@@ -41,6 +44,39 @@ class PosMove(Model):
         database = book_db
 '''
 
+#------------------------------------------------------------------------------
+#所有库共用的sqlite连接参数
+BOOK_CACHE_MB = 64
+BOOK_MMAP_MB = 256
+
+#peewee的连接按线程分开，每个线程的连接要在这个线程中关闭，这里记下所有打开的库
+_bookDatabases = weakref.WeakSet()
+
+def closeThreadConnections():
+    #关闭当前线程中所有库的连接，之后再查询时会自动重新连接
+    for db in list(_bookDatabases):
+        if not db.is_closed():
+            db.close()
+
+def openBookDatabase(fileName, readOnly = False):
+    pragmas = [
+        ('cache_size', -1024 * BOOK_CACHE_MB),
+        ('mmap_size', 1024 * 1024 * BOOK_MMAP_MB),
+        ('temp_store', 'memory'),
+    ]
+    
+    if readOnly:
+        #开局库、大师库在程序运行时不会改动，按只读不可变方式打开，
+        #sqlite不再加锁也不检查文件是否被修改，查询直接读mmap映射的页面
+        uri = Path(fileName).resolve().as_uri() + '?mode=ro&immutable=1'
+        db = SqliteExtDatabase(uri, uri = True, pragmas = pragmas)
+    else:
+        pragmas.extend([('journal_mode', 'wal'), ('synchronous', 'normal')])
+        db = SqliteExtDatabase(fileName, pragmas = pragmas)
+    
+    _bookDatabases.add(db)
+    return db
+
 #------------------------------------------------------------------------------
 #本地古典库，大师库
 #
@@ -60,11 +96,28 @@ class MasterEvBook(Model):
         database = master_book_db
         table_name = 'evbook'
 
+#------------------------------------------------------------------------------
+def getCanonicalKey(board):
+    #左右镜像的局面视为同一个局面，取两个zhash中较小的一个作为键值
+    zhash = board.zhash()
+    zhash_mirror = board.mirror().zhash()
+    if zhash_mirror < zhash:
+        return (zhash_mirror, True)
+    return (zhash, False)
+
 #------------------------------------------------------------------------------
 #本地库
 #
 local_book_db = Proxy()
 
+#本地库的表结构版本，保存在sqlite的user_version中
+#0: book表按fen字符串查询
+#1: book表增加镜像归一后的key，(key, iccs)唯一索引
+LOCAL_BOOK_VERSION = 1
+
+#批量写入时每条insert语句的记录数，5个字段 * 100 不超过sqlite的参数个数上限
+LOCAL_BOOK_BATCH_SIZE = 100
+
 class LocalModel(Model):
     class Meta:
         database = local_book_db
@@ -72,13 +125,16 @@ class LocalModel(Model):
 #------------------------------------------------------------------------------
 
 class Book(LocalModel):
-    fen = CharField(index=True)
+    #fen和iccs都是镜像归一后的(与key对应的那一侧)
+    key   = BigIntegerField()
+    fen   = CharField()
     iccs  = CharField()
     score = IntegerField(null=True)
     memo  = JSONField(null=True)
     
     class Meta:
         table_name = 'book'
+        indexes = ((('key', 'iccs'), True),)
 
 #------------------------------------------------------------------------------
 class Bookmark(LocalModel):
@@ -105,6 +161,7 @@ class MoveBookMixIn():
         actions = OrderedDict()    
         score_best = None
         board = ChessBoard(fen)
+        fen_key = getFenKey(fen)
         move_color = board.get_move_color()        
         
         for item in records:
@@ -120,7 +177,7 @@ class MoveBookMixIn():
             m['iccs'] = iccs
             move_it = board.copy().move_iccs(iccs)
             m['text'] = move_it.to_text()
-            m['new_fen'] = move_it.board_done.to_fen()
+            m['new_key'] = getMoveKey(move_it, fen_key)
             
             if score is not None:
                 if score_best is  None:
@@ -226,7 +283,7 @@ class MasterBook(MoveBookMixIn):
         if not Path(fileName).is_file():
             return False
 
-        self.db_master = SqliteExtDatabase(fileName)
+        self.db_master = openBookDatabase(fileName, readOnly = True)
         master_book_db.initialize(self.db_master)
 
         return True
@@ -250,6 +307,7 @@ class MasterBook(MoveBookMixIn):
         actions = OrderedDict()    
         score_best = None
         board = ChessBoard(fen)
+        fen_key = getFenKey(fen)
         move_color = board.get_move_color()        
         
         for ics, act in record.actions.items():
@@ -264,7 +322,7 @@ class MasterBook(MoveBookMixIn):
             m['iccs'] = iccs
             move_it = board.copy().move_iccs(iccs)
             m['text'] = move_it.to_text()
-            m['new_fen'] = move_it.board_done.to_fen()
+            m['new_key'] = getMoveKey(move_it, fen_key)
             
             if score is not None:
                 if score_best is  None:
@@ -433,13 +491,50 @@ class LocalBook():
         if not Path(fileName).is_file():
             isInit = True
 
-        self.db_local = SqliteExtDatabase(fileName)
+        self.db_local = openBookDatabase(fileName)
         local_book_db.initialize(self.db_local)
         if isInit:
             local_book_db.create_tables([Book, Bookmark])
+            self.db_local.pragma('user_version', LOCAL_BOOK_VERSION)
+        elif self.db_local.pragma('user_version') < LOCAL_BOOK_VERSION:
+            self.upgrade()
 
         return True
     
+    def upgrade(self):
+        #旧版本的book表只有fen字段，重新生成一遍，同时合并镜像重复的记录
+        records = OrderedDict()
+        if self.db_local.table_exists('book'):
+            cursor = self.db_local.execute_sql('SELECT fen, iccs, score, memo FROM book')
+            for fen, iccs, score, memo in cursor.fetchall():
+                it = self.makeRecord(fen, iccs, score)
+                #旧表中的memo是JSON文本，解出来再写入JSONField，否则会被编码两次
+                it['memo'] = json.loads(memo) if memo else None
+                old = records.setdefault((it['key'], it['iccs']), it)
+                if (old['score'] is None) and (score is not None):
+                    old['score'] = score
+                if (old['memo'] is None) and it['memo']:
+                    old['memo'] = it['memo']
+
+        with self.db_local.atomic():
+            self.db_local.execute_sql('DROP TABLE IF EXISTS book')
+            local_book_db.create_tables([Book, Bookmark])
+            rows = list(records.values())
+            for batch in chunked(rows, LOCAL_BOOK_BATCH_SIZE):
+                Book.insert_many(batch).execute()
+            self.db_local.pragma('user_version', LOCAL_BOOK_VERSION)
+        
+        logging.info(f'本地库升级到版本 {LOCAL_BOOK_VERSION}，共 {len(rows)} 条记录')
+
+    def makeRecord(self, fen, iccs, score = None):
+        #写入前先做镜像归一
+        board = ChessBoard(fen)
+        key, is_mirror = getCanonicalKey(board)
+        if is_mirror:
+            fen = board.mirror().to_fen()
+            iccs = cchess.iccs_mirror(iccs)
+        return {'key': key, 'fen': fen, 'iccs': iccs, 'score': score}
+    
     def close(self):
         if self.db_local:
             self.db_local.close()
@@ -476,63 +571,87 @@ class LocalBook():
         return True
 
     def saveBook(self, fen, moves):
-        book = Book(fen = fen, moves = moves)
-        book.save()
+        for iccs in moves:
+            self.saveRecord(fen, iccs, None)
         return True
 
     def savePositionList(self, positionList):
-        #TODO: 更新分数
-        for position in positionList[1:]:
-            fen = position['fen_prev']
-            iccs = position['iccs']
-            score = None
-            self.saveRecord(fen, iccs, score)
-
-    def saveRecord(self, fen, iccs, score):
+        return self.savePositionLists([positionList])
 
-        ret_len, is_mirror = self.getRecord(fen, iccs)
+    def savePositionLists(self, positionLists):
+        #TODO: 更新分数
+        records = []
+        for positionList in positionLists:
+            for position in positionList[1:]:
+                records.append((position['fen_prev'], position['iccs'], None))
+        return self.saveRecords(records)
+
+    def importGames(self, games):
+        #导入整个棋谱库，只导入主线
+        records = []
+        for game in games:
+            moves = game.dump_iccs_moves()
+            if not moves:
+                continue
+            board = game.init_board.copy()
+            for iccs in moves[0]:
+                fen = board.to_fen()
+                if board.move_iccs(iccs) is None:
+                    break
+                board.next_turn()
+                records.append((fen, iccs, None))
+        return self.saveRecords(records)
+
+    def saveRecords(self, records):
+        #所有记录在一个事务中批量写入，已经有的记录不覆盖
+        start_time = time.time()
         
-        if ret_len == 0:
-            new_record = Book(fen = fen, iccs = iccs, score = score)
-            new_record.save()
-        else:
-            #TODO 更新score
-            pass
+        rows = OrderedDict()
+        for fen, iccs, score in records:
+            it = self.makeRecord(fen, iccs, score)
+            rows.setdefault((it['key'], it['iccs']), it)
+        
+        count = 0
+        with self.db_local.atomic():
+            for batch in chunked(rows.values(), LOCAL_BOOK_BATCH_SIZE):
+                count += Book.insert_many(batch).on_conflict_ignore().as_rowcount().execute()
         
+        used = max(time.time() - start_time, 1e-6)
+        logging.info(f'本地库导入 {len(records)} 步，新增 {count} 条，{len(records) / used:.0f} 步/秒')
+        
+        return {'plies': len(records), 'inserted': count, 'seconds': used, 'plies_per_sec': len(records) / used}
+
+    def saveRecord(self, fen, iccs, score):
+        #已经有的记录不覆盖  #TODO 更新score
+        Book.insert(**self.makeRecord(fen, iccs, score)).on_conflict_ignore().execute()
         return True
             
     def getRecord(self, fen, iccs):
 
-        f_mirror = cchess.fen_mirror(fen)
-        i_mirror = cchess.iccs_mirror(iccs)
+        board = ChessBoard(fen)
+        key, is_mirror = getCanonicalKey(board)
+        if is_mirror:
+            iccs = cchess.iccs_mirror(iccs)
 
-        query = Book.select().where(  ((Book.fen == fen) & (Book.iccs == iccs)) 
-                                        | ((Book.fen == f_mirror) & (Book.iccs == i_mirror)) )
-        query.execute()
+        query = Book.select().where((Book.key == key) & (Book.iccs == iccs)).execute()
             
         if len(query) == 0:
             return (0, False)
         
-        if len(query) > 1:
-            raise Exception(f"Local Storage Multi Record Error:{fen}, {iccs}")
-        
-        is_mirror = False
-        if query[0].fen == f_mirror:
-            True
-
         return (1, is_mirror)
     
     def getMoves(self, fen):
 
         board = ChessBoard(fen)
-        f_mirror = cchess.fen_mirror(fen)
-        query = Book.select().where((Book.fen == fen) | (Book.fen == f_mirror)).execute()
+        fen_key = getFenKey(fen)
+        key, is_mirror = getCanonicalKey(board)
+        query = Book.select().where(Book.key == key).order_by(Book.id).execute()
         
         actions = OrderedDict() 
         for it in query:
             
             iccs = it.iccs
-            if it.fen == f_mirror:
+            if is_mirror:
                 iccs = cchess.iccs_mirror(iccs)
             
             m = {}
@@ -544,7 +663,7 @@ class LocalBook():
             move_it = board.copy().move_iccs(iccs)
             if move_it:
                 m['text'] = move_it.to_text()
-                m['new_fen'] = move_it.board_done.to_fen()
+                m['new_key'] = getMoveKey(move_it, fen_key)
             else:
                 m['text'] = 'move error'
             
@@ -557,6 +676,132 @@ class LocalBook():
 
         return ret
         
+#------------------------------------------------------------------------------
+#分析库，保存引擎和云库的分析结果，程序重启后不用再重新分析
+#
+analysis_db = Proxy()
+
+class Analysis(Model):
+    key    = BigIntegerField()
+    source = CharField()           #engine, cloud
+    name   = CharField(default = '')  #引擎名称及版本
+    score  = IntegerField(null=True)  #红方得分
+    mate   = IntegerField(null=True)
+    depth  = IntegerField(null=True)
+    iccs   = CharField(null=True)
+    pv     = JSONField(null=True)
+    actions = JSONField(null=True)
+    
+    class Meta:
+        database = analysis_db
+        table_name = 'analysis'
+        indexes = ((('key', 'source', 'name'), True),)
+
+#------------------------------------------------------------------------------
+class AnalysisStore():
+    def __init__(self):
+        self.db = None
+
+    def open(self, fileName):
+        
+        self.db = openBookDatabase(fileName)
+        analysis_db.initialize(self.db)
+        analysis_db.create_tables([Analysis], safe = True)
+        
+        return True
+        
+    def close(self):
+        if self.db:
+            self.db.close()
+        self.db = None
+    
+    def getAnalysis(self, fen, source, minDepth = 0):
+        
+        if not self.db:
+            return None
+
+        board = ChessBoard(fen)
+        fen_key = getFenKey(fen)
+        key, is_mirror = getCanonicalKey(board)
+
+        query = Analysis.select().where((Analysis.key == key) & (Analysis.source == source))
+        if minDepth > 0:
+            query = query.where(Analysis.depth >= minDepth)
+        query = query.order_by(Analysis.depth.desc(nulls = 'LAST')).limit(1).execute()
+        
+        if len(query) == 0:
+            return None
+        
+        it = query[0]
+        mirror = (lambda x: cchess.iccs_mirror(x)) if is_mirror else (lambda x: x)
+        
+        ret = {'fen': fen, 'source': source}
+        if it.name:
+            ret['engine'] = it.name
+        for field in ['score', 'mate', 'depth']:
+            value = getattr(it, field)
+            if value is not None:
+                ret[field] = value
+        if it.iccs:
+            ret['iccs'] = mirror(it.iccs)
+        if it.pv:
+            ret['moves'] = [mirror(x) for x in it.pv]
+        
+        actions = OrderedDict()
+        for act in (it.actions or []):
+            iccs = mirror(act['iccs'])
+            m = dict(act)
+            m['iccs'] = iccs
+            move_it = board.copy().move_iccs(iccs)
+            if move_it is None:
+                continue
+            m['text'] = move_it.to_text()
+            m['new_key'] = getMoveKey(move_it, fen_key)
+            actions[iccs] = m
+        ret['actions'] = actions
+
+        return ret
+
+    def saveAnalysis(self, fenInfo, source, name = ''):
+        
+        if not self.db:
+            return False
+
+        key, is_mirror = getCanonicalKey(ChessBoard(fenInfo['fen']))
+        mirror = (lambda x: cchess.iccs_mirror(x)) if is_mirror else (lambda x: x)
+        
+        #new_key和text在读取时重新生成，这里只保存着法和分数
+        actions = []
+        for iccs, act in fenInfo.get('actions', {}).items():
+            m = {'iccs': mirror(iccs)}
+            for field in ['score', 'mate', 'diff']:
+                if field in act:
+                    m[field] = act[field]
+            actions.append(m)
+        
+        iccs = fenInfo.get('iccs', None)
+        moves = fenInfo.get('moves', None)
+        depth = fenInfo.get('depth', None)
+        
+        #已有更深的分析结果就不覆盖
+        old = Analysis.get_or_none((Analysis.key == key) & (Analysis.source == source) & (Analysis.name == name))
+        if old and old.depth and ((depth is None) or (depth < old.depth)):
+            return False
+
+        Analysis.insert(
+            key = key,
+            source = source,
+            name = name,
+            score = fenInfo.get('score', None),
+            mate = fenInfo.get('mate', None),
+            depth = depth,
+            iccs = mirror(iccs) if iccs else None,
+            pv = [mirror(x) for x in moves] if moves else None,
+            actions = actions,
+            ).on_conflict_replace().execute()
+        
+        return True
+        
 #------------------------------------------------------------------------------
 #勇芳格式开局库
 openBookYfk = Proxy()
@@ -614,6 +859,77 @@ class PfBook(BaseModelPfBook):
     class Meta:
         table_name = 'pfBook'
 
+#------------------------------------------------------------------------------
+class MoveRecord(dict):
+    #开局库查询返回的着法，着法文字'text'和走后局面键值'new_key'要走一步棋才能得到，
+    #第一次访问这两项时才计算。用法与dict相同
+    LAZY_KEYS = ('text', 'new_key')
+
+    def __init__(self, board, fen_key, iccs, **kwargs):
+        super().__init__(iccs = iccs, **kwargs)
+        self.board = board
+        self.fen_key = fen_key
+        self.isResolved = False
+
+    def resolve(self):
+        if self.isResolved:
+            return
+        self.isResolved = True
+
+        iccs = dict.__getitem__(self, 'iccs')
+        move_it = self.board.copy().move_iccs(iccs)
+        if move_it is not None:
+            dict.__setitem__(self, 'text', move_it.to_text())
+            dict.__setitem__(self, 'new_key', getMoveKey(move_it, self.fen_key))
+        else:
+            dict.__setitem__(self, 'text', f'err:{iccs}')
+            logging.error(f"{self.board.to_fen()} move {iccs} error")
+    
+    def __missing__(self, key):
+        if (key not in self.LAZY_KEYS) or self.isResolved:
+            raise KeyError(key)
+        self.resolve()
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+        if key in self.LAZY_KEYS:
+            self.resolve()
+        return dict.__contains__(self, key)
+    
+    def get(self, key, default = None):
+        if key in self.LAZY_KEYS:
+            self.resolve()
+        return dict.get(self, key, default)
+    
+    #整体遍历或者复制时先把所有项算出来
+    def __iter__(self):
+        self.resolve()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self.resolve()
+        return dict.__len__(self)
+
+    def keys(self):
+        self.resolve()
+        return dict.keys(self)
+
+    def values(self):
+        self.resolve()
+        return dict.values(self)
+
+    def items(self):
+        self.resolve()
+        return dict.items(self)
+
+    def copy(self):
+        self.resolve()
+        return dict(self)
+    
+    def __repr__(self):
+        self.resolve()
+        return dict.__repr__(self)
+
 #------------------------------------------------------------------------------
 #开局库基础类
 class OpenBookDB():    
@@ -643,8 +959,25 @@ class OpenBookDB():
         "a0", "b0", "c0", "d0", "e0", "f0", "g0", "h0", "i0"
         ]
     
-    CoordMap = {}
-        
+    #按字节直接查表得到坐标，Mirror表是左右镜像后的坐标，省掉iccs_mirror
+    CoordTable = [''] * 256
+    CoordMirrorTable = [''] * 256
+    for _i in range(90):
+        CoordTable[c90[_i]] = s90[_i]
+        CoordMirrorTable[c90[_i]] = chr(ord('a') + ord('i') - ord(s90[_i][0])) + s90[_i][1]
+    del _i
+
+    CoordMap = dict(zip(c90, s90))
+    
+    #vmove中起点坐标所在的位置，勇芳库在低8位，鹏飞库在高8位
+    fromShift = 0
+    
+    def vmove2iccs(self, vmove, isMirror = False):
+        table = self.CoordMirrorTable if isMirror else self.CoordTable
+        v_from = (vmove >> self.fromShift) & 0xff
+        v_to = (vmove >> (8 - self.fromShift)) & 0xff
+        return table[v_from] + table[v_to]
+
     def __init__(self):
         
         self.isBookOpened = False
@@ -652,10 +985,6 @@ class OpenBookDB():
         self.name = ''
         self.isUseScore = False
 
-        if not self.CoordMap:
-            for i in range(90):
-                self.CoordMap[self.c90[i]] = self.s90[i]
-    
     def open(self, fileName, globDatabase, useScore):
         
         if self.isBookOpened:
@@ -664,7 +993,7 @@ class OpenBookDB():
         if not Path(fileName).is_file():
             return False
 
-        self.db = SqliteExtDatabase(fileName)
+        self.db = openBookDatabase(fileName, readOnly = True)
         globDatabase.initialize(self.db)
 
         self.isBookOpened = True
@@ -693,12 +1022,6 @@ class OpenBookYfk(OpenBookDB):
     def open(self, fileName, useScore = False):
         super().open(fileName, openBookYfk, useScore)
         
-    #鹏飞库与勇芳库的高低位是反的，其他数据一样
-    def vmove2iccs(self, vmove):
-        v_from =  vmove & 0xff
-        v_to = vmove >> 8
-        return self.CoordMap[v_from] + self.CoordMap[v_to]
-
     def getMoves(self, fen):
 
         if not self.isBookOpened:
@@ -708,8 +1031,9 @@ class OpenBookYfk(OpenBookDB):
         zhash = board.zhash()
         zhash_mirror = board.mirror().zhash()
         
-        query = Bhobk.select().where(((Bhobk.vkey == zhash) | (Bhobk.vkey == zhash_mirror)) & (Bhobk.vvalid == 1))\
-                                    .order_by(-Bhobk.vscore).execute()
+        query = Bhobk.select(Bhobk.vkey, Bhobk.vmove, Bhobk.vscore)\
+                    .where(((Bhobk.vkey == zhash) | (Bhobk.vkey == zhash_mirror)) & (Bhobk.vvalid == 1))\
+                    .order_by(-Bhobk.vscore).tuples().execute()
         
         if len(query) == 0:
             return None
@@ -717,31 +1041,13 @@ class OpenBookYfk(OpenBookDB):
         actions = OrderedDict() 
         score_best = None
         
-        for it in query:
-            iccs = self.vmove2iccs(it.vmove)
+        for vkey, vmove, score in query:
+            iccs = self.vmove2iccs(vmove, vkey != zhash)
             
-            score = it.vscore
             if score_best is None:
                 score_best = score
             
-            if it.vkey == zhash_mirror:
-                iccs = cchess.iccs_mirror(iccs)
-                
-            m = {}  
-            m['iccs'] = iccs
-            m['score'] = score
-            m['diff'] =  score - score_best
-            
-            bd = board.copy()
-            move_it = bd.move_iccs(iccs)
-            if move_it is not None:
-                m['text'] = move_it.to_text()
-                m['new_fen'] = move_it.board_done.to_fen()
-            else:
-                m['text'] = f'err:{iccs}'
-                logging.error(f"{bd.to_fen()} move {iccs} error")
-            
-            actions[iccs] = m
+            actions[iccs] = MoveRecord(board, zhash, iccs, score = score, diff = score - score_best)
         
         ret = {}
         ret['fen'] = fen
@@ -754,6 +1060,9 @@ class OpenBookYfk(OpenBookDB):
 #------------------------------------------------------------------------------
 class OpenBookPF(OpenBookDB):
     
+    #鹏飞库与勇芳库的高低位是反的，其他数据一样
+    fromShift = 8
+    
     def __init__(self):
         super().__init__()
         self.name = '鹏飞'
@@ -762,12 +1071,6 @@ class OpenBookPF(OpenBookDB):
     def open(self, fileName, useScore = False):
         super().open(fileName, openBookPF, useScore)
         
-    #鹏飞库与勇芳库的高低位是反的，其他数据一样
-    def vmove2iccs(self, vmove):
-        v_to =  vmove & 0xff
-        v_from = vmove >> 8
-        return self.CoordMap[v_from] + self.CoordMap[v_to]
-
     def getMoves(self, fen):
         
         if not self.isBookOpened:
@@ -777,51 +1080,33 @@ class OpenBookPF(OpenBookDB):
         zhash = board.zhash()
         zhash_mirror = board.mirror().zhash()
         
-        query = PfBook.select().where(((PfBook.vkey == zhash) | (PfBook.vkey == zhash_mirror)) & (PfBook.vvalid == 1))\
-                                    .order_by(-PfBook.vscore).execute()
+        query = PfBook.select(PfBook.vkey, PfBook.vmove, PfBook.vscore, PfBook.vmemo)\
+                    .where(((PfBook.vkey == zhash) | (PfBook.vkey == zhash_mirror)) & (PfBook.vvalid == 1))\
+                    .order_by(-PfBook.vscore).tuples().execute()
         
         if len(query) == 0:
             return None
                     
         actions = OrderedDict() 
         score_best = None
-        #move_color = board.get_move_color()        
         
-        for it in query:
-            iccs = self.vmove2iccs(it.vmove)
+        for vkey, vmove, score, vmemo in query:
+            iccs = self.vmove2iccs(vmove, vkey != zhash)
         
-            score = it.vscore
             if score_best is None:
                score_best = score
                     
-            if it.vkey == zhash_mirror:
-                iccs = cchess.iccs_mirror(iccs)
-                
             if iccs in actions:
                 continue
 
-            m = {}  
-            m['iccs'] = iccs
-                
-            if isinstance(it.vmemo, str):
-                m['memo'] = it.vmemo
-            elif isinstance(it.vmemo, bytes):
-                m['memo'] = it.vmemo.decode('utf-8')
+            if isinstance(vmemo, str):
+                memo = vmemo
+            elif isinstance(vmemo, bytes):
+                memo = vmemo.decode('utf-8')
             else:
-                m['memo'] = str(it.vmemo)
+                memo = str(vmemo)
             
-            m['score'] = score
-            m['diff'] =  score - score_best
-        
-            move_it = board.copy().move_iccs(iccs)
-            if move_it is not None:
-                m['text'] = move_it.to_text()
-                m['new_fen'] = move_it.board_done.to_fen()
-            else:
-                m['text'] = f'err:{iccs}'
-                logging.error(f"{bd.to_fen()} move {iccs} error")
-            
-            actions[iccs] = m
+            actions[iccs] = MoveRecord(board, zhash, iccs, memo = memo, score = score, diff = score - score_best)
         
         ret = {}
         ret['fen'] = fen
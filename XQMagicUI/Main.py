@@ -13,10 +13,10 @@ from collections import OrderedDict
 from configparser import ConfigParser
 
 #from PyQt5 import 
-from PyQt5.QtCore import Qt, pyqtSignal, QByteArray, QUrl
+from PyQt5.QtCore import Qt, pyqtSignal, QByteArray, QUrl, QTimer
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QApplication,QMainWindow, QStyle, QSizePolicy, QMessageBox, QWidget, QCheckBox, QRadioButton, QComboBox,\
-                            QFileDialog, QButtonGroup, QActionGroup, QAction
+                            QFileDialog, QButtonGroup, QActionGroup, QAction, QProgressDialog
 from PyQt5.QtMultimedia import QMediaPlayer, QMediaContent,QAudioOutput
 
 import cchess
@@ -24,11 +24,17 @@ from cchess import ChessBoard, Game, EngineErrorException
 
 from .Version import release_version
 from .Resource import qt_resource_data
-from .Engine import EngineManager
+from .Engine import EngineManager, EngineInfoCoalescer
+from .Review import ReviewWorker, EnginePool, getPoolThreads
+from .Cache import CACHE_MAX_ENTRIES, CACHE_MAX_MB, getFenKey
 
 from .Storage import EndBookStore
-from .CloudDB import CloudDB, MyScoreDB
-from .LocalDB import OpenBookYfk, OpenBookPF, MasterBook, LocalBook
+from .CloudDB import CloudDB, MyScoreDB, CLOUD_PREFETCH_CHILDREN, CLOUD_PREFETCH_PLIES
+from .LocalDB import OpenBookYfk, OpenBookPF, MasterBook, LocalBook, AnalysisStore
+from .CompiledBook import CompiledBook, getCompiledFile
+from .BookStack import BookStack
+from .GameIndex import GameIndex, GameIndexWorker
+from .GameLib import readLibGame, buildPositions, FileLoadWorker, GAME_LIB_TYPES, END_BOOK_TYPES
 
 from .Utils import GameMode, ReviewMode, TimerMessageBox, QGameManager, getTitle, getStepsFromFenMoves, trim_fen
 from .BoardWidgets import ChessBoardWidget, DEFAULT_SKIN
@@ -61,7 +67,6 @@ class ActionType(Enum):
 #-----------------------------------------------------#
 
 GAME_FILE_TYPES = ['.xqf','.pgn', '.cbr']
-GAME_LIB_TYPES = ['.cbl']
 GAME_TYPES_ALL = GAME_FILE_TYPES + GAME_LIB_TYPES
 
 #-----------------------------------------------------#
@@ -96,6 +101,7 @@ class MainWindow(QMainWindow):
                 
         #self.openBook = MasterBook()
         #self.openBook.open(Path('Game', 'openbook.edb'))
+        self.openBook = None
         
         Globl.endbookStore = EndBookStore(Path(gamePath, 'endbooks.json'))
         #Globl.localbookStore = LocalBookStore(Path(gamePath, 'localbooks.json'))
@@ -103,6 +109,12 @@ class MainWindow(QMainWindow):
         Globl.localBook = LocalBook()
         Globl.localBook.open(Path(gamePath, 'localbook.db'))
         
+        Globl.analysisStore = AnalysisStore()
+        Globl.analysisStore.open(Path(gamePath, 'analysis.db'))
+
+        Globl.gameIndex = GameIndex()
+        Globl.gameIndex.open(Path(gamePath, 'gameindex.db'))
+
         Globl.engineManager = EngineManager(self, id = 1)
         
         self.onlineManager = OnlineManager(self)
@@ -158,7 +170,10 @@ class MainWindow(QMainWindow):
         
         Globl.engineManager.readySignal.connect(self.onEngineReady)
         Globl.engineManager.moveBestSignal.connect(self.onTryEngineMove)
-        Globl.engineManager.moveInfoSignal.connect(self.onEngineMoveInfo)
+        #引擎info先在引擎线程里合并，再按固定频率批量送到界面
+        self.engineInfoCoalescer = EngineInfoCoalescer(self)
+        self.engineInfoCoalescer.infoSignal.connect(self.onEngineMoveInfos)
+        Globl.engineManager.moveInfoSignal.connect(self.engineInfoCoalescer.push, Qt.DirectConnection)
         #Globl.engineManager.checkmate_signal.connect(self.onEngineCheckmate)
 
         self.skins = self.loadSkins()
@@ -169,6 +184,14 @@ class MainWindow(QMainWindow):
 
         
         self.reviewMode = None
+        self.reviewWorker = None
+        self.gameIndexWorker = None
+        self.fileLoadWorker = None
+        self.fileLoadDialog = None
+        self.engineName = ''
+        self.reviewEngines = 1
+        self.enginePool = None
+        self.enginePoolConfig = None
         self.isQueryCloud = False
         self.lastOpenFolder = ''
         self.isNeedSave = False
@@ -180,6 +203,11 @@ class MainWindow(QMainWindow):
 
         self.clearAll()
         
+        #开局库和本地库合并查询，本地库的着法标记为*
+        self.bookStack = BookStack(self)
+        self.bookStack.resultSignal.connect(self.onBookQueryResult)
+        self.bookStack.setBook('local', Globl.localBook, priority = 0, mark = '*')
+
         self.readSettings()
         self.loadOpenBook(self.openBookFile)
         #self.cloudQuery = MyScoreDB(self) #CloudDB(self)
@@ -219,10 +247,24 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, f'{getTitle()}', f'打开配置文件[{Globl.config_file}]出错：{e}')
             return False
         
+        #fenCache的容量上限
+        if self.config.has_section('Cache'):
+            cache = self.config['Cache']
+            Globl.fenCache.setLimits(cache.getint('max_entries', CACHE_MAX_ENTRIES), cache.getint('max_mb', CACHE_MAX_MB) * 1024 * 1024)
+
+        #局面搜索时索引的棋谱目录，多个目录用;分隔
+        self.gameIndexFolders = ['Books']
+        if self.config.has_section('GameIndex'):
+            folders = self.config['GameIndex'].get('folders', '')
+            self.gameIndexFolders = [x.strip() for x in folders.split(';') if x.strip()]
+        
     def initEngine(self):
         try:
             self.engine_type = self.config['MainEngine']['engine_type'].lower()
             self.engine_exec = Path(self.config['MainEngine']['engine_exec'])
+            #引擎复盘时同时运行的引擎个数，大于1时使用引擎池
+            self.reviewEngines = self.config['MainEngine'].getint('review_engines', 1)
+            self.resetEnginePool()
         except Exception as e:
             QMessageBox.critical(self, f'{getTitle()}', f'配置文件[{Globl.config_file}]格式错误：{e}')
             return False
@@ -253,8 +295,17 @@ class MainWindow(QMainWindow):
         if not file_name.is_file():
             return 
         
+        oldBook = self.openBook
+
+        #源库没有改动过时优先用编译好的库，查询不经过sqlite
+        compiled = CompiledBook()
         ext = file_name.suffix.lower()
-        if ext == '.yfk':
+        if compiled.open(getCompiledFile(file_name), [file_name]):
+            compiled.name = file_name.stem
+            self.openBook = compiled
+            self.openBookFile = file_name
+            logging.info(f'加载开局库：{file_name}(编译版)')
+        elif ext == '.yfk':
             self.openBook = OpenBookYfk()
             self.openBook.open(file_name)
             logging.info(f'加载开局库：{file_name}')
@@ -267,6 +318,14 @@ class MainWindow(QMainWindow):
         else:
             self.openBook = OpenBookPF()
             logging.info('无开局库')
+        
+        #开局库的分数不显示
+        self.bookStack.setBook('open', self.openBook, priority = 10, useScore = False)
+
+        #换上新库后关闭旧库：编译库释放内存映射，数据库库关闭界面线程中的连接，查询线程中的连接在下次查询前关闭
+        if oldBook is not None:
+            oldBook.close()
+            self.bookStack.closeConnections()
 
     def loadSkins(self):
         
@@ -350,6 +409,7 @@ class MainWindow(QMainWindow):
 
     def saveGameToDB(self):
         Globl.localBook.savePositionList(self.positionList)
+        self.bookStack.clearCache()
         self.isNeedSave = False
     
     #-----------------------------------------------------------------------
@@ -564,7 +624,7 @@ class MainWindow(QMainWindow):
         #在fenCach中把招法连起来
         if new_fen not in Globl.fenCache:
             Globl.fenCache[new_fen] = {}
-        Globl.fenCache[new_fen].update({ 'fen_prev': position['fen_prev'] })
+        Globl.fenCache[new_fen].update({ 'prev_key': getFenKey(position['fen_prev']) })
             
         self.historyView.onNewPostion(self.currPosition)
         self.updateStatus(quickMode)
@@ -575,6 +635,9 @@ class MainWindow(QMainWindow):
     def onChangePosition(self, quickMode = False):   
         
         position = self.currPosition
+        
+        #当前棋谱上的局面不会被fenCache淘汰
+        Globl.fenCache.pin(x['fen'] for x in self.positionList)
         fen = position['fen']
         move_index = position['index']
         
@@ -594,6 +657,7 @@ class MainWindow(QMainWindow):
              self.boardView.clearPickup()
 
         #清空显示，同步棋盘状态    
+        self.engineInfoCoalescer.clear()
         self.engineView.clear()
         self.actionsView.clear()
         self.boardView.from_fen(fen)
@@ -606,7 +670,11 @@ class MainWindow(QMainWindow):
             self.localSearch(position)
             
             if self.isQueryCloud:
+                #旧局面还没返回的查询不再需要了，新局面要预取的局面还在查询的就接着查
+                fens = self.getPrefetchFens(position)
+                self.cloudQuery.cancelQueries(keep = [fen] + fens)
                 self.cloudQuery.startQuery(position)
+                self.cloudQuery.prefetch(fens)
             
             #引擎搜索 #TODO 根据checkbox状态搜索
             if Globl.gameManager.gameMode != GameMode.Free:
@@ -643,7 +711,7 @@ class MainWindow(QMainWindow):
 
     #-----------------------------------------------------------
     #fenCache 核心逻辑
-    def updateFenCache(self, fenInfo):
+    def updateFenCache(self, fenInfo, updateView = True):
 
         fen = fenInfo['fen']
         
@@ -665,31 +733,32 @@ class MainWindow(QMainWindow):
             Globl.fenCache[fen]['best_next'] = best_next 
 
         #本着法的其他更好的招法    
+        fen_key = getFenKey(fen)
         for act in actions.values():
             if 'score' not in act:
                 continue
-            new_fen = act['new_fen']
+            new_key = act['new_key']
 
             info = { 'score': act['score'], 'diff':act['diff'] }
             if (act['diff'] < -50) and best_next:
                 info['alter_best'] = best_next
 
-            if new_fen not in Globl.fenCache:
-                Globl.fenCache[new_fen] = {'fen_prev': fen}   
+            if new_key not in Globl.fenCache:
+                Globl.fenCache[new_key] = {'prev_key': fen_key}   
 
-            Globl.fenCache[new_fen].update(info)
+            Globl.fenCache[new_key].update(info)
                     
         if best_next:
             Globl.fenCache[fen]['best_next'] = best_next 
 
-        # 如果这一步的fen不在上个步骤的预测走法里面，需要根据fen_prev的分数建立此步骤的alter_best   
+        # 如果这一步的fen不在上个步骤的预测走法里面，需要根据上一步局面的分数建立此步骤的alter_best   
         fenInfo = Globl.fenCache[fen]
         
-        if ('diff' not in fenInfo) and ('fen_prev' in fenInfo):
+        if ('diff' not in fenInfo) and ('prev_key' in fenInfo):
             move_color = cchess.get_move_color(fen)    
-            fen_prev = fenInfo['fen_prev']
-            if fen_prev in Globl.fenCache :
-                prevInfo = Globl.fenCache[fen_prev]
+            prev_key = fenInfo['prev_key']
+            if prev_key in Globl.fenCache :
+                prevInfo = Globl.fenCache[prev_key]
                 if 'score' in prevInfo:
                     diff = prevInfo['score'] - fenInfo['score']
                     if move_color == cchess.BLACK:
@@ -698,6 +767,9 @@ class MainWindow(QMainWindow):
                     if (diff < -40) and ('best_next' in prevInfo):
                         fenInfo['alter_best'] = prevInfo['best_next']
         
+        if not updateView:
+            return
+
         for pos in self.positionList:
             if pos['fen'] == fen:
                 self.historyView.onUpdatePosition(pos)
@@ -713,66 +785,36 @@ class MainWindow(QMainWindow):
                 continue 
             fenInfo = Globl.fenCache[fen]
             newInfo = {}
-            if 'fen_prev' in fenInfo :
-                newInfo['fen_prev'] = fenInfo['fen_prev']
+            if 'prev_key' in fenInfo :
+                newInfo['prev_key'] = fenInfo['prev_key']
             Globl.fenCache[fen] = newInfo
 
             self.historyView.onUpdatePosition(pos)
 
     def localSearch(self, position):
-        
-        fen = position['fen']
-        
-        #开局库        
-        query = self.openBook.getMoves(fen)    
-        if query:
-            openbook_actions = query['actions']
-        else:
-            openbook_actions = OrderedDict()
+        #开局库和本地库在工作线程中查询，结果由onBookQueryResult处理
+        self.boardActions = OrderedDict()
+        self.actionsView.clear()
+        self.bookStack.startQuery(position)
 
-        #本地库库        
-        query = Globl.localBook.getMoves(fen)
-        if query:
-            local_actions = query['actions']
-        else:
-            local_actions = OrderedDict()
+    def onBookQueryResult(self, query):
+        
+        if not self.currPosition or (query['fen'] != self.currPosition['fen']):
+            return
 
-        for iccs, act in local_actions.items():
-            if iccs in openbook_actions:
-                act['score'] = openbook_actions[iccs]['score']
-            act['mark'] = "*"
-            
-        #合并最终的输出  
-        final_actions = openbook_actions.copy()
-        #合并本地库与开局库
-        for iccs, l_act in local_actions.items():
-            if iccs in final_actions:
-                f_act = final_actions[iccs]
-                f_act.update(l_act)
+        #云库或引擎的结果可能先到，已有的着法只补充库中的信息
+        for iccs, act in query['actions'].items():
+            if iccs in self.boardActions:
+                #已有的着法可能就是云库缓存中的dict，合并到副本上，不改动缓存
+                old_act = dict(self.boardActions[iccs])
+                for key, value in act.items():
+                    old_act.setdefault(key, value)
+                self.boardActions[iccs] = old_act
             else:
-                final_actions[iccs] = l_act
-
-        for iccs, o_act in openbook_actions.items():
-            o_act['score'] = ''
-
-        '''        
-        #更新分数 
-        for act in final_actions.values():
-            if 'new_fen' not in act:
-                continue
-            new_fen = act['new_fen']
-            if new_fen not in Globl.fenCache:
-                continue
-            info= Globl.fenCache[new_fen]
-            if 'score' not in info:
-                continue
-            act['score'] = info['score']
-        '''
-
+                self.boardActions[iccs] = act
+        
         #boardActions 存储当前局面下的最优走法
-        self.boardActions = final_actions
         self.actionsView.updateActions(self.boardActions)
-        
 
     def onCloudQueryResult(self, query):
         
@@ -816,6 +858,28 @@ class MainWindow(QMainWindow):
 
         if self.reviewMode == ReviewMode.ByCloud:
             self.onReviewGameStep()
+        elif self.isQueryCloud:
+            self.prefetchCloud(self.currPosition)
+
+    def prefetchCloud(self, position):
+        #翻看棋谱或者按推荐着法走棋时，云库结果可以直接从缓存中取出
+        self.cloudQuery.prefetch(self.getPrefetchFens(position))
+
+    def getPrefetchFens(self, position):
+        #要预取的局面：棋谱中后面几步的局面，以及当前局面最好的几个着法走后的局面
+        if self.reviewMode == ReviewMode.ByCloud:
+            return []
+        
+        index = position['index']
+        fens = [x['fen'] for x in self.positionList[index + 1 : index + 1 + CLOUD_PREFETCH_PLIES]]
+        
+        board = ChessBoard(position['fen'])
+        for iccs in list(self.boardActions.keys())[:CLOUD_PREFETCH_CHILDREN]:
+            move = board.copy().move_iccs(iccs)
+            if move:
+                fens.append(move.board_done.to_fen())
+        
+        return fens
 
     def showBestHint(self, fenInfo):
         best = []
@@ -849,9 +913,11 @@ class MainWindow(QMainWindow):
                 logging.error(f'updateFenCache error {e}')
                 logging.error(f'{fenInfo}')
                 return
+        
+        self.saveAnalysis(fenInfo)
 
+        #引擎复盘由ReviewWorker独占引擎完成，这里只会收到复盘前残留的输出
         if self.reviewMode == ReviewMode.ByEngine:
-            self.onReviewGameStep()
             return
         
         if self.moveEvent.is_set():
@@ -866,19 +932,24 @@ class MainWindow(QMainWindow):
         elif not self.isQueryCloud:
             self.showBestHint(fenInfo)
         
-    def onEngineMoveInfo(self, engine_id, fenInfo):
+    def onEngineMoveInfos(self, engine_id, fenInfos):
         
-        #if not self.isQueryCloud or (self.reviewMode == ReviewMode.ByEngine):
-        #    self.updateFenCache(fenInfo)
+        fenInfos = [x for x in fenInfos if self.isCurrMoveInfo(x)]
+        if not fenInfos:
+            return
+
+        self.engineView.onEngineMoveInfos(fenInfos, self.engineInfoCoalescer.getStats())
+
+    def isCurrMoveInfo(self, fenInfo):
 
         if not self.currPosition:
-            return
+            return False
 
-        fen = fenInfo['fen']
+        fen = fenInfo.get('fen', None)
 
         #引擎输出的历史数据,不处理
         if fen != self.currPosition['fen']:
-            return
+            return False
 
         '''    
         currmove = fenInfo.get('currmove', None)
@@ -889,14 +960,14 @@ class MainWindow(QMainWindow):
 
         moves = fenInfo.get('moves', None)
         if not moves:
-            return
+            return False
         
         iccs = moves[0]
         board = ChessBoard(fen)
         
         #引擎输出的历史数据,不处理
         if not board.is_valid_iccs_move(iccs):
-            return
+            return False
         
         '''
         moveShow = [cchess.iccs2pos(x) for x in moves[:2]]    
@@ -904,11 +975,12 @@ class MainWindow(QMainWindow):
             self.boardView.showMoveHint(moveShow)
         '''
 
-        self.engineView.onEngineMoveInfo(fenInfo)
+        return True
 
     def onEngineReady(self, engine_id, name, engine_options):
 
         logging.info(f'Engine[{engine_id}] {name} Ready.' )
+        self.engineName = name
         self.engineView.loadSettings(Globl.settings)
         self.engineView.onEngineReady(engine_id, name, engine_options)
         #默认只从自由练棋模式开始，减少复杂度
@@ -954,6 +1026,15 @@ class MainWindow(QMainWindow):
         if (self.engineRunColor[0] > 0) or (self.engineRunColor[move_color] > 0):
             #首行会没有move项
             params = self.engineView.getGoParams()
+            
+            #分析库中已有足够深度的结果，就不再启动引擎搜索
+            fenInfo = self.getEngineAnalysis(fen, params)
+            if fenInfo:
+                Globl.engineManager.stopThinking()
+                self.isRunEngine = False
+                QTimer.singleShot(0, lambda: self.onTryEngineMove(Globl.engineManager.id, fenInfo))
+                return
+
             try:
                 ok = Globl.engineManager.goFrom(fen_engine, fen, params)
                 self.isRunEngine = ok
@@ -967,6 +1048,27 @@ class MainWindow(QMainWindow):
                 QMessageBox.critical(self, f'{getTitle()}', f'加载象棋引擎[{engine_exec.absolute()}]出错，请确认该程序能在您的电脑上正确运行。')
                        
  
+    def getEngineAnalysis(self, fen, params):
+        #只有引擎分析模式、且按深度搜索时才使用分析库的结果，人机对战要保留引擎的限强设置
+        if Globl.gameManager.gameMode != GameMode.EngineAssit:
+            return None
+        
+        depth = params.get('depth', 0)
+        if depth <= 0:
+            return None
+        
+        return Globl.analysisStore.getAnalysis(fen, 'engine', minDepth = depth)
+    
+    def saveAnalysis(self, fenInfo):
+        #从分析库中读出的结果带有source，不用再保存
+        if 'source' in fenInfo:
+            return
+        
+        try:
+            Globl.analysisStore.saveAnalysis(fenInfo, 'engine', self.engineName)
+        except Exception as e:
+            logging.error(f'保存引擎分析结果错误：{e}')
+                       
     #------------------------------------------------------------------------------
     #UI Events
     def onTryBoardMove(self,  move_from,  move_to):
@@ -1104,9 +1206,70 @@ class MainWindow(QMainWindow):
             self.engineView.onReviewBegin(self.reviewMode)
             #self.reviewByEngineBtn.setText('停止复盘')
             logging.info('引擎复盘开始')
-            self.onReviewGameStep()
+            
+            #整盘棋在后台线程中连续分析，结果成批回到界面
+            self.reviewWorker = ReviewWorker(Globl.engineManager, self.reviewList, self.engineView.getGoParams(), pool = self.getEnginePool())
+            self.reviewWorker.resultSignal.connect(self.onReviewResults)
+            self.reviewWorker.progressSignal.connect(self.onReviewProgress)
+            self.reviewWorker.doneSignal.connect(self.onReviewWorkerDone)
+            self.reviewWorker.start()
         else:
             self.onReviewGameEnd(isCanceled=True)
+    
+    def getEnginePoolConfig(self):
+        #CPU线程和Hash内存在引擎池的各个引擎之间平分
+        options = {}
+        for key, value in self.engineView.params.items():
+            if key.startswith('param.'):
+                options[key[len('param.'):]] = value
+        options['Threads'] = getPoolThreads(self.reviewEngines)
+        #从配置文件读出的值可能是字符串
+        options['Hash'] = max(16, int(options.get('Hash') or 0) // self.reviewEngines)
+        
+        return (str(self.engine_exec), self.engine_type, self.reviewEngines, options)
+    
+    def resetEnginePool(self):
+        if self.enginePool:
+            self.enginePool.quit()
+        self.enginePool = None
+        self.enginePoolConfig = None
+
+    def getEnginePool(self):
+        if self.reviewEngines <= 1:
+            self.resetEnginePool()
+            return None
+        
+        #引擎、引擎个数或者引擎参数改了以后重建引擎池
+        config = self.getEnginePoolConfig()
+        if self.enginePool and (config != self.enginePoolConfig):
+            self.resetEnginePool()
+
+        if not self.enginePool:
+            engine_exec, engine_type, count, options = config
+            self.enginePool = EnginePool(None, engine_exec = engine_exec, engine_type = engine_type, 
+                                    count = count, options = options)
+            self.enginePoolConfig = config
+        
+        return self.enginePool
+
+    def onReviewResults(self, fenInfos):
+        for fenInfo in fenInfos:
+            self.updateFenCache(fenInfo, updateView = False)
+            self.saveAnalysis(fenInfo)
+        
+        #一批结果只刷新一次棋谱记录
+        fens = set(x['fen'] for x in fenInfos)
+        for pos in self.positionList:
+            if pos['fen'] in fens:
+                self.historyView.onUpdatePosition(pos)
+
+    def onReviewProgress(self, count, total):
+        self.statusBar().showMessage(f'复盘分析中：{count}/{total}')
+
+    def onReviewWorkerDone(self, isCanceled):
+        self.reviewWorker = None
+        if self.reviewMode == ReviewMode.ByEngine:
+            self.onReviewGameEnd(isCanceled)
             
     def onReviewGameStep(self):
         if len(self.reviewList) > 0:
@@ -1126,6 +1289,9 @@ class MainWindow(QMainWindow):
         
     def onReviewGameEnd(self, isCanceled=False):
         
+        if self.reviewWorker:
+            self.reviewWorker.stop()
+            
         #self.reviewByCloudBtn.setText('云库复盘')
         #self.reviewByEngineBtn.setText('引擎复盘')
         self.engineView.onReviewEnd(self.reviewMode)
@@ -1235,27 +1401,51 @@ class MainWindow(QMainWindow):
         self.isNeedSave = False
         self.updateTitle(f'{game["book_name"]} - {game["name"]}')
 
-    def loadBookGame(self, name, game):
+    def loadBookGame(self, name, game, positions = None):
         
         fen = game.init_board.to_fen()
         
-        self.initGame(fen)
+        #positions可以在读取文件的工作线程中提前生成
+        if positions is None:
+            moves = game.dump_iccs_moves()
+            positions = buildPositions(fen, moves[0] if moves else [])
         
-        moves = game.dump_iccs_moves()
+        self.initGame(fen)
         
-        if not moves:
+        if not positions:
             return
 
-        for iccs in moves[0]:
-            self.moveEvent.set()    
-            self.onMoveGo(iccs, quickMode = True)
-            #qApp.processEvents()
-            self.moveEvent.clear()    
+        self.replayPositions(positions)
             
         self.isNeedSave = False
         self.updateTitle(name)
         self.detectRunEngine()
 
+    def replayPositions(self, positions):
+        #一次性加入走好的局面，不逐步更新界面，最后只刷新一次
+        self.moveEvent.set()
+        
+        for position in positions:
+            self.positionList.append(position)
+            fen = position['fen']
+            if fen not in Globl.fenCache:
+                Globl.fenCache[fen] = {}
+            Globl.fenCache[fen].update({ 'prev_key': getFenKey(position['fen_prev']) })
+            self.historyView.onNewPostion(position, show = False)
+        
+        self.currPosition = self.positionList[-1]
+        self.board.from_fen(self.currPosition['fen'])
+        self.historyView.selectRow(self.currPosition['index'])
+        
+        self.updateStatus(quickMode = True)
+        if ('ecco' in self.positionList[0]) and (len(self.positionList) > 9):
+            ecco = getBookEcco(self.positionList[:25])
+            self.positionList[0]['ecco'] = '-'.join(ecco[1:])
+        
+        self.moveEvent.clear()
+        
+        self.changePositionSignal.emit(True)
+
     def loadBookmark(self, name, position):
     
         if self.isNeedSave :
@@ -1270,10 +1460,7 @@ class MainWindow(QMainWindow):
         
         moves = position.get('moves', [])
         if moves:
-            for iccs in moves:
-                self.moveEvent.set()
-                self.onMoveGo(iccs, quickMode = True)
-                self.moveEvent.clear()
+            self.replayPositions(buildPositions(fen, moves))
                     
         self.isNeedSave = False
         self.updateTitle(name)
@@ -1325,10 +1512,53 @@ class MainWindow(QMainWindow):
     #    dlg.edit(img)
 
     def onSearchBoard(self):
-        dlg = PositionEditDialog(self)
-        new_fen = dlg.edit('')
-        if new_fen:
-            self.initGame(new_fen)
+        #在对局库中搜索走到过当前局面的棋谱，搜索前先增量更新索引
+        if self.gameIndexWorker:
+            return
+        
+        fen = self.currPosition['fen'] if self.currPosition else cchess.FULL_INIT_FEN
+        self.searchBoardAct.setEnabled(False)
+        self.statusBar().showMessage('正在更新对局库索引...')
+        
+        self.gameIndexWorker = GameIndexWorker(Globl.gameIndex, self.gameIndexFolders, fen)
+        self.gameIndexWorker.progressSignal.connect(self.onGameIndexProgress)
+        self.gameIndexWorker.doneSignal.connect(self.onGameIndexSearchDone)
+        self.gameIndexWorker.start()
+        
+    def onGameIndexProgress(self, count, total):
+        self.statusBar().showMessage(f'正在更新对局库索引：{count}/{total}')
+
+    def onGameIndexSearchDone(self, fen, results):
+        self.gameIndexWorker.thread.wait()
+        self.gameIndexWorker = None
+        self.searchBoardAct.setEnabled(True)
+        self.statusBar().showMessage(f'找到 {len(results)} 局棋谱')
+        
+        if not results:
+            msgbox = TimerMessageBox('对局库中没有找到走到当前局面的棋谱。')
+            msgbox.exec()
+            return
+
+        self.gamelibView.updateSearchResult(results)
+        self.gamelibView.show()
+
+    def loadIndexedGame(self, result):
+        #result是棋库列表中的一项或者对局库搜索结果，这时才解析棋谱
+        fileName = Path(result['file'])
+        try:
+            game = readLibGame(fileName, result)
+        except Exception as e:
+            game = None
+            logging.error(f'读取棋谱文件【{fileName}】错误：{e}')
+            
+        if not game:
+            msgbox = TimerMessageBox(f"读取棋谱文件错误：{fileName}")
+            msgbox.exec()
+            return
+        
+        self.loadBookGame(f'{result.get("lib") or fileName.name}-{result["title"]}', game)
+        if 'ply' in result:
+            self.onSelectHistoryPosition(result['ply'])
 
     def onSetupEngine(self):
         dlg = EngineConfigDialog(self)
@@ -1358,6 +1588,8 @@ class MainWindow(QMainWindow):
 
         if not fileName:
             return
+        
+        self.openFile(fileName)
        
     def onSaveFile(self):
         
@@ -1416,37 +1648,73 @@ class MainWindow(QMainWindow):
             return
 
         ext = fileName.suffix.lower()
-        if ext in GAME_FILE_TYPES:
-            game = Game.read_from(fileName)
-            if not game:
-                msg = f"读取棋谱文件错误：{fileName}"
-                logging.error(msg)
-                msgbox = TimerMessageBox(msg)
-                msgbox.exec()
-                return
-            self.gamelibView.hide()
-            self.loadBookGame(fileName.name, game)
-            self.lastOpenFolder = str(fileName.parent)
+        if ext not in (GAME_TYPES_ALL + END_BOOK_TYPES):
+            msg = f"不支持的文件类型【{fileName}】"
+            logging.error(msg)
+            msgbox = TimerMessageBox(msg)
+            msgbox.exec()
+            return
         
-        elif ext in GAME_LIB_TYPES:
-            try:
-                game_lib = Game.read_from_lib(fileName)
-            except Exception as e:
-                msg = f"读取棋谱库文件【{fileName}】错误：{e}"
-                logging.error(msg)
-                msgbox = TimerMessageBox(msg)
-                msgbox.exec()
-                return
-
-            self.gamelibView.updateGameLib(game_lib)
-            self.gamelibView.show()
+        #上一个文件还在读取中
+        if self.fileLoadWorker:
+            return
 
-            self.lastOpenFolder = str(fileName.parent)
+        #在工作线程中读取文件，读取时间较长时显示进度，可以取消
+        self.fileLoadDialog = QProgressDialog(f'正在读取：{fileName.name}', '取消', 0, 0, self)
+        self.fileLoadDialog.setWindowTitle(getTitle())
+        self.fileLoadDialog.setWindowModality(Qt.WindowModal)
+        self.fileLoadDialog.setMinimumDuration(500)
+        
+        self.fileLoadWorker = FileLoadWorker(fileName)
+        self.fileLoadWorker.progressSignal.connect(self.onFileLoadProgress)
+        self.fileLoadWorker.doneSignal.connect(self.onFileLoaded)
+        self.fileLoadDialog.canceled.connect(self.fileLoadWorker.stop)
+        self.fileLoadWorker.start()
+        
+    def onFileLoadProgress(self, count, total):
+        if self.fileLoadWorker and not self.fileLoadWorker.stopEvent.is_set():
+            self.fileLoadDialog.setMaximum(total)
+            self.fileLoadDialog.setValue(count)
+
+    def onFileLoaded(self, result):
+        #读完和取消都会到这里，每次读取的进度对话框用完就删掉
+        self.fileLoadWorker.thread.wait()
+        self.fileLoadWorker = None
+        self.fileLoadDialog.canceled.disconnect()
+        self.fileLoadDialog.close()
+        self.fileLoadDialog.deleteLater()
+        self.fileLoadDialog = None
+        
+        fileName = Path(result['file'])
+        if result['canceled']:
+            self.statusBar().showMessage(f'已取消读取：{fileName.name}')
+            return
+        
+        if result['type'] == 'game':
+            game = result['game']
+            ok = (game is not None) and (result['positions'] is not None)
+        elif result['type'] == 'lib':
+            ok = bool(result['lib'])
         else:
-            msg = f"不支持的文件类型【{fileName}】"
+            ok = (result['type'] == 'endbook')
+        
+        if not ok:
+            msg = f"读取文件【{fileName}】错误：{result['error']}"
             logging.error(msg)
             msgbox = TimerMessageBox(msg)
             msgbox.exec()
+            return
+        
+        if result['type'] == 'game':
+            self.gamelibView.hide()
+            self.loadBookGame(fileName.name, result['game'], result['positions'])
+        elif result['type'] == 'lib':
+            self.gamelibView.updateGameLib(result['lib'])
+            self.gamelibView.show()
+        else:
+            self.endBookView.importEndBook(fileName, result['games'])
+        
+        self.lastOpenFolder = str(fileName.parent)
         
     def saveToFile(self, file_name):
 
@@ -1730,7 +1998,7 @@ class MainWindow(QMainWindow):
 
         #self.doOnlineAct.setEnabled(False)
         #self.gameBar.addAction(self.captureBoardAct)
-        #self.gameBar.addAction(self.searchBoardAct)
+        self.gameBar.addAction(self.searchBoardAct)
         
        
         self.queryCloudBox = QCheckBox("搜索云库")
@@ -1795,12 +2063,25 @@ class MainWindow(QMainWindow):
 
         Globl.engineManager.stopThinking()
         Globl.engineManager.quit()
+        if self.reviewWorker:
+            self.reviewWorker.stop()
+        self.resetEnginePool()
+        if self.gameIndexWorker:
+            self.gameIndexWorker.stop()
+        if self.fileLoadWorker:
+            self.fileLoadWorker.stop()
+        logging.info(f'引擎信息合并统计：{self.engineInfoCoalescer.getStats()}')
+        logging.info(f'fenCache统计：{Globl.fenCache.getStats()}')
         time.sleep(0.6)
         
-        self.openBook.close()
+        self.bookStack.close()
+        if self.openBook is not None:
+            self.openBook.close()
         #Globl.bookmarkStore.close()
         Globl.endbookStore.close()
         Globl.localBook.close()
+        Globl.analysisStore.close()
+        Globl.gameIndex.close()
         
         logging.info('应用关闭.')
 
@@ -2,6 +2,7 @@
 import os
 import time
 import json
+import logging
 import datetime as dt
 from collections import defaultdict, namedtuple
 from pathlib import Path
@@ -17,12 +18,17 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5.QtWidgets import *
 
-import pygetwindow as gw
+#找窗口截屏只在Windows上可用，没有时只能识别图片和视频(比如离线测试)
+try:
+    import pygetwindow as gw
+except Exception:
+    gw = None
 
 import cchess
 from cchess import ChessBoard
 
 from .Utils import scaleImage, TimerMessageBox, ThreadRunner
+from .BoardVision import FrameDiffer, TemplateMatcher, BoardTracker
 
 Point = namedtuple('Point', ['x', 'y'])
 Size = namedtuple('Size', ['width', 'height'])
@@ -110,6 +116,10 @@ class ImageSource():
 #-----------------------------------------------------------------------------------------        
 class MovieSource():
 
+    def __init__(self, differ = None):
+        #等待画面稳定的判断，可以换成缩小比较或者感知哈希比较的FrameDiffer
+        self.differ = differ if differ else FrameDiffer()
+
     def open(self, file_name):
         self.movie = cv.VideoCapture(file_name)
         
@@ -141,42 +151,12 @@ class MovieSource():
         return frame
         
     def get_image_roi(self, roi_rect = None):
+        #读到感兴趣区域稳定(与上一帧基本相同)的一帧
+        return self.differ.wait_stable(self.movie.read, roi_rect)
     
-        ok, frame = self.movie.read()      
-        if not ok:
-            return None
-        
-        if roi_rect is not None:    
-            img_roi = cv.split(frame[roi_rect[0][1]:roi_rect[1][1], roi_rect[0][0]:roi_rect[1][0]])[0]
-
-        for x in range(25):
-            ok, new_frame = self.movie.read()
-            if not ok:
-                break
-            
-            if roi_rect is not None:
-                img_new_roi = cv.split(new_frame[roi_rect[0][1]:roi_rect[1][1], roi_rect[0][0]:roi_rect[1][0]])[0]
-
-                chang_count = 0
-                change = cv.absdiff(img_roi, img_new_roi)
-    
-                #cv.imshow('INIT BOARD',img_new_roi)
-                #cv.waitKey(0)
-
-                for y in range(change.shape[0]):
-                    for x in range(change.shape[1]):
-                        p = change[y, x]
-                        if p > 15:
-                            chang_count += 1
-                
-                #print(chang_count)            
-                if chang_count < 500:
-                    break
-                
-                img_roi = img_new_roi                
-            frame = new_frame        
-        
-        return frame 
+    def get_stats(self):
+        #每次比较两帧的耗时
+        return self.differ.latency.get_stats()
 
 #-----------------------------------------------------------------------------------------------------
 class ScreenSource():
@@ -191,6 +171,8 @@ class ScreenSource():
     def connect(self, window_title, marge):
 
         self.win = None
+        if gw is None:
+            return False
         windows = gw.getWindowsWithTitle(window_title)
         if len(windows) == 0:
             return False
@@ -213,7 +195,7 @@ class ScreenSource():
         
     def grab(self):
         
-        if not self.title:
+        if (not self.title) or (gw is None):
             return None
 
         windows = gw.getWindowsWithTitle(self.title)
@@ -263,6 +245,10 @@ class OnlineManager(QObject):
         self.piece_radius = 0
         self.piece_points = []
         self.piece_tmpl = {}
+        #模板改变后置为None，下次识别时重建
+        self.matcher = None
+        #在线时跟踪棋盘，只识别变化的格子
+        self.tracker = None
     
         self.img_size = Size(0, 0)    
         self.img = None
@@ -297,7 +283,23 @@ class OnlineManager(QObject):
         if img is None:
             return None
         #self.boardImageView.updateImage(img)
-        fen = self.to_fen()
+        return self.track_board()
+
+    def track_board(self):
+        #跟踪self.img_cv上的棋盘，返回新走的着法(iccs)列表，局面在self.tracker.board
+        #第一次或者跟踪失败时整个棋盘重新识别，这时没有着法
+        crops = self.get_square_imgs()
+        matcher = self.get_matcher()
+        if (self.tracker is None) or (self.tracker.matcher is not matcher):
+            self.tracker = BoardTracker(matcher)
+            self.tracker.reset(crops)
+            return []
+
+        moves = self.tracker.update(crops)
+        #与引擎的moveSignal相同，fen是走子前的局面
+        for fen, iccs in zip(self.tracker.fens[len(self.tracker.fens) - len(moves):], moves):
+            self.moveSignal.emit(0, {'fen': fen, 'iccs': iccs})
+        return moves
 
     def is_ready(self):
         return self.source.is_connected()
@@ -346,6 +348,22 @@ class OnlineManager(QObject):
         im = self.img_cv[top : bottom, left :right] 
         
         return im
+    
+    def get_matcher(self):
+        #格子图像的大小随棋子半径变化，大小变了也要重建
+        v = int(self.piece_radius / 1.2 / 1.5)
+        crop_size = (2 * v, 2 * v)
+        if (self.matcher is None) or (self.matcher.crop_size != crop_size):
+            self.matcher = TemplateMatcher(self.piece_tmpl, crop_size)
+        return self.matcher
+    
+    def get_square_imgs(self):
+        #90个格子的图像，下标是y * 9 + x
+        return [self.get_piece_img(Point(x, y), small = True) for y in range(10) for x in range(9)]
+
+    def match_squares(self):
+        #90个格子一次识别，和上一帧相比没有变化的格子不重新识别
+        return self.get_matcher().match_frame(self.get_square_imgs())
             
     def detect_board(self):
         
@@ -435,13 +453,15 @@ class OnlineManager(QObject):
                     break
             if not found:
                 miss_count += 1
-
+        
+        self.matcher = None
+        results = self.match_squares()
+        
         for y in range(10):
             for x in range(9):
                 pt = Point(x, y)
                 pos = self.point_board_to_image(pt)
-                img = self.get_piece_img(pt, small = True)
-                fench, max_match, _ = self.detect_piece(img)
+                fench, max_match = results[y * 9 + x]
                 if not fench:
                     continue
                 color = (255, 0, 0) if fench.islower() else (0, 0, 255)
@@ -455,12 +475,12 @@ class OnlineManager(QObject):
         
         pieces = []
         img_src = self.img_cv.copy()
+        results = self.match_squares()
         for y in range(10):
             for x in range(9):
                 pt = Point(x, y)
                 pos = self.point_board_to_image(pt)
-                img = self.get_piece_img(pt, small = True)
-                fench, max_match, img_match = self.detect_piece(img)
+                fench, max_match = results[y * 9 + x]
                 if not fench:
                     continue
                 color = (255, 0, 0) if fench.islower() else (0, 0, 255)
@@ -492,28 +512,6 @@ class OnlineManager(QObject):
         
         return board.to_fen()
 
-    def detect_piece(self, img_src):
-        ret = None
-        max_match = 0.0 
-        for key, img_tmpl in self.piece_tmpl.items():
-            #print(img_src.shape, img_tmpl.shape)
-            
-            result = cv.matchTemplate(img_src, img_tmpl, cv.TM_CCOEFF_NORMED)
-            min_val, max_val, min_loc, max_loc = cv.minMaxLoc(result)
-            #print(min_val, max_val)
-            if max_val > max_match:
-                max_match = max_val
-                ret = key
-        
-        img = None
-        if max_match > 0.8:
-            bottom,right = img_src.shape[:2]
-            im = self.piece_tmpl[ret][0:bottom, 0:right] 
-        
-            img = np.concatenate((img_src, im), axis=0)
-            
-        return (ret, max_match, img)
-        
     def to_schema(self, name):
 
         if name not in self.schemas:
@@ -613,6 +611,7 @@ class OnlineManager(QObject):
                 
                 self.piece_tmpl[fench] = image[top : bottom, left :right]
         
+        self.matcher = None
         return True 
 
     def load_schema_file(self, templ_file):
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from queue import Queue, Empty
+from pathlib import Path
+
+from PyQt5.QtCore import pyqtSignal, QObject
+
+import cchess
+from cchess import ChessBoard, Game, UcciEngine, UciEngine
+
+from .Engine import parseBestMove, waitEngineOutput, WAIT_OUTPUT_TIMEOUT
+from .Utils import ThreadRunner
+
+#-----------------------------------------------------#
+#每分析完这么多步，才把结果批量送到界面一次
+REVIEW_BATCH_SIZE = 8
+
+#单个局面的最长分析时间(秒)，超时后发送stop取回当前最优着法
+REVIEW_POSITION_TIMEOUT = 60
+
+#发送stop后仍然没有bestmove，等这么久就放弃这个局面(秒)
+REVIEW_STOP_TIMEOUT = 5
+
+#-----------------------------------------------------#
+def positionsFromGame(game):
+    #按照MainWindow.onMoveGo的方式生成主线上每一步的局面，但不涉及任何界面操作
+    board = game.init_board.copy()
+    fen = board.to_fen()
+
+    positions = [{'fen': fen, 'fen_engine': fen, 'index': 0, 'move_color': board.get_move_color()}]
+
+    moves = game.dump_iccs_moves()
+    if not moves:
+        return positions
+
+    history = []
+    for iccs in moves[0]:
+        move = board.move_iccs(iccs)
+        if move is None:
+            break
+        board.next_turn()
+        move.prepare_for_engine(board.move_player, history)
+        history.append(move)
+
+        positions.append({
+            'fen': board.to_fen(),
+            'fen_engine': move.to_engine_fen(),
+            'fen_prev': move.board.to_fen(),
+            'iccs': iccs,
+            'index': len(positions),
+            'move_color': move.board.move_player.color
+        })
+
+    return positions
+
+#-----------------------------------------------------#
+class EngineReviewer():
+    #在调用者线程中同步驱动一个引擎，一个局面分析完马上发送下一个，中间没有界面往返
+    def __init__(self, engine, params, timeout = REVIEW_POSITION_TIMEOUT, stop_timeout = REVIEW_STOP_TIMEOUT):
+        self.engine = engine
+        self.params = params
+        self.timeout = timeout
+        self.stop_timeout = stop_timeout
+
+    def sync(self, timeout = 5):
+        #丢弃之前搜索残留的输出，直到引擎回应readyok
+        self.engine._send_cmd('isready')
+        start_time = time.time()
+        while (time.time() - start_time) < timeout:
+            action = self.engine.get_action()
+            if action is None:
+                waitEngineOutput(self.engine, WAIT_OUTPUT_TIMEOUT)
+                continue
+            if action.get('raw_msg', '') == 'readyok':
+                return True
+        return False
+
+    def analyse(self, position, stopEvent = None):
+
+        fen = position['fen']
+        fen_engine = position.get('fen_engine', fen)
+
+        if cchess.EMPTY_BOARD in fen:
+            return None
+
+        self.engine.go_from(fen_engine, self.params)
+
+        start_time = time.time()
+        stop_time = None
+        while True:
+            action = self.engine.get_action()
+            if action is None:
+                now = time.time()
+                if stop_time is None:
+                    #超时或者复盘被取消时发送stop，让引擎尽快给出着法
+                    if ((now - start_time) > self.timeout) or (stopEvent and stopEvent.is_set()):
+                        self.engine._send_cmd('stop')
+                        stop_time = now
+                elif (now - stop_time) > self.stop_timeout:
+                    logging.warning(f'引擎没有给出着法，跳过局面：{fen}')
+                    return None
+                waitEngineOutput(self.engine, WAIT_OUTPUT_TIMEOUT)
+                continue
+
+            act_id = action['action']
+            if act_id == 'bestmove':
+                ret = parseBestMove(action, fen, self.engine)
+                if ret is not None:
+                    return ret
+            elif act_id in ['dead', 'draw']:
+                #走子方被将死或者困毙，换算到红方得分
+                ret = {'fen': fen, 'action': act_id}
+                if act_id == 'dead':
+                    ret['mate'] = 0
+                    ret['score'] = -29999 if (ChessBoard(fen).get_move_color() == cchess.RED) else 29999
+                else:
+                    ret['score'] = 0
+                return ret
+
+    def review(self, positions, onResult = None, stopEvent = None):
+        results = []
+        for position in positions:
+            if stopEvent and stopEvent.is_set():
+                break
+            ret = self.analyse(position, stopEvent)
+            if ret is None:
+                continue
+            ret['index'] = position['index']
+            results.append(ret)
+            if onResult:
+                onResult(ret)
+        return results
+
+#-----------------------------------------------------#
+def loadEngine(engine_exec, engine_type, options = {}):
+    engine = UciEngine('') if engine_type == 'uci' else UcciEngine('')
+    if (not engine.load(engine_exec)) or (not engine.wait_for_ready()):
+        return None
+    for name, value in options.items():
+        engine.set_option(name, value)
+    return engine
+
+def getPoolThreads(count):
+    #每个引擎分到的线程数，所有引擎加起来正好用满CPU
+    return max(1, (os.cpu_count() or 1) // max(1, count))
+
+class EnginePool():
+    #多个引擎进程同时复盘，局面放在共享队列里，哪个引擎空闲就取下一个局面
+    #接口与EngineReviewer相同，可以直接替换
+    def __init__(self, params, engines = None, engine_exec = None, engine_type = 'uci', count = 1, options = {}):
+        self.params = params
+        self.engines = engines if engines else []
+        self.engine_exec = engine_exec
+        self.engine_type = engine_type
+        self.count = count
+        self.options = options
+
+    def load(self):
+        if self.engines:
+            return True
+
+        options = dict(self.options)
+        options.setdefault('Threads', getPoolThreads(self.count))
+
+        for i in range(self.count):
+            engine = loadEngine(self.engine_exec, self.engine_type, options)
+            if engine is None:
+                logging.error(f'加载复盘引擎[{self.engine_exec}]失败')
+                break
+            self.engines.append(engine)
+
+        logging.info(f'复盘引擎池：{len(self.engines)} 个引擎，每个引擎 {options["Threads"]} 线程')
+        return len(self.engines) > 0
+
+    def quit(self):
+        for engine in self.engines:
+            engine.quit()
+        self.engines = []
+
+    def review(self, positions, onResult = None, stopEvent = None):
+        queue = Queue()
+        for position in positions:
+            queue.put(position)
+
+        results = []
+        lock = threading.Lock()
+
+        def work(engine):
+            reviewer = EngineReviewer(engine, self.params)
+            reviewer.sync()
+            while not (stopEvent and stopEvent.is_set()):
+                try:
+                    position = queue.get_nowait()
+                except Empty:
+                    break
+                ret = reviewer.analyse(position, stopEvent)
+                if ret is None:
+                    continue
+                ret['index'] = position['index']
+                with lock:
+                    results.append(ret)
+                    if onResult:
+                        onResult(ret)
+            reviewer.sync()
+
+        threads = [threading.Thread(target = work, args = (engine, ), daemon = True) for engine in self.engines]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        results.sort(key = lambda x: x['index'])
+        return results
+
+#-----------------------------------------------------#
+class ReviewWorker(QObject):
+    resultSignal = pyqtSignal(list)
+    progressSignal = pyqtSignal(int, int)
+    doneSignal = pyqtSignal(bool)
+
+    def __init__(self, engineManager, positions, params, options = {}, pool = None):
+        super().__init__()
+
+        self.engineManager = engineManager
+        self.positions = positions
+        self.params = params
+        self.options = options
+        self.pool = pool
+
+        self.stopEvent = threading.Event()
+        self.lock = threading.Lock()
+        self.batch = []
+        self.count = 0
+
+    def start(self):
+        self.thread = ThreadRunner(self)
+        self.thread.start()
+
+    def stop(self):
+        self.stopEvent.set()
+
+    def run(self):
+        start_time = time.time()
+        try:
+            if self.pool and self.pool.load():
+                self.pool.params = self.params
+                self.pool.review(self.positions, self.onResult, self.stopEvent)
+            else:
+                self.reviewByMainEngine()
+        except Exception as e:
+            logging.error(f'复盘分析错误：{e}')
+
+        self.flush()
+
+        used = time.time() - start_time
+        logging.info(f'复盘分析 {self.count} 步，用时 {used:.1f} 秒')
+        self.doneSignal.emit(self.stopEvent.is_set())
+
+    def reviewByMainEngine(self):
+        with self.engineManager.borrowEngine() as engine:
+            engine.stop_thinking()
+            for name, value in self.options.items():
+                engine.set_option(name, value)
+
+            reviewer = EngineReviewer(engine, self.params)
+            reviewer.sync()
+            reviewer.review(self.positions, self.onResult, self.stopEvent)
+            reviewer.sync()
+
+    #多引擎复盘时onResult会在多个线程中被调用
+    def onResult(self, fenInfo):
+        with self.lock:
+            self.batch.append(fenInfo)
+            self.count += 1
+            if len(self.batch) < REVIEW_BATCH_SIZE:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            batch = self.batch
+            self.batch = []
+            count = self.count
+        self.progressSignal.emit(count, len(self.positions))
+        if batch:
+            self.resultSignal.emit(batch)
+
+#-----------------------------------------------------#
+def annotateGame(reviewer, game):
+    positions = positionsFromGame(game)
+    results = {x['index']: x for x in reviewer.review(positions)}
+
+    steps = []
+    for position in positions:
+        index = position['index']
+        if index not in results:
+            continue
+        ret = results[index]
+        step = {'index': index, 'fen': position['fen'], 'score': ret['score']}
+        if 'iccs' in position:
+            step['move'] = position['iccs']
+        if 'iccs' in ret:
+            step['best'] = ret['iccs']
+        if 'mate' in ret:
+            step['mate'] = ret['mate']
+        #本步着法与上一局面最优着法的分差(走子方视角)
+        if (index - 1) in results:
+            diff = ret['score'] - results[index - 1]['score']
+            if position['move_color'] == cchess.BLACK:
+                diff = -diff
+            step['diff'] = diff
+        steps.append(step)
+
+    return steps
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = '批量引擎复盘，为棋谱的每一步标注分数')
+    parser.add_argument('files', nargs = '+', help = '棋谱文件(xqf, pgn, cbr, cbf)')
+    parser.add_argument('--engine', required = True, help = '引擎程序路径')
+    parser.add_argument('--type', default = 'uci', choices = ['uci', 'ucci'], help = '引擎类型')
+    parser.add_argument('--depth', type = int, default = 18, help = '每步搜索深度')
+    parser.add_argument('--movetime', type = int, default = 0, help = '每步搜索时间(毫秒)')
+    parser.add_argument('--option', action = 'append', default = [], help = '引擎参数 name=value')
+    parser.add_argument('--jobs', type = int, default = 1, help = '同时运行的引擎个数，CPU线程平均分配')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level = logging.INFO)
+
+    options = {}
+    for opt in args.option:
+        name, value = opt.split('=', 1)
+        options[name] = value
+
+    params = {}
+    if args.depth > 0:
+        params['depth'] = args.depth
+    if args.movetime > 0:
+        params['movetime'] = args.movetime
+
+    reviewer = EnginePool(params, engine_exec = args.engine, engine_type = args.type, count = max(1, args.jobs), options = options)
+    if not reviewer.load():
+        print(f'加载引擎[{args.engine}]失败')
+        return -1
+
+    for file_name in args.files:
+        game = Game.read_from(file_name)
+        if game is None:
+            print(f'读取棋谱文件错误：{file_name}')
+            continue
+        start_time = time.time()
+        steps = annotateGame(reviewer, game)
+        out_file = Path(file_name).with_suffix('.review.json')
+        with open(out_file, 'w', encoding = 'utf-8') as f:
+            json.dump(steps, f, ensure_ascii = False, indent = 1)
+        print(f'{file_name}: {len(steps)} 步, {time.time() - start_time:.1f} 秒 -> {out_file}')
+
+    reviewer.quit()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,7 +11,7 @@ from PyQt5.QtWidgets import QStyle, QApplication, QMenu, QHBoxLayout, QVBoxLayou
                     QLabel, QSpinBox, QCheckBox, QPushButton, QRadioButton, QToolButton, \
                     QWidget, QDockWidget, QDialogButtonBox, QButtonGroup, QListWidget, QListWidgetItem, QInputDialog, \
                     QAbstractItemView, QComboBox, QTreeWidgetItem, QTreeWidget, QTextEdit, QSplitter, QMessageBox, QTableView, \
-                    QWidget,QHeaderView, QAbstractItemView
+                    QWidget,QHeaderView, QAbstractItemView, QListView
 
 import cchess
 from cchess import ChessBoard
@@ -20,6 +20,7 @@ from .Utils import Stage, GameMode, ReviewMode, getTitle, TimerMessageBox, getFr
 from .BoardWidgets import ChessBoardWidget, ChessBoardEditWidget
 from .SnippingWidget import SnippingWidget
 from .Dialogs import EngineConfigDialog
+from .GameLib import GameLibModel
 
 from . import Globl
 
@@ -1018,10 +1019,23 @@ class EngineWidget(QDockWidget):
         self.parent.onViewBranch(fenInfo)
         
         
-    def onEngineMoveInfo(self, fenInfo):
+    def onEngineMoveInfos(self, fenInfos, stats = None):
+        #成批刷新，整批只排序一次
+        updated = False
+        for fenInfo in fenInfos:
+            if self.updateMoveInfo(fenInfo):
+                updated = True
+        
+        if updated:
+            self.posView.sortItems(1, Qt.AscendingOrder)
+
+        if stats:
+            self.engineLabel.setToolTip(f"引擎信息 {stats['received']} 条，合并 {stats['merged']} 条，丢弃 {stats['dropped']} 条")
+
+    def updateMoveInfo(self, fenInfo):
         
         if "moves" not in fenInfo:
-            return
+            return False
 
         iccs_str = ','.join(fenInfo["moves"])
         fenInfo['iccs_str'] = iccs_str
@@ -1031,7 +1045,7 @@ class EngineWidget(QDockWidget):
         ok, moves_text = getStepsTextFromFenMoves(fen, fenInfo["moves"])
         if not ok:
             #logging.warning(f'{fen}, moves {fenInfo["moves"]}')
-            return
+            return False
         
         fenInfo['move_1'] = ','.join(moves_text[:2])
         fenInfo['move_2'] = ','.join(moves_text[2:])
@@ -1051,7 +1065,8 @@ class EngineWidget(QDockWidget):
             it = QTreeWidgetItem(self.posView)
         
         self.updateNode(it, fenInfo)
-        self.posView.sortItems(1, Qt.AscendingOrder)
+        
+        return True
         
     def updateNode(self, it, fenInfo):
 
@@ -1509,6 +1524,10 @@ class EndBookWidget(QDockWidget):
         if not fileName:
             return
 
+        self.importEndBook(fileName)
+    
+    def importEndBook(self, fileName, games = None):
+        #games是已经读好的局面(例如在读文件的工作线程中)，没有时在这里读取
         lib_name = Path(fileName).stem
         if Globl.endbookStore.isEndBookExist(lib_name):
             msgbox = TimerMessageBox(f"杀局谱[{lib_name}]系统中已经存在，不能重复导入。",
@@ -1516,11 +1535,12 @@ class EndBookWidget(QDockWidget):
             msgbox.exec()
             return
         ext = Path(fileName).suffix.lower()
-        if ext =='.eglib': 
-            games = loadEglib(fileName)
-            Globl.endbookStore.saveEndBook(lib_name, games)
-        if ext =='.csv':  
-            games = loadCsvlib(fileName)
+        if games is None:
+            if ext =='.eglib': 
+                games = loadEglib(fileName)
+            if ext =='.csv':  
+                games = loadCsvlib(fileName)
+        if games is not None:
             Globl.endbookStore.saveEndBook(lib_name, games)
                 
         self.updateBooks()
@@ -1710,7 +1730,11 @@ class GameLibWidget(QDockWidget):
         self.dockedWidget = QWidget(self)
         self.setWidget(self.dockedWidget)
 
-        self.gamesView = QListWidget()
+        #列表只保存棋谱索引，双击时才读取棋谱
+        self.gamesModel = GameLibModel(self)
+        self.gamesView = QListView()
+        self.gamesView.setModel(self.gamesModel)
+        self.gamesView.setUniformItemSizes(True)
         self.gamesView.doubleClicked.connect(self.onDoubleClicked)
 
         vbox = QVBoxLayout()
@@ -1727,26 +1751,19 @@ class GameLibWidget(QDockWidget):
 
 
     def updateGameLib(self, gamelib):
-        #self.
+        #gamelib是GameLib.readLibIndex的结果
         self.gamelib = gamelib
-        games = gamelib['games']   
-
-        self.gamesView.clear()
-        
-        for i, it in enumerate(games):
-            item = QListWidgetItem()
-            item.setText(it.info['title'])
-            item.setData(Qt.UserRole, it)
-            self.gamesView.addItem(item)
+        self.gamesModel.setEntries(gamelib['games'])
     
-    def onDoubleClicked(self):
-        item = self.gamesView.currentItem()
-        game = item.data(Qt.UserRole)
-        name = f'{self.gamelib["name"]}-{game.info["title"]}'
-        self.parent.loadBookGame(name, game)
-
-    def onSelectIndex(self, index):
-        self.curr_item = self.gamesView.itemFromIndex(index)
+    def updateSearchResult(self, results):
+        #局面搜索的结果
+        self.gamesModel.setEntries(results)
+    
+    def onDoubleClicked(self, index):
+        entry = self.gamesModel.entry(index)
+        if entry is None:
+            return
+        self.parent.loadIndexedGame(entry)
 
     def sizeHint(self):
         return QSize(150, 500)